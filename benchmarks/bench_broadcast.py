@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# Comet VOEvent Broker.
+# Benchmark distribution of events to filtering subscribers.
+#
+# Sends events to increasing numbers of subscribers, each with an XPath
+# filter, and compares evaluating every subscriber's filter in its own thread
+# with VOEventBroadcasterFactory.send_event, which evaluates all the filters
+# for an event in a single task. By default, the filters take a form which
+# can be indexed; use --unindexed to have them evaluated as XPath. For example:
+#
+#     python benchmarks/bench_broadcast.py --subscribers 100 1000 5000
+
+import argparse
+import time
+
+from twisted.internet import defer, task
+from twisted.internet.threads import deferToThread
+
+from comet.protocol.broadcaster import VOEventBroadcasterFactory
+from comet.utility import VOEventMessage
+
+from bench_infer_type import make_event
+
+FILTER = '//Param[@name="param%d" and @value > 0]'
+UNINDEXED_FILTER = '//Param[@name="param%d"][@value > 0]'
+
+
+class Subscriber(object):
+    def __init__(self, filters):
+        self.filters = filters
+        self.received = 0
+
+    def deliver_event(self, event):
+        self.received += 1
+
+
+def per_filter(broadcasters, event):
+    """Evaluate each subscriber's filters in their own threads."""
+
+    def deliver(result, broadcaster):
+        if any(value for success, value in result if success):
+            broadcaster.deliver_event(event)
+
+    return defer.gatherResults(
+        [
+            defer.DeferredList(
+                [deferToThread(xpath, event.element) for xpath in b.filters],
+                consumeErrors=True,
+            ).addCallback(deliver, b)
+            for b in broadcasters
+        ]
+    )
+
+
+@defer.inlineCallbacks
+def run(send, events):
+    start = time.perf_counter()
+    for event in events:
+        yield send(event)
+    return (time.perf_counter() - start) / len(events)
+
+
+@defer.inlineCallbacks
+def main(reactor, args):
+    events = [VOEventMessage(make_event(args.size * 1024)) for _ in range(args.events)]
+    expression = UNINDEXED_FILTER if args.unindexed else FILTER
+    for count in args.subscribers:
+        factory = VOEventBroadcasterFactory("ivo://comet.broker/bench", 0)
+        broadcasters = [
+            Subscriber([factory.install_filter(expression % (n % args.distinct,))])
+            for n in range(count)
+        ]
+        before = yield run(lambda event: per_filter(broadcasters, event), events)
+        after = yield run(lambda event: factory.send_event(event, broadcasters), events)
+        print(
+            "%5d subscribers  per filter: %8.2f ms  single task: %8.2f ms  (%.1fx)"
+            % (count, 1e3 * before, 1e3 * after, before / after)
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark event distribution.")
+    parser.add_argument(
+        "--subscribers",
+        type=int,
+        nargs="*",
+        default=[100, 1000, 5000],
+        help="Numbers of subscribers to test [default: 100 1000 5000].",
+    )
+    parser.add_argument(
+        "--distinct",
+        type=int,
+        default=50,
+        help="Number of distinct filters in use [default=%(default)s].",
+    )
+    parser.add_argument(
+        "--events",
+        type=int,
+        default=20,
+        help="Events to send to each set of subscribers [default=%(default)s].",
+    )
+    parser.add_argument(
+        "--size",
+        type=int,
+        default=5,
+        help="Size of each event (kilobytes) [default=%(default)s].",
+    )
+    parser.add_argument(
+        "--unindexed",
+        action="store_true",
+        help="Use filters which cannot be indexed.",
+    )
+    task.react(main, [parser.parse_args()])
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# Comet VOEvent Broker.
+# Benchmark the event database backends.
+#
+# Records a number of synthetic event keys in each backend, then checks them
+# all again, reporting the rate at which each pass completes. For example:
+#
+#     python benchmarks/bench_event_db.py --events 10000000 dbm mapped
+
+import argparse
+import shutil
+import tempfile
+import time
+from hashlib import sha1
+
+from comet.utility import Event_DB, MappedEventDB, PartitionedEventDB, SQLiteEventDB
+
+BACKENDS = {
+    "dbm": Event_DB,
+    "mapped": MappedEventDB,
+    "partitioned": PartitionedEventDB,
+    "sqlite": SQLiteEventDB,
+}
+
+
+def batches(count, batch_size, sources):
+    """
+    Generate batches of ``(db_path, key)`` pairs for ``count`` events, spread
+    over ``sources`` databases.
+    """
+    for start in range(0, count, batch_size):
+        stop = min(start + batch_size, count)
+        yield [
+            ("source%d" % (i % sources,), sha1(b"%d" % (i,)).hexdigest())
+            for i in range(start, stop)
+        ]
+
+
+def run_pass(event_db, args, expected):
+    start = time.perf_counter()
+    for batch in batches(args.events, args.batch_size, args.sources):
+        results = event_db.check_batch(batch)
+        if any(result != expected for result in results):
+            raise RuntimeError("Unexpected result from %r" % (event_db,))
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark event databases.")
+    parser.add_argument(
+        "backends",
+        nargs="*",
+        default=["dbm", "mapped"],
+        choices=sorted(BACKENDS),
+        help="Backends to benchmark [default: dbm mapped].",
+    )
+    parser.add_argument(
+        "--events",
+        type=int,
+        default=10000000,
+        help="Number of events to record [default=%(default)s].",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=100,
+        help="Events per call to check_batch [default=%(default)s].",
+    )
+    parser.add_argument(
+        "--sources",
+        type=int,
+        default=10,
+        help="Number of distinct event sources [default=%(default)s].",
+    )
+    args = parser.parse_args()
+
+    for name in args.backends:
+        root = tempfile.mkdtemp()
+        try:
+            event_db = BACKENDS[name](root)
+            insert = run_pass(event_db, args, True)
+            lookup = run_pass(event_db, args, False)
+            event_db.close()
+        finally:
+            shutil.rmtree(root)
+        print(
+            "%-12s insert: %10.0f events/s  lookup: %10.0f events/s"
+            % (name, args.events / insert, args.events / lookup)
+        )
+
+
+if __name__ == "__main__":
+    main()
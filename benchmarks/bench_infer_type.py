@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# Comet VOEvent Broker.
+# Benchmark message type inference.
+#
+# Compares xml_document.infer_type, which parses each payload once, with the
+# previous approach of parsing it once to find the role and again to
+# construct the message, for VOEvents of a range of sizes. For example:
+#
+#     python benchmarks/bench_infer_type.py --sizes 2 5 10 20
+
+import argparse
+import timeit
+
+from comet.testutils import DUMMY_VOEVENT
+from comet.utility import VOEventMessage, xml_document
+
+PARAM = b'<Param name="param%d" value="%d" unit="ct" ucd="phot.count"/>'
+
+
+def make_event(size):
+    """Return a VOEvent payload of approximately ``size`` bytes."""
+    params = []
+    length = len(DUMMY_VOEVENT)
+    while length < size:
+        params.append(PARAM % (len(params), len(params)))
+        length += len(params[-1])
+    what = b"<What>" + b"".join(params) + b"</What>"
+    return DUMMY_VOEVENT.replace(b"</voe:VOEvent>", what + b"</voe:VOEvent>")
+
+
+def double_parse(raw_bytes):
+    xml_document(raw_bytes).role
+    return VOEventMessage(raw_bytes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark infer_type.")
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="*",
+        default=[2, 5, 10, 20],
+        help="Event sizes to test (kilobytes) [default: 2 5 10 20].",
+    )
+    parser.add_argument(
+        "--number",
+        type=int,
+        default=2000,
+        help="Messages to parse at each size [default=%(default)s].",
+    )
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        raw_bytes = make_event(size * 1024)
+        before = timeit.timeit(lambda: double_parse(raw_bytes), number=args.number)
+        after = timeit.timeit(
+            lambda: xml_document.infer_type(raw_bytes), number=args.number
+        )
+        print(
+            "%3d KB  double parse: %7.1f us  single parse: %7.1f us  saved: %4.1f%%"
+            % (
+                size,
+                1e6 * before / args.number,
+                1e6 * after / args.number,
+                100 * (before - after) / before,
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# Comet VOEvent Broker.
+# Benchmark schema validation.
+#
+# Submits a burst of events to CheckSchema, validating them in a thread and
+# then in pools of worker processes of increasing size, and reports the
+# throughput achieved by each. For example:
+#
+#     python benchmarks/bench_schema.py --processes 1 2 4 8 --events 5000
+#
+# Sending events to worker processes has a substantial cost, which is only
+# repaid when there are spare cores for the workers to use. On a machine with
+# a single CPU, a pool of one process achieved 0.23 times the throughput of
+# validation in a thread. Validation in a thread therefore remains the
+# default; measure before enabling the pool.
+
+import argparse
+import os
+import time
+
+from twisted.internet import defer, task
+
+import comet
+from comet.utility import VOEventMessage
+from comet.validator import CheckSchema
+
+from bench_infer_type import make_event
+
+SCHEMA = os.path.join(comet.__path__[0], "schema/VOEvent-v2.0.xsd")
+
+
+@defer.inlineCallbacks
+def run(processes, events, max_pending):
+    validator = CheckSchema(SCHEMA, processes, max_pending, len(events))
+    try:
+        # Start the workers before the clock does.
+        yield validator(events[0])
+        start = time.perf_counter()
+        yield defer.gatherResults([validator(event) for event in events])
+        return len(events) / (time.perf_counter() - start)
+    finally:
+        validator.close()
+
+
+@defer.inlineCallbacks
+def main(reactor, args):
+    events = [VOEventMessage(make_event(args.size * 1024))] * args.events
+    baseline = yield run(0, events, args.max_pending)
+    print("thread        %8.0f events/s" % (baseline,))
+    for processes in args.processes:
+        rate = yield run(processes, events, args.max_pending)
+        print(
+            "%2d processes  %8.0f events/s  (%.2fx)"
+            % (processes, rate, rate / baseline)
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark schema validation.")
+    parser.add_argument(
+        "--processes",
+        type=int,
+        nargs="*",
+        default=[1, 2, 4, os.cpu_count()],
+        help="Worker pool sizes to test [default: 1 2 4 and the number of CPUs].",
+    )
+    parser.add_argument(
+        "--events",
+        type=int,
+        default=2000,
+        help="Events to validate with each pool [default=%(default)s].",
+    )
+    parser.add_argument(
+        "--size",
+        type=int,
+        default=5,
+        help="Size of each event (kilobytes) [default=%(default)s].",
+    )
+    parser.add_argument(
+        "--max-pending",
+        type=int,
+        default=1000,
+        help="Events sent to the pool at once [default=%(default)s].",
+    )
+    task.react(main, [parser.parse_args()])
@@ -19,6 +19,10 @@ class DummyBroadcaster(object):
 class DummyFactory(object):
     broadcasters = [DummyBroadcaster(), DummyBroadcaster()]
 
+    def send_event(self, event):
+        for broadcaster in self.broadcasters:
+            broadcaster.send_event(event)
+
 
 class EventRelayTestCase(unittest.TestCase):
     def test_interface(self):
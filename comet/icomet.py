@@ -42,3 +42,6 @@ class IValidator(Interface):
         If the event validates, we return normally. If the event is invalid,
         raise an exception.
         """
+
+    # Validators may also provide a ``cost`` attribute, which determines the
+    # order in which they are applied: see comet.validator.pipeline.
@@ -64,14 +64,14 @@ class EventWriter(object):
         self.directory = os.getcwd()
 
     # When the handler is called, it is passed an instance of
-    # comet.utility.xml.xml_document.
+    # comet.utility.voevent.VOEventMessage.
     def __call__(self, event):
         """
         Save an event to disk.
         """
         if not os.path.exists(self.directory):
             os.makedirs(self.directory)
-        with event_file(event.element.attrib["ivorn"], self.directory) as f:
+        with event_file(event.ivoid, self.directory) as f:
             log.debug("Writing to %s" % (f.name,))
             f.write(event.raw_bytes.decode(event.encoding))
 
@@ -8,7 +8,7 @@ from twisted.trial import unittest
 from twisted.plugin import IPlugin
 
 from comet.icomet import IHandler, IHasOptions
-from comet.utility import xml_document
+from comet.utility import VOEventMessage
 from comet.testutils import DUMMY_VOEVENT
 from comet.plugins.eventwriter import EventWriter
 from comet.plugins.eventwriter import string_to_filename
@@ -62,7 +62,7 @@ class EventFileTestCase(unittest.TestCase):
 
 class EventWriterTestCase(unittest.TestCase):
     def setUp(self):
-        self.event = xml_document(DUMMY_VOEVENT)
+        self.event = VOEventMessage(DUMMY_VOEVENT)
         self.event_writer = EventWriter()
 
     def test_interface(self):
@@ -1,13 +1,76 @@
 # Comet VOEvent Broker.
 # Basic protocol building-blocks.
 
+# Python standard library
+import struct
+import tempfile
+
 # Twisted protocol definition
-from twisted.internet import defer
-from twisted.protocols.basic import Int32StringReceiver
+from twisted.internet import defer, reactor
+from twisted.internet.threads import deferToThreadPool
+from twisted.protocols.basic import Int32StringReceiver, StringTooLongError
+from twisted.python.threadpool import ThreadPool
 
 # Comet
 import comet.log as log
 from comet.protocol.messages import TransportMessage
+from comet.utility import IncrementalParser, ParseError, xml_document
+from comet.utility.xml import MAX_SIZE
+from comet.validator import ValidationPipeline
+
+# Large payloads are parsed by a pool of up to PARSE_THREADS threads, which is
+# shared by all connections and created when first required.
+PARSE_THREADS = 4
+_parse_pool = None
+
+
+def _get_parse_pool():
+    global _parse_pool
+    if _parse_pool is None:
+        _parse_pool = ThreadPool(0, PARSE_THREADS, "comet-parse")
+        _parse_pool.start()
+        reactor.addSystemEventTrigger("during", "shutdown", _parse_pool.stop)
+    return _parse_pool
+
+
+class _IncomingFrame(object):
+    """
+    A large frame which is collected, and optionally parsed, as it arrives.
+
+    If ``parse`` is set, the frame is parsed as it arrives, and up to
+    ``spool_size`` bytes of it are held in memory; beyond that, it is spooled
+    to a temporary file. Otherwise, ``parser`` is None, and the pieces of the
+    frame are held in memory until it is complete.
+    """
+
+    def __init__(self, length, spool_size, parse=True):
+        self.remaining = length
+        if parse:
+            self.parser = IncrementalParser()
+            self.spool = tempfile.SpooledTemporaryFile(spool_size)
+        else:
+            self.parser = None
+            self.chunks = []
+
+    def feed(self, data):
+        """
+        Consume ``data``, which is no more than the ``remaining`` part of the
+        frame.
+        """
+        self.remaining -= len(data)
+        if self.parser is None:
+            self.chunks.append(data)
+        else:
+            self.spool.write(data)
+            self.parser.feed(data)
+
+    def payload(self):
+        """Return the complete payload of the frame."""
+        if self.parser is None:
+            return b"".join(self.chunks)
+        self.spool.seek(0)
+        with self.spool:
+            return self.spool.read()
 
 
 class ElementSender(Int32StringReceiver):
@@ -22,6 +85,28 @@ class ElementSender(Int32StringReceiver):
         """
         self.sendString(document.raw_bytes)
 
+    @classmethod
+    def frame(cls, data):
+        """
+        Return ``data`` prefixed with its length, as it would be sent by
+        ``sendString``.
+
+        A frame may be prepared once, then sent to many peers with
+        `send_frame`.
+        """
+        if len(data) >= 2 ** (8 * cls.prefixLength):
+            raise StringTooLongError(
+                "Try to send %s bytes whereas maximum is %s"
+                % (len(data), 2 ** (8 * cls.prefixLength))
+            )
+        return struct.pack(cls.structFormat, len(data)) + data
+
+    def send_frame(self, frame):
+        """
+        Send a frame prepared by `frame`.
+        """
+        self.transport.write(frame)
+
     def lengthLimitExceeded(self, length):
         """
         This is called when a remote tries to send a massive string.
@@ -39,20 +124,134 @@ class EventHandler(ElementSender):
     Receiver) providing event handling support.
     """
 
+    # Payloads of at least PARSE_THRESHOLD bytes are parsed so that they
+    # don't hold up the reactor: by default, in a thread once they are
+    # complete; if STREAM_FRAMES is set, on the reactor as they arrive, in
+    # which case up to SPOOL_SIZE bytes of each are held in memory.
+    PARSE_THRESHOLD = 256 * 1024
+    STREAM_FRAMES = False
+    SPOOL_SIZE = 128 * 1024
+
+    # Refuse frames larger than the largest document we are prepared to parse.
+    MAX_LENGTH = MAX_SIZE
+
+    # Fires when all messages received so far have been parsed and delivered.
+    _parsing = None
+
+    # Data received which has not yet been split into frames.
+    _buffer = b""
+
+    # The large frame which is arriving, if any, and the payload and parser of
+    # the most recently completed one which was parsed as it arrived.
+    _frame = None
+    _streamed = None
+
+    def dataReceived(self, data):
+        """
+        Split incoming data into frames, calling stringReceived with each.
+
+        This replaces the framing provided by `Int32StringReceiver`, so that
+        large frames can be collected, and optionally parsed, as they arrive,
+        rather than being repeatedly copied into a buffer until they are
+        complete.
+        """
+        buffer = self._buffer + data
+        offset = 0
+        while not self.paused:
+            if self._frame is not None:
+                stop = offset + self._frame.remaining
+                chunk = buffer[offset:stop]
+                offset += len(chunk)
+                self._frame.feed(chunk)
+                if self._frame.remaining:
+                    break
+                frame, self._frame = self._frame, None
+                payload = frame.payload()
+                if frame.parser is not None:
+                    self._streamed = (payload, frame.parser)
+                self.stringReceived(payload)
+                continue
+            start = offset + self.prefixLength
+            if len(buffer) < start:
+                break
+            (length,) = struct.unpack(self.structFormat, buffer[offset:start])
+            if length > self.MAX_LENGTH:
+                self._buffer = buffer[offset:]
+                self.lengthLimitExceeded(length)
+                return
+            if length >= self.PARSE_THRESHOLD:
+                offset = start
+                self._frame = _IncomingFrame(
+                    length, self.SPOOL_SIZE, parse=self.STREAM_FRAMES
+                )
+                continue
+            end = start + length
+            if len(buffer) < end:
+                break
+            offset = end
+            self.stringReceived(buffer[start:end])
+        self._buffer = buffer[offset:]
+
+    def parse_message(self, data):
+        """
+        Parse the incoming message ``data``.
+
+        Return a Deferred which fires with the appropriate `xml_document`
+        subclass, or fails with `ParseError`. Small payloads are parsed (as
+        lazily as possible) immediately, unless an earlier message is still
+        being parsed; large ones are parsed in full in a thread, unless they
+        were parsed as they arrived. Either way, the Deferreds returned by
+        successive calls fire in the order in which the messages were
+        received.
+
+        If the factory has a ``schema``, messages which were not parsed as
+        they arrived are instead all parsed in a thread, and VOEvents are
+        validated against the schema at the same time.
+        """
+        schema = getattr(self.factory, "schema", None)
+        result = defer.Deferred()
+        streamed, self._streamed = self._streamed, None
+
+        def infer_streamed(parser):
+            return xml_document.infer_type(data, element=parser.close())
+
+        def parse(ignored):
+            if streamed is not None and streamed[0] is data:
+                d = defer.maybeDeferred(infer_streamed, streamed[1])
+            elif schema is not None:
+                d = deferToThreadPool(
+                    reactor,
+                    _get_parse_pool(),
+                    xml_document.infer_type,
+                    data,
+                    schema=schema,
+                )
+            elif len(data) < self.PARSE_THRESHOLD:
+                d = defer.maybeDeferred(xml_document.infer_type, data, lazy=True)
+            else:
+                d = deferToThreadPool(
+                    reactor, _get_parse_pool(), xml_document.infer_type, data
+                )
+            # The next message is parsed once this one has been delivered.
+            return d.chainDeferred(result)
+
+        if self._parsing is None:
+            self._parsing = defer.succeed(None)
+        self._parsing.addCallback(parse)
+        return result
+
     def validate_event(self, event):
         """
         Call a set of event validators on a given event (an xml_document).
 
         If a validator raises an exception (ie, calls an errback), the event
-        is invalid. Otherwise, it's ok.
+        is invalid. Otherwise, it's ok. Validators are applied in order of
+        cost, stopping at the first failure (see `ValidationPipeline`).
         """
-        return defer.gatherResults(
-            [
-                defer.maybeDeferred(validator, event)
-                for validator in self.factory.validators
-            ],
-            consumeErrors=True,
-        )
+        validators = self.factory.validators
+        if not isinstance(validators, ValidationPipeline):
+            validators = ValidationPipeline(validators)
+        return validators(event)
 
     def handle_event(self, event):
         """
@@ -78,38 +277,35 @@ class EventHandler(ElementSender):
         """
 
         def handle_valid(status):
+            # Events may have been parsed lazily; make sure the whole event is
+            # well formed before accepting it.
+            try:
+                event.element
+            except ParseError as e:
+                return reject(str(e))
             log.debug("Event accepted; sending ACK to %s" % (self.transport.getPeer()))
-            self.send_xml(
-                TransportMessage.ack(
-                    self.factory.local_ivo, event.element.attrib["ivorn"]
-                )
-            )
+            self.send_xml(TransportMessage.ack(self.factory.local_ivo, event.ivoid))
             self.handle_event(event).addCallbacks(
                 lambda x: log.debug("Event processed"),
                 lambda x: log.warn("Event handlers failed"),
             )
 
         def handle_invalid(failure):
-            log.info(
-                "Event rejected (%s); discarding"
-                % (failure.value.subFailure.getErrorMessage(),)
-            )
+            reject(failure.value.subFailure.getErrorMessage())
+
+        def reject(reason):
+            log.info("Event rejected (%s); discarding" % (reason,))
             if can_nak:
                 log.debug("Sending NAK to %s" % (self.transport.getPeer()))
                 self.send_xml(
                     TransportMessage.nak(
                         self.factory.local_ivo,
-                        event.element.attrib["ivorn"],
-                        "Event rejected: %s"
-                        % (failure.value.subFailure.getErrorMessage(),),
+                        event.ivoid,
+                        "Event rejected: %s" % (reason,),
                     )
                 )
             else:
                 log.debug("Sending ACK to %s" % (self.transport.getPeer()))
-                self.send_xml(
-                    TransportMessage.ack(
-                        self.factory.local_ivo, event.element.attrib["ivorn"]
-                    )
-                )
+                self.send_xml(TransportMessage.ack(self.factory.local_ivo, event.ivoid))
 
         return self.validate_event(event).addCallbacks(handle_valid, handle_invalid)
@@ -16,6 +16,7 @@ from twisted.internet.protocol import ServerFactory
 
 # Base protocol definitions
 from comet.protocol.base import ElementSender
+from comet.protocol.filters import FilterIndex
 
 # Constructors for transport protocol messages
 from comet.protocol.messages import TransportMessage
@@ -27,6 +28,23 @@ from comet.utility import ParseError, VOEventMessage
 __all__ = ["VOEventBroadcasterFactory"]
 
 
+def _match_filters(element, index, subscriptions):
+    """
+    Match ``element`` against the filters in ``index`` (a `FilterIndex`),
+    and return a bitmap of the subscriptions which match.
+
+    ``subscriptions`` is a sequence of sequences of positions in ``index``.
+    Bit ``n`` of the result is set if subscription ``n`` is empty, or if any
+    of the filters it refers to match.
+    """
+    matched = index.match(element)
+    bits = [
+        "1" if not indices or not matched.isdisjoint(indices) else "0"
+        for indices in reversed(subscriptions)
+    ]
+    return int("".join(bits) or "0", 2)
+
+
 class VOEventBroadcaster(ElementSender):
     MAX_ALIVE_COUNT = 1  # Drop connection if peer misses too many iamalives
     MAX_OUTSTANDING_ACK = 10  # Drop connection if peer misses too many acks
@@ -44,6 +62,7 @@ class VOEventBroadcaster(ElementSender):
     def connectionLost(self, *args):
         log.info("Subscriber at %s disconnected" % str(self.transport.getPeer()))
         self.factory.broadcasters.remove(self)
+        self._release_filters()
         return ElementSender.connectionLost(self, *args)
 
     def sendIAmAlive(self):
@@ -54,12 +73,12 @@ class VOEventBroadcaster(ElementSender):
             log.info("Peer is not acknowledging events; dropping connection")
             self.transport.loseConnection()
         else:
-            self.send_xml(TransportMessage.iamalive(self.factory.local_ivo))
+            self.send_frame(self.factory.iamalive_frame())
             self.alive_count += 1
 
     def stringReceived(self, data):
         try:
-            incoming = TransportMessage(data)
+            incoming = TransportMessage(data, lazy=True)
         except ParseError:
             log.warn("Unparsable message received")
             return
@@ -77,27 +96,27 @@ class VOEventBroadcaster(ElementSender):
             self.transport.loseConnection()
         elif incoming.role == "authenticate":
             log.debug("Authentication received from %s" % str(self.transport.getPeer()))
-            self.filters = []
+            try:
+                element = incoming.element
+            except ParseError:
+                log.warn("Unparsable message received")
+                return
+            self._release_filters()
             # Accept both "new-style" (<Param type="xpath-filter" />) and
             # old-style (<filter type="xpath" />) filters.
             for xpath in chain(
                 [
                     elem.get("value")
-                    for elem in incoming.element.findall(
-                        'Meta/Param[@name="xpath-filter"]'
-                    )
-                ],
-                [
-                    elem.text
-                    for elem in incoming.element.findall('Meta/filter[@type="xpath"]')
+                    for elem in element.findall('Meta/Param[@name="xpath-filter"]')
                 ],
+                [elem.text for elem in element.findall('Meta/filter[@type="xpath"]')],
             ):
                 log.info(
                     "Installing filter %s for %s"
                     % (xpath, str(self.transport.getPeer()))
                 )
                 try:
-                    self.filters.append(ElementTree.XPath(xpath))
+                    self.filters.append(self.factory.install_filter(xpath))
                 except ElementTree.XPathSyntaxError:
                     log.info("Filter %s is not valid XPath" % (xpath,))
         else:
@@ -106,28 +125,30 @@ class VOEventBroadcaster(ElementSender):
                 % (self.transport.getPeer(), incoming.role)
             )
 
+    def _release_filters(self):
+        for xpath in self.filters:
+            self.factory.release_filter(xpath)
+        self.filters = []
+
     def send_event(self, event):
         # Check the event against our filters and, if one or more pass, then
         # we send the event to our subscriber.
-        def check_filters(result):
-            if not self.filters or any([value for success, value in result if success]):
-                log.info(
-                    "Event matches filter criteria: forwarding to %s"
-                    % (str(self.transport.getPeer()),)
-                )
-                self.send_xml(event)
-                self.outstanding_ack += 1
-            else:
-                log.info("Event rejected by filter")
+        return self.factory.send_event(event, [self])
 
-        return defer.DeferredList(
-            [deferToThread(xpath, event.element) for xpath in self.filters],
-            consumeErrors=True,
-        ).addCallback(check_filters)
+    def deliver_event(self, event):
+        log.info(
+            "Event matches filter criteria: forwarding to %s"
+            % (str(self.transport.getPeer()),)
+        )
+        self.send_xml(event)
+        self.outstanding_ack += 1
 
 
 class VOEventBroadcasterFactory(ServerFactory):
     IAMALIVE_INTERVAL = 60  # Sent iamalive every IAMALIVE_INTERVAL seconds
+    IAMALIVE_BATCH = 100  # Send iamalive to this many subscribers at a time...
+    IAMALIVE_SPREAD = 0.5  # ...spread over this fraction of IAMALIVE_INTERVAL
+    INLINE_FILTER_COST = 64 * 1024  # Max filters x event bytes to check inline
     protocol = VOEventBroadcaster
 
     def __init__(self, local_ivo, test_interval):
@@ -136,7 +157,13 @@ class VOEventBroadcasterFactory(ServerFactory):
         self.local_ivo = local_ivo
         self.test_interval = test_interval
         self.broadcasters = []
+        # Filters installed by subscribers, indexed by expression, together
+        # with the number of subscribers using each.
+        self.filters = {}
+        self._filter_index = FilterIndex([])
         self.alive_loop = LoopingCall(self.sendIAmAlive)
+        self._alive_frame = None
+        self._alive_calls = []
         self.test_loop = LoopingCall(self.sendTestEvent)
 
     def startFactory(self):
@@ -147,17 +174,138 @@ class VOEventBroadcasterFactory(ServerFactory):
 
     def stopFactory(self):
         self.alive_loop.stop()
+        for call in self._alive_calls:
+            if call.active():
+                call.cancel()
+        self._alive_calls = []
         if self.test_loop.running:
             self.test_loop.stop()
         return ServerFactory.stopFactory(self)
 
+    def iamalive_frame(self):
+        """
+        Return a length-prefixed iamalive message, ready to be sent to a
+        subscriber.
+
+        The message is generated at most once per tick of ``alive_loop``, and
+        shared by all subscribers.
+        """
+        if self._alive_frame is None:
+            self._alive_frame = self.protocol.frame(
+                TransportMessage.iamalive(self.local_ivo).raw_bytes
+            )
+        return self._alive_frame
+
     def sendIAmAlive(self):
+        """
+        Send iamalive messages to all subscribers.
+
+        Subscribers are handled IAMALIVE_BATCH at a time. The first batch is
+        handled immediately; the others are spread over IAMALIVE_SPREAD of
+        IAMALIVE_INTERVAL, so that large numbers of subscribers don't cause a
+        spike in CPU and bandwidth use.
+        """
         log.debug("Broadcasting iamalive")
-        for broadcaster in self.broadcasters:
-            broadcaster.sendIAmAlive()
+        self._alive_frame = None
+        self._alive_calls = [call for call in self._alive_calls if call.active()]
+        broadcasters = list(self.broadcasters)
+        batches = []
+        for start in range(0, len(broadcasters), self.IAMALIVE_BATCH):
+            stop = start + self.IAMALIVE_BATCH
+            batches.append(broadcasters[start:stop])
+        if not batches:
+            return
+        self._send_iamalive_batch(batches[0])
+        step = self.IAMALIVE_INTERVAL * self.IAMALIVE_SPREAD / len(batches)
+        for count, batch in enumerate(batches[1:], 1):
+            self._alive_calls.append(
+                self.alive_loop.clock.callLater(
+                    count * step, self._send_iamalive_batch, batch
+                )
+            )
+
+    def _send_iamalive_batch(self, batch):
+        # Skip subscribers which have disconnected since the batch was made.
+        connected = set(self.broadcasters)
+        for broadcaster in batch:
+            if broadcaster in connected:
+                broadcaster.sendIAmAlive()
+
+    def install_filter(self, expression):
+        """
+        Return a compiled XPath filter for ``expression``.
+
+        Subscribers which request the same expression share a single filter.
+        Raises `~lxml.etree.XPathSyntaxError` if ``expression`` is invalid.
+        """
+        if expression not in self.filters:
+            self.filters[expression] = [ElementTree.XPath(expression), 0]
+        entry = self.filters[expression]
+        entry[1] += 1
+        return entry[0]
+
+    def release_filter(self, xpath):
+        """Note that a subscriber is no longer using the filter ``xpath``."""
+        entry = self.filters.get(xpath.path)
+        if entry is not None and entry[0] is xpath:
+            entry[1] -= 1
+            if not entry[1]:
+                del self.filters[xpath.path]
+
+    def send_event(self, event, broadcasters=None):
+        """
+        Send ``event`` to those ``broadcasters`` (by default, all of them)
+        whose subscribers either have no filters, or have at least one filter
+        which matches the event.
+
+        Each distinct filter expression is evaluated only once, however many
+        subscribers use it. Common forms of filter are matched using an index
+        (see `~comet.protocol.filters.FilterIndex`); the rest are evaluated as
+        XPath. All the filters are evaluated together: in the reactor thread
+        if they are all indexed and the cost of the index multiplied by the
+        size of the event is no more than INLINE_FILTER_COST, or in a single
+        worker thread otherwise. Filters evaluated as XPath may be arbitrarily
+        expensive, so never hold up the reactor.
+
+        The index built for all the broadcasters is kept until the filters
+        they use change; that for an explicit set of ``broadcasters`` is
+        discarded after use.
+        """
+        shared = broadcasters is None
+        if shared:
+            broadcasters = list(self.broadcasters)
+        positions = {}
+        xpaths = []
+        subscriptions = []
+        for broadcaster in broadcasters:
+            indices = []
+            for xpath in broadcaster.filters:
+                if xpath.path not in positions:
+                    positions[xpath.path] = len(xpaths)
+                    xpaths.append(xpath)
+                indices.append(positions[xpath.path])
+            subscriptions.append(indices)
+        if not shared:
+            index = FilterIndex(xpaths)
+        else:
+            # The index is rebuilt only when the filters in use change.
+            if self._filter_index.paths != tuple(positions):
+                self._filter_index = FilterIndex(xpaths)
+            index = self._filter_index
+
+        def deliver(recipients):
+            for position, broadcaster in enumerate(broadcasters):
+                if recipients >> position & 1:
+                    broadcaster.deliver_event(event)
+                else:
+                    log.info("Event rejected by filter")
+
+        if not index.fallback and index.cost * event.size <= self.INLINE_FILTER_COST:
+            d = defer.maybeDeferred(_match_filters, event.element, index, subscriptions)
+        else:
+            d = deferToThread(_match_filters, event.element, index, subscriptions)
+        return d.addCallback(deliver)
 
     def sendTestEvent(self):
         log.debug("Broadcasting test event")
-        test_event = VOEventMessage.broker_test(self.local_ivo)
-        for broadcaster in self.broadcasters:
-            broadcaster.send_event(test_event)
+        self.send_event(VOEventMessage.broker_test(self.local_ivo))
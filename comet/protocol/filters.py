@@ -0,0 +1,238 @@
+# Comet VOEvent Broker.
+# Index subscriber filters for fast matching.
+
+import re
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+
+import lxml.etree as ElementTree
+
+__all__ = ["FilterIndex", "compile_filter"]
+
+# Numbers are converted by libxml2, exactly as they would be when evaluating
+# the filter as XPath.
+_NUMBER = ElementTree.XPath("number($value)")
+
+_STRING = r"""(?:"(?P<{0}dq>[^"]*)"|'(?P<{0}sq>[^']*)')"""
+_LITERAL = r"(?P<number>-?(?:\d+(?:\.\d*)?|\.\d+))"
+_OPERATOR = r"(?P<op><=|>=|<|>|=)"
+
+# The common forms of filter which can be indexed. Each produces a field,
+# which is extracted from each event, and a condition on its value.
+_SHAPES = [
+    (
+        "role",
+        re.compile(r"\s*//@role\s*=\s*%s\s*" % _STRING.format("value")),
+    ),
+    (
+        "voevent-role",
+        re.compile(
+            r"\s*/\*\[\s*local-name\(\)\s*=\s*(?:\"VOEvent\"|'VOEvent')\s+and\s+"
+            r"@role\s*=\s*%s\s*\]\s*" % _STRING.format("value")
+        ),
+    ),
+    (
+        "ivorn",
+        re.compile(
+            r"\s*starts-with\(\s*(?P<path>/\*/@ivorn|//@ivorn)\s*,\s*%s\s*\)\s*"
+            % _STRING.format("value")
+        ),
+    ),
+    (
+        "param",
+        re.compile(
+            r"\s*//Param\[\s*@name\s*=\s*%s\s+and\s+@value\s*%s\s*%s\s*\]\s*"
+            % (_STRING.format("name"), _OPERATOR, _LITERAL)
+        ),
+    ),
+    (
+        "param",
+        re.compile(
+            r"\s*//Param\[\s*@name\s*=\s*%s\s*\]/@value\s*%s\s*%s\s*"
+            % (_STRING.format("name"), _OPERATOR, _LITERAL)
+        ),
+    ),
+]
+
+# A filter which can be indexed: an event matches if ``field`` (a tuple
+# naming what to extract from the event) satisfies ``operator`` with
+# respect to ``value``.
+FilterShape = namedtuple("FilterShape", ["field", "operator", "value"])
+
+
+def _group(match, name):
+    """Return the string captured by a _STRING pattern called ``name``."""
+    value = match.group(name + "dq")
+    return value if value is not None else match.group(name + "sq")
+
+
+def compile_filter(expression):
+    """
+    Recognize a filter ``expression`` which can be indexed.
+
+    Return a `FilterShape`, or None if ``expression`` does not take one of
+    the forms which are understood and must be evaluated as XPath. These
+    forms are:
+
+    - ``//@role="observation"``;
+    - ``/*[local-name()="VOEvent" and @role="observation"]``;
+    - ``starts-with(//@ivorn, "ivo://example/")`` (or ``/*/@ivorn``);
+    - ``//Param[@name="X" and @value > 10]`` and ``//Param[@name="X"]/@value
+      > 10``, with any of ``<``, ``<=``, ``=``, ``>=`` or ``>``.
+    """
+    for kind, pattern in _SHAPES:
+        match = pattern.fullmatch(expression)
+        if match is None:
+            continue
+        if kind == "param":
+            threshold = _NUMBER(ElementTree.Element("filter"), value=match["number"])
+            return FilterShape((kind, _group(match, "name")), match["op"], threshold)
+        elif kind == "ivorn":
+            return FilterShape(
+                (kind, match["path"]), "starts-with", _group(match, "value")
+            )
+        else:
+            return FilterShape((kind,), "=", _group(match, "value"))
+    return None
+
+
+def _extract(element, field):
+    """
+    Return the values of ``field`` in the event represented by ``element``.
+    """
+    kind = field[0]
+    if kind == "role":
+        return set(element.xpath("//@role"))
+    elif kind == "voevent-role":
+        root = element.getroottree().getroot()
+        if ElementTree.QName(root).localname == "VOEvent":
+            return {root.get("role")}
+        return set()
+    elif kind == "ivorn":
+        return [element.xpath("string(%s)" % (field[1],))]
+
+
+def _extract_params(element, names):
+    """
+    Return the numeric values of all Params in ``element`` with ``names``.
+    """
+    values = {name: [] for name in names}
+    for param in element.xpath("//Param"):
+        name = param.get("name")
+        if name in values and param.get("value") is not None:
+            values[name].append(_NUMBER(element, value=param.get("value")))
+    return values
+
+
+class _RangeIndex(object):
+    """Filters comparing a number to thresholds, indexed by threshold."""
+
+    def __init__(self):
+        self.entries = []
+
+    def add(self, threshold, position):
+        self.entries.append((threshold, position))
+
+    def freeze(self):
+        self.entries.sort(key=lambda entry: entry[0])
+        self.thresholds = [threshold for threshold, position in self.entries]
+        self.positions = [position for threshold, position in self.entries]
+
+    def match(self, operator, value):
+        # Comparisons with NaN are always false.
+        if value != value:
+            return []
+        start = bisect_left(self.thresholds, value)
+        stop = bisect_right(self.thresholds, value)
+        if operator == ">":
+            return self.positions[:start]
+        elif operator == ">=":
+            return self.positions[:stop]
+        elif operator == "<":
+            return self.positions[stop:]
+        elif operator == "<=":
+            return self.positions[start:]
+        else:
+            return self.positions[start:stop]
+
+
+class FilterIndex(object):
+    """
+    Match events against a sequence of ``filters`` (compiled XPath
+    expressions).
+
+    Filters which `compile_filter` recognizes are held in hash or range
+    indexes over fields which are extracted once from each event, so that
+    the cost of matching them depends on the number of matches rather than
+    the number of filters. Others are evaluated as XPath.
+    """
+
+    def __init__(self, filters):
+        self.paths = tuple(getattr(xpath, "path", None) for xpath in filters)
+        self.equal = {}
+        self.prefixes = {}
+        self.ranges = {}
+        self.fallback = []
+        for position, xpath in enumerate(filters):
+            shape = (
+                compile_filter(self.paths[position]) if self.paths[position] else None
+            )
+            if shape is None:
+                self.fallback.append((position, xpath))
+            elif shape.operator == "starts-with":
+                prefixes = self.prefixes.setdefault(shape.field, {})
+                prefixes.setdefault(shape.value, []).append(position)
+            elif shape.field[0] == "param":
+                ranges = self.ranges.setdefault(shape.field[1], {})
+                ranges.setdefault(shape.operator, _RangeIndex()).add(
+                    shape.value, position
+                )
+            else:
+                values = self.equal.setdefault(shape.field, {})
+                values.setdefault(shape.value, []).append(position)
+        for ranges in self.ranges.values():
+            for index in ranges.values():
+                index.freeze()
+        self.prefix_lengths = {
+            field: sorted({len(prefix) for prefix in prefixes})
+            for field, prefixes in self.prefixes.items()
+        }
+
+    @property
+    def cost(self):
+        """The number of passes over each event required to match it."""
+        return (
+            len(self.fallback)
+            + len(self.equal)
+            + len(self.prefixes)
+            + (1 if self.ranges else 0)
+        )
+
+    def match(self, element):
+        """
+        Return the set of positions of the filters which match ``element``.
+        """
+        matched = set()
+        for field, values in self.equal.items():
+            for value in _extract(element, field):
+                matched.update(values.get(value, ()))
+        for field, prefixes in self.prefixes.items():
+            for value in _extract(element, field):
+                for length in self.prefix_lengths[field]:
+                    if length > len(value):
+                        break
+                    matched.update(prefixes.get(value[:length], ()))
+        if self.ranges:
+            params = _extract_params(element, self.ranges)
+            for name, ranges in self.ranges.items():
+                for value in params[name]:
+                    for operator, index in ranges.items():
+                        matched.update(index.match(operator, value))
+        for position, xpath in self.fallback:
+            try:
+                if xpath(element):
+                    matched.add(position)
+            except Exception:
+                # A filter which cannot be evaluated does not match.
+                pass
+        return matched
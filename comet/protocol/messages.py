@@ -2,7 +2,9 @@
 # VOEvent transport protocol messages.
 
 # Python standard library
-from datetime import datetime
+import re
+import time
+from xml.sax.saxutils import escape
 
 # XML parsing using lxml
 import lxml.etree as ElementTree
@@ -15,19 +17,92 @@ ElementTree.register_namespace(
     "trn", "http://www.telescope-networks.org/xml/Transport/v1.1"
 )
 
+# Marks the position of a field in a message template. Since it is a
+# character from the Unicode private use area, it cannot occur in the markup
+# generated around it.
+MARKER = "\ue000"
+
+# Characters which may not appear in an XML document.
+INVALID_XML = re.compile("[^\t\n\r\x20-\ud7ff\ue000-\ufffd\U00010000-\U0010ffff]")
+
+# The most recent timestamp, as (seconds since the epoch, formatted string).
+_timestamp = (None, None)
+
+
+def _utc_timestamp():
+    """
+    Return the current UTC time, formatted for use in a message.
+
+    The string is only regenerated when the time in seconds changes.
+    """
+    global _timestamp
+    now = int(time.time())
+    if _timestamp[0] != now:
+        _timestamp = (now, time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(now)))
+    return _timestamp[1]
+
+
+def _escape(value):
+    """
+    Return ``value`` escaped for use as element text, exactly as lxml would
+    serialize it. None is treated as empty text.
+    """
+    if value is None:
+        return ""
+    if isinstance(value, bytes):
+        # Like lxml, we accept bytes only if they are ASCII.
+        value = value.decode("ascii")
+    if INVALID_XML.search(value):
+        raise ValueError("All strings must be XML compatible")
+    return escape(value).replace("\r", "&#13;")
+
+
+class _Template(object):
+    """
+    A serialized message, split around the fields which vary between
+    messages.
+    """
+
+    def __init__(self, root_element):
+        self.attrib = dict(root_element.attrib)
+        parts = ElementTree.tostring(
+            root_element, xml_declaration=True, encoding="UTF-8", pretty_print=True
+        ).split(MARKER.encode("UTF-8"))
+        self.literals = parts[0::2]
+        self.fields = [name.decode("UTF-8") for name in parts[1::2]]
+
+    def render(self, **values):
+        """Return the message with the given ``values`` substituted."""
+        output = [self.literals[0]]
+        for name, literal in zip(self.fields, self.literals[1:]):
+            output.append(_escape(values[name]).encode("UTF-8"))
+            output.append(literal)
+        return b"".join(output)
+
 
 class TransportMessage(xml_document):
 
     # NB: ordering within packet must be per schema --
     # Origin, Response, Timestamp, Meta.
 
+    # Templates for messages, keyed by role and by whether they contain a
+    # Response and a Result.
+    _templates = {}
+
     @property
     def origin(self):
+        if self._element is None and self._header[1] is not None:
+            return self._header[1]
         return self.element.find("Origin").text
 
     @staticmethod
-    def _root_element():
-        return ElementTree.Element(
+    def _build_element(role, origin, response=None, timestamp=None, result=None):
+        """
+        Return the root element of a message.
+
+        The ``timestamp`` defaults to the current time.
+        """
+        root_element = ElementTree.Element(
             "{http://www.telescope-networks.org/xml/Transport/v1.1}Transport",
             attrib={
                 "version": "1.0",
@@ -36,65 +111,71 @@ class TransportMessage(xml_document):
                 "http://www.telescope-networks.org/schema/Transport-v1.1.xsd",
             },
         )
+        root_element.set("role", role)
+        origin_element = ElementTree.SubElement(root_element, "Origin")
+        origin_element.text = origin
+        if response:
+            response_element = ElementTree.SubElement(root_element, "Response")
+            response_element.text = response
+        timestamp_element = ElementTree.SubElement(root_element, "TimeStamp")
+        timestamp_element.text = timestamp or _utc_timestamp()
+        if result:
+            meta = ElementTree.SubElement(root_element, "Meta")
+            result_element = ElementTree.SubElement(meta, "Result")
+            result_element.text = result
+        return root_element
 
     @classmethod
-    def _origin_response_element(cls, local_ivo, remote_ivo):
-        root_element = cls._root_element()
-        origin = ElementTree.SubElement(root_element, "Origin")
-        origin.text = remote_ivo
-        if local_ivo:
-            response = ElementTree.SubElement(root_element, "Response")
-            response.text = local_ivo
-        timestamp = ElementTree.SubElement(root_element, "TimeStamp")
-        timestamp.text = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
-        return root_element
+    def _from_template(cls, role, origin, response=None, result=None):
+        """
+        Return a message equivalent to ``cls(cls._build_element(...))``, generated
+        from a pre-serialized template rather than by building a tree.
+        """
+        # An Origin with no text is serialized as an empty element, so it
+        # needs a template of its own.
+        key = (role, origin is None, bool(response), bool(result))
+        template = cls._templates.get(key)
+        if template is None:
+            template = _Template(
+                cls._build_element(
+                    role,
+                    None if origin is None else MARKER + "origin" + MARKER,
+                    MARKER + "response" + MARKER if response else None,
+                    MARKER + "timestamp" + MARKER,
+                    MARKER + "result" + MARKER if result else None,
+                )
+            )
+            cls._templates[key] = template
+        raw_bytes = template.render(
+            origin=origin, response=response, timestamp=_utc_timestamp(), result=result
+        )
+        if isinstance(origin, bytes):
+            origin = origin.decode("ascii")
+        return cls.from_parsed(raw_bytes, header=(dict(template.attrib), origin))
 
     @classmethod
     def iamalive(cls, local_ivo):
-        root_element = cls._root_element()
-        root_element.set("role", "iamalive")
-        origin = ElementTree.SubElement(root_element, "Origin")
-        origin.text = local_ivo
-        timestamp = ElementTree.SubElement(root_element, "TimeStamp")
-        timestamp.text = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
-        return cls(root_element)
+        return cls._from_template("iamalive", local_ivo)
 
     @classmethod
     def iamaliveresponse(cls, local_ivo, remote_ivo):
-        root_element = cls._origin_response_element(local_ivo, remote_ivo)
-        root_element.set("role", "iamalive")
-        return cls(root_element)
+        return cls._from_template("iamalive", remote_ivo, local_ivo)
 
     @classmethod
     def ack(cls, local_ivo, remote_ivo):
-        root_element = cls._origin_response_element(local_ivo, remote_ivo)
-        root_element.set("role", "ack")
-        return cls(root_element)
+        return cls._from_template("ack", remote_ivo, local_ivo)
 
     @classmethod
     def nak(cls, local_ivo, remote_ivo, result=None):
-        root_element = cls._origin_response_element(local_ivo, remote_ivo)
-        root_element.set("role", "nak")
-        if result:
-            meta = ElementTree.SubElement(root_element, "Meta")
-            result_element = ElementTree.SubElement(meta, "Result")
-            result_element.text = result
-        return cls(root_element)
+        return cls._from_template("nak", remote_ivo, local_ivo, result)
 
     @classmethod
     def authenticate(cls, local_ivo):
-        root_element = cls._root_element()
-        root_element.set("role", "authenticate")
-        origin = ElementTree.SubElement(root_element, "Origin")
-        origin.text = local_ivo
-        timestamp = ElementTree.SubElement(root_element, "TimeStamp")
-        timestamp.text = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
-        return cls(root_element)
+        return cls._from_template("authenticate", local_ivo)
 
     @classmethod
     def authenticateresponse(cls, local_ivo, remote_ivo, filters):
-        root_element = cls._origin_response_element(local_ivo, remote_ivo)
-        root_element.set("role", "authenticate")
+        root_element = cls._build_element("authenticate", remote_ivo, local_ivo)
         meta = ElementTree.SubElement(root_element, "Meta")
         for my_filter in filters:
             ElementTree.SubElement(
@@ -10,7 +10,7 @@ from comet.protocol.base import EventHandler
 
 # Comet utility routines
 import comet.log as log
-from comet.utility import xml_document, ParseError
+from comet.utility import ParseError
 
 __all__ = ["VOEventReceiverFactory"]
 
@@ -42,13 +42,8 @@ class VOEventReceiver(EventHandler, TimeoutMixin):
         """
         Called when a complete new message is received.
         """
-        try:
-            incoming = xml_document.infer_type(data)
-        except ParseError:
-            d = log.warn(
-                "Unparsable message received from %s" % str(self.transport.getPeer())
-            )
-        else:
+
+        def handle_message(incoming):
             # The root element of both VOEvent and Transport packets has a
             # "role" element which we use to identify the type of message we
             # have received.
@@ -57,20 +52,31 @@ class VOEventReceiver(EventHandler, TimeoutMixin):
                     "VOEvent %s received from %s"
                     % (incoming.ivoid, str(self.transport.getPeer()))
                 )
-                d = self.process_event(incoming)
+                return self.process_event(incoming)
             else:
-                d = log.warn(
+                return log.warn(
                     "Incomprehensible data received from %s (role=%s)"
                     % (self.transport.getPeer(), incoming.role)
                 )
-        finally:
-            return d.addCallback(lambda x: self.transport.loseConnection())
+
+        def handle_unparsable(failure):
+            failure.trap(ParseError)
+            return log.warn(
+                "Unparsable message received from %s" % str(self.transport.getPeer())
+            )
+
+        d = self.parse_message(data)
+        d.addCallbacks(handle_message, handle_unparsable)
+        return d.addCallback(lambda x: self.transport.loseConnection())
 
 
 class VOEventReceiverFactory(ServerFactory):
     protocol = VOEventReceiver
 
-    def __init__(self, local_ivo, validators=None, handlers=None):
+    def __init__(self, local_ivo, validators=None, handlers=None, schema=None):
+        # If schema (an lxml.etree.XMLSchema) is provided, submissions are
+        # validated against it as they are parsed.
         self.local_ivo = local_ivo
         self.validators = validators or []
         self.handlers = handlers or []
+        self.schema = schema
@@ -72,9 +72,12 @@ class VOEventSender(ElementSender):
                     f"ACK received: " f"{self.transport.getPeer()} accepted VOEvent"
                 )
             elif incoming.role == "nak":
-                reason = incoming.element.findtext(
-                    "Meta/Result", default="no reason given"
-                )
+                try:
+                    reason = incoming.element.findtext(
+                        "Meta/Result", default="no reason given"
+                    )
+                except ParseError:
+                    reason = "unparsable response"
                 log.warn(
                     f"NAK received: "
                     f"{self.transport.getPeer()} refused to accept VOEvent "
@@ -83,7 +86,7 @@ class VOEventSender(ElementSender):
             self.transport.loseConnection()
             return incoming
 
-        outgoing_ivoid = event.element.attrib["ivorn"]
+        outgoing_ivoid = event.attrib["ivorn"]
         self.send_xml(event)
         d = Deferred().addCallback(log_response)
         self._sent_ivoids[outgoing_ivoid] = d
@@ -98,7 +101,7 @@ class VOEventSender(ElementSender):
         """
         log.debug("Got response from %s" % str(self.transport.getPeer()))
         try:
-            incoming = xml_document.infer_type(data)
+            incoming = xml_document.infer_type(data, lazy=True)
         except ParseError:
             log.warn(f"Unparsable message received from " f"{self.transport.getPeer()}")
             return
@@ -14,7 +14,7 @@ from comet.protocol.messages import TransportMessage
 
 # Comet utility routines
 import comet.log as log
-from comet.utility import xml_document, ParseError
+from comet.utility import ParseError
 
 __all__ = ["VOEventSubscriberFactory"]
 
@@ -48,12 +48,18 @@ class VOEventSubscriber(EventHandler, TimeoutMixin):
         """
         Called when a complete new message is received.
         """
-        try:
-            incoming = xml_document.infer_type(data)
-        except ParseError:
-            log.warn("Unparsable message received")
-            return
+        self.parse_message(data).addCallbacks(
+            self.messageReceived, self.unparsableReceived
+        )
+
+    def unparsableReceived(self, failure):
+        failure.trap(ParseError)
+        log.warn("Unparsable message received")
 
+    def messageReceived(self, incoming):
+        """
+        Called when a new message has been parsed.
+        """
         # Reset the timeout counter and wait another 120 seconds before
         # disconnecting due to inactivity.
         self.resetTimeout()
@@ -86,7 +92,7 @@ class VOEventSubscriber(EventHandler, TimeoutMixin):
         else:
             log.warn(
                 "Incomprehensible data received from %s (role=%s)"
-                % (self.transport.getPeer(), incoming.element.get("role"))
+                % (self.transport.getPeer(), incoming.role)
             )
 
 
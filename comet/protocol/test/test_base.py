@@ -9,8 +9,9 @@ from twisted.internet import defer
 from twisted.test import proto_helpers
 from twisted.internet.protocol import ServerFactory
 
-from comet.testutils import DummyEvent, DUMMY_EVENT_IVOID
+from comet.testutils import DummyEvent, DUMMY_EVENT_IVOID, DUMMY_IAMALIVE, DUMMY_VOEVENT
 from comet.protocol.base import ElementSender, EventHandler
+from comet.utility import ParseError
 
 
 class ElementSenderFactory(ServerFactory):
@@ -32,6 +33,15 @@ class ElementSenderTestCase(unittest.TestCase):
             struct.pack("!i", len(dummy_element.raw_bytes)) + dummy_element.raw_bytes,
         )
 
+    def test_send_frame(self):
+        # A prepared frame is sent exactly as send_xml would send it.
+        dummy_element = DummyEvent()
+        self.proto.send_frame(ElementSender.frame(dummy_element.raw_bytes))
+        frame = self.tr.value()
+        self.tr.clear()
+        self.proto.send_xml(dummy_element)
+        self.assertEqual(frame, self.tr.value())
+
     def test_lengthLimitExceeded(self):
         self.assertEqual(self.tr.disconnecting, False)
         dummy_element = DummyEvent()
@@ -62,6 +72,136 @@ class Fails(object):
         raise Exception(self.has_run)
 
 
+class RecordingEventHandler(EventHandler):
+    def __init__(self):
+        self.received = []
+
+    def stringReceived(self, data):
+        self.received.append(self.parse_message(data))
+
+
+class RecordingEventHandlerFactory(ServerFactory):
+    protocol = RecordingEventHandler
+
+
+class StreamingTestCase(unittest.TestCase):
+    """
+    Large frames are parsed as they arrive.
+    """
+
+    def setUp(self):
+        self.proto = RecordingEventHandlerFactory().buildProtocol(("127.0.0.1", 0))
+        self.proto.makeConnection(proto_helpers.StringTransport())
+        self.proto.PARSE_THRESHOLD = 100
+        self.proto.SPOOL_SIZE = 100
+        self.proto.STREAM_FRAMES = True
+
+    def _send(self, data, size=50):
+        for start in range(0, len(data), size):
+            stop = start + size
+            self.proto.dataReceived(data[start:stop])
+
+    def test_streamed(self):
+        self._send(ElementSender.frame(DUMMY_VOEVENT)[:-1])
+        self.assertEqual(self.proto.received, [])
+        self.assertEqual(self.proto._buffer, b"")
+        self.assertTrue(self.proto._frame.spool._rolled)
+        self.proto.dataReceived(DUMMY_VOEVENT[-1:])
+        [d] = self.proto.received
+        self.assertTrue(d.called)
+
+        def check(event):
+            self.assertEqual(event.raw_bytes, DUMMY_VOEVENT)
+            # The tree was built as the frame arrived.
+            self.assertIsNotNone(event._element)
+
+        return d.addCallback(check)
+
+    def test_malformed(self):
+        self._send(ElementSender.frame(DUMMY_VOEVENT.replace(b"</Who>", b"")))
+        [d] = self.proto.received
+        return self.assertFailure(d, ParseError)
+
+    def test_mixed(self):
+        # Small frames on either side of a streamed one are unaffected.
+        self._send(
+            ElementSender.frame(DUMMY_IAMALIVE[:99])
+            + ElementSender.frame(DUMMY_VOEVENT)
+            + ElementSender.frame(DUMMY_IAMALIVE),
+            size=7,
+        )
+        self.assertEqual(len(self.proto.received), 3)
+        bad = self.assertFailure(self.proto.received[0], ParseError)
+        good = defer.gatherResults(self.proto.received[1:])
+        good.addCallback(
+            lambda events: self.assertEqual(
+                [event.raw_bytes for event in events], [DUMMY_VOEVENT, DUMMY_IAMALIVE]
+            )
+        )
+        return defer.gatherResults([bad, good])
+
+    def test_small_frames(self):
+        # Small frames are delivered whole, however they arrive.
+        self.proto.PARSE_THRESHOLD = len(DUMMY_IAMALIVE) + 1
+        frame = ElementSender.frame(DUMMY_IAMALIVE)
+        self._send(frame * 3 + frame[:10], size=7)
+        self.assertEqual(len(self.proto.received), 3)
+        self.assertEqual(self.proto._buffer, frame[:10])
+        self.proto.dataReceived(frame[10:])
+        self.assertEqual(len(self.proto.received), 4)
+        self.assertEqual(self.proto._buffer, b"")
+
+    def test_paused(self):
+        # No frames are delivered while the protocol is paused.
+        self.proto.pauseProducing()
+        self._send(
+            ElementSender.frame(DUMMY_IAMALIVE) + ElementSender.frame(DUMMY_VOEVENT)
+        )
+        self.assertEqual(self.proto.received, [])
+        self.proto.resumeProducing()
+        self.assertEqual(len(self.proto.received), 2)
+
+    def test_too_long(self):
+        # Frames which are too long to parse are refused outright.
+        self.proto.MAX_LENGTH = len(DUMMY_VOEVENT) - 1
+        self._send(ElementSender.frame(DUMMY_VOEVENT))
+        self.assertEqual(self.proto.received, [])
+        self.assertTrue(self.proto.transport.disconnecting)
+
+
+class LargeFrameTestCase(unittest.TestCase):
+    """
+    By default, large frames are collected as they arrive, then parsed in a
+    thread.
+    """
+
+    def setUp(self):
+        self.proto = RecordingEventHandlerFactory().buildProtocol(("127.0.0.1", 0))
+        self.proto.makeConnection(proto_helpers.StringTransport())
+        padding = b"<!--" + b" " * EventHandler.PARSE_THRESHOLD + b"-->"
+        self.event = DUMMY_VOEVENT.replace(
+            b"</voe:VOEvent>", padding + b"</voe:VOEvent>"
+        )
+
+    def test_large_frame(self):
+        frame = ElementSender.frame(self.event)
+        for start in range(0, len(frame), 65536):
+            if start:
+                # The frame is held in memory, rather than spooled.
+                self.assertIsNone(self.proto._frame.parser)
+                self.assertFalse(hasattr(self.proto._frame, "spool"))
+            stop = start + 65536
+            self.proto.dataReceived(frame[start:stop])
+        [d] = self.proto.received
+        self.assertFalse(d.called)
+
+        def check(event):
+            self.assertEqual(event.raw_bytes, self.event)
+            self.assertIsNotNone(event._element)
+
+        return d.addCallback(check)
+
+
 class EventHandlerTestCase(unittest.TestCase):
     def setUp(self):
         factory = EventHandlerFactory()
@@ -69,6 +209,44 @@ class EventHandlerTestCase(unittest.TestCase):
         self.tr = proto_helpers.StringTransport()
         self.proto.makeConnection(self.tr)
 
+    def test_parse_message_inline(self):
+        # Small messages are parsed immediately.
+        d = self.proto.parse_message(DUMMY_VOEVENT)
+        self.assertTrue(d.called)
+        d.addCallback(lambda event: self.assertEqual(event.raw_bytes, DUMMY_VOEVENT))
+        return d
+
+    def test_parse_message_threaded(self):
+        # Large messages are parsed in full in a thread.
+        self.proto.PARSE_THRESHOLD = 0
+        d = self.proto.parse_message(DUMMY_VOEVENT)
+        self.assertFalse(d.called)
+        d.addCallback(lambda event: self.assertIsNotNone(event._element))
+        return d
+
+    def test_parse_message_unparsable(self):
+        self.proto.PARSE_THRESHOLD = 0
+        return self.assertFailure(self.proto.parse_message(b"<xml"), ParseError)
+
+    def test_parse_message_order(self):
+        # Messages are delivered in the order in which they were received,
+        # even if a small message follows a large one.
+        self.proto.PARSE_THRESHOLD = len(DUMMY_VOEVENT)
+        received = []
+        first = self.proto.parse_message(DUMMY_VOEVENT)
+        first.addCallback(received.append)
+        second = self.proto.parse_message(DUMMY_IAMALIVE)
+        second.addCallback(received.append)
+        self.assertFalse(second.called)
+
+        def check(result):
+            self.assertEqual(
+                [message.raw_bytes for message in received],
+                [DUMMY_VOEVENT, DUMMY_IAMALIVE],
+            )
+
+        return defer.gatherResults([first, second]).addCallback(check)
+
     def test_validate_event_valid(self):
         self.proto.factory.validators = [Succeeds()]
         d = self.proto.validate_event(True)
@@ -0,0 +1,110 @@
+# Comet VOEvent Broker.
+# Tests for indexed subscriber filters.
+
+import lxml.etree as etree
+
+from twisted.trial import unittest
+
+from comet.testutils import DUMMY_VOEVENT
+from comet.protocol.filters import FilterIndex, compile_filter
+
+WHAT = b"""<What>
+    <Param name="SC_Lat" value="%s"/>
+    <Param name="SC_Lat" value="-20"/>
+    <Param name="Sun_Distance" value="1.5e-1"/>
+    <Param name="No_Value"/>
+    </What>"""
+
+# Filters covering each indexed form, together with some which are not
+# indexed, and their expected results for an event with role "test" and
+# SC_Lat Params of 600 and -20.
+FILTERS = [
+    ('//@role="test"', True),
+    ("//@role = 'observation'", False),
+    ('/*[local-name()="VOEvent" and @role="test"]', True),
+    ("/*[local-name()='VOEvent' and @role='observation']", False),
+    ('starts-with(//@ivorn, "ivo://comet.broker/")', True),
+    ('starts-with(/*/@ivorn, "ivo://comet.broker/test#1")', True),
+    ('starts-with(//@ivorn, "")', True),
+    ('starts-with(//@ivorn, "ivo://other/")', False),
+    ('//Param[@name="SC_Lat" and @value<600]', True),
+    ('//Param[@name="SC_Lat" and @value<-20]', False),
+    ('//Param[@name="SC_Lat" and @value <= -20]', True),
+    ('//Param[@name="SC_Lat" and @value>600]', False),
+    ('//Param[@name="SC_Lat" and @value >= 600]', True),
+    ('//Param[@name="SC_Lat" and @value=600]', True),
+    ('//Param[@name="SC_Lat"]/@value > 599.5', True),
+    ('//Param[@name="Sun_Distance"]/@value > .15', True),
+    ('//Param[@name="Sun_Distance"]/@value = 0.15', False),
+    ('//Param[@name="No_Value"]/@value > -1', False),
+    ('//Param[@name="Missing" and @value > -1]', False),
+    ('//Param[@name="SC_Lat" and @value!=600]', True),
+    ("//Who/AuthorIVORN", True),
+]
+
+
+def make_event(sc_lat=b"600"):
+    what = WHAT % (sc_lat,)
+    return etree.fromstring(
+        DUMMY_VOEVENT.replace(b"</voe:VOEvent>", what + b"</voe:VOEvent>")
+    )
+
+
+class CompileFilterTestCase(unittest.TestCase):
+    def test_shapes(self):
+        shape = compile_filter('//@role="observation"')
+        self.assertEqual(shape.field, ("role",))
+        self.assertEqual(shape.value, "observation")
+        shape = compile_filter("starts-with(/*/@ivorn, 'ivo://example/')")
+        self.assertEqual(shape.field, ("ivorn", "/*/@ivorn"))
+        self.assertEqual(shape.operator, "starts-with")
+        self.assertEqual(shape.value, "ivo://example/")
+        shape = compile_filter('//Param[@name="SC_Lat" and @value<600]')
+        self.assertEqual(shape.field, ("param", "SC_Lat"))
+        self.assertEqual(shape.operator, "<")
+        self.assertEqual(shape.value, 600)
+
+    def test_not_indexed(self):
+        for expression in [
+            "//Who/AuthorIVORN",
+            '//Param[@name="SC_Lat" and @value!=600]',
+            '//Param[@name="SC_Lat" or @value<600]',
+            '//@role="test" or //@role="observation"',
+        ]:
+            self.assertIsNone(compile_filter(expression))
+
+
+class FilterIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.xpaths = [etree.XPath(expression) for expression, result in FILTERS]
+        self.index = FilterIndex(self.xpaths)
+
+    def test_indexed(self):
+        self.assertEqual(len(self.index.fallback), 2)
+
+    def test_match(self):
+        matched = self.index.match(make_event())
+        self.assertEqual(
+            [position in matched for position in range(len(FILTERS))],
+            [result for expression, result in FILTERS],
+        )
+
+    def test_matches_xpath(self):
+        # The index gives the same results as evaluating the filters as
+        # XPath, including for values which are not simple numbers.
+        for value in [b"600", b"599.99", b"6e2", b"+600", b"NaN", b"", b" 600 "]:
+            element = make_event(value)
+            self.assertEqual(
+                self.index.match(element),
+                {
+                    position
+                    for position, xpath in enumerate(self.xpaths)
+                    if xpath(element)
+                },
+            )
+
+    def test_not_voevent(self):
+        element = etree.fromstring(b'<Other role="test"/>')
+        matched = self.index.match(element)
+        self.assertIn(0, matched)
+        self.assertNotIn(2, matched)
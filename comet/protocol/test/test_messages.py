@@ -9,6 +9,7 @@ from twisted.trial import unittest
 
 import comet
 from comet.testutils import DUMMY_SERVICE_IVOID
+import comet.protocol.messages
 from comet.protocol.messages import TransportMessage
 
 
@@ -78,3 +79,125 @@ class TransportTestCase(unittest.TestCase):
         for inp, outp in zip(filters, filter_elems):
             self.assertEqual(inp, outp.get("value"))
         self._check_message(message, "authenticate")
+
+
+class TemplateTestCase(unittest.TestCase):
+    """
+    Messages generated from templates are identical to those built as trees.
+    """
+
+    TIMESTAMP = "2020-01-01T00:00:00Z"
+
+    def setUp(self):
+        self.patch(comet.protocol.messages, "_utc_timestamp", lambda: self.TIMESTAMP)
+
+    def _check_equivalent(self, message, *args, **kwargs):
+        expected = TransportMessage(
+            TransportMessage._build_element(*args, timestamp=self.TIMESTAMP, **kwargs)
+        )
+        self.assertEqual(message.raw_bytes, expected.raw_bytes)
+        self.assertEqual(message.role, expected.role)
+        self.assertEqual(message.origin, expected.origin)
+
+    def test_iamalive(self):
+        self._check_equivalent(
+            TransportMessage.iamalive(DUMMY_SERVICE_IVOID),
+            "iamalive",
+            DUMMY_SERVICE_IVOID,
+        )
+
+    def test_iamaliveresponse(self):
+        self._check_equivalent(
+            TransportMessage.iamaliveresponse("ivo://local", "ivo://remote"),
+            "iamalive",
+            "ivo://remote",
+            "ivo://local",
+        )
+
+    def test_ack(self):
+        self._check_equivalent(
+            TransportMessage.ack("ivo://local", "ivo://remote"),
+            "ack",
+            "ivo://remote",
+            "ivo://local",
+        )
+
+    def test_nak(self):
+        self._check_equivalent(
+            TransportMessage.nak("ivo://local", "ivo://remote", "reason"),
+            "nak",
+            "ivo://remote",
+            "ivo://local",
+            result="reason",
+        )
+
+    def test_authenticate(self):
+        self._check_equivalent(
+            TransportMessage.authenticate(DUMMY_SERVICE_IVOID),
+            "authenticate",
+            DUMMY_SERVICE_IVOID,
+        )
+
+    def test_no_origin(self):
+        # A remote end which has not told us its IVOID gets an empty Origin.
+        self._check_equivalent(
+            TransportMessage.iamaliveresponse("ivo://local", None),
+            "iamalive",
+            None,
+            "ivo://local",
+        )
+        self._check_equivalent(
+            TransportMessage.authenticate(None), "authenticate", None
+        )
+        self._check_equivalent(
+            TransportMessage.nak(None, None, "reason"),
+            "nak",
+            None,
+            None,
+            result="reason",
+        )
+        self.assertIn(
+            b"<Origin/>",
+            TransportMessage.iamaliveresponse("ivo://local", None).raw_bytes,
+        )
+        self.assertEqual(TransportMessage.authenticate(None).origin, None)
+
+    def test_escaping(self):
+        result = '<Result> & "quoted"\r\n\u00e9'
+        self._check_equivalent(
+            TransportMessage.nak("ivo://local", "ivo://remote", result),
+            "nak",
+            "ivo://remote",
+            "ivo://local",
+            result=result,
+        )
+        message = TransportMessage.nak("ivo://local", "ivo://remote", result)
+        self.assertEqual(message.element.find("Meta/Result").text, result)
+
+    def test_invalid_character(self):
+        # As with lxml, we refuse to generate an invalid document.
+        self.assertRaises(
+            ValueError, TransportMessage.nak, "ivo://local", "ivo://remote", "\x00"
+        )
+        self.assertRaises(
+            ValueError,
+            TransportMessage.ack,
+            "ivo://\xff".encode("latin-1"),
+            "ivo://remote",
+        )
+
+
+class TimestampTestCase(unittest.TestCase):
+    def test_cached(self):
+        # The timestamp is only regenerated when the second changes.
+        now = [1577836800.1]
+        self.patch(comet.protocol.messages.time, "time", lambda: now[0])
+        self.patch(comet.protocol.messages, "_timestamp", (None, None))
+        first = comet.protocol.messages._utc_timestamp()
+        self.assertEqual(first, "2020-01-01T00:00:00Z")
+        now[0] = 1577836800.9
+        self.assertIs(comet.protocol.messages._utc_timestamp(), first)
+        now[0] = 1577836801.0
+        self.assertEqual(
+            comet.protocol.messages._utc_timestamp(), "2020-01-01T00:00:01Z"
+        )
@@ -3,7 +3,7 @@
 
 import lxml.etree as etree
 
-from twisted.internet import reactor
+from twisted.internet import defer, reactor
 from twisted.internet import task
 from twisted.trial import unittest
 from twisted.test import proto_helpers
@@ -19,18 +19,30 @@ from comet.testutils import (
 )
 from comet.service.broker import BCAST_TEST_INTERVAL
 
+from comet.protocol.messages import TransportMessage
+import comet.protocol.broadcaster as broadcaster_module
 from comet.protocol.broadcaster import VOEventBroadcaster, VOEventBroadcasterFactory
+from comet.protocol.broadcaster import _match_filters
+from comet.protocol.filters import FilterIndex
+
+ROLE_TEST = '/*[local-name()="VOEvent" and @role="test"]'
+ROLE_OBSERVATION = '/*[local-name()="VOEvent" and @role="observation"]'
+
+# Equivalent filters which cannot be indexed, so are evaluated as XPath.
+XPATH_TEST = '//*[@role="test"]'
+XPATH_OBSERVATION = '//*[@role="observation"]'
 
 
 class DummyBroadcaster(object):
-    def __init__(self):
+    def __init__(self, filters=()):
         self.received_alive = False
         self.received_event = False
+        self.filters = list(filters)
 
     def sendIAmAlive(self):
         self.received_alive = True
 
-    def send_event(self, event):
+    def deliver_event(self, event):
         self.received_event = True
 
 
@@ -58,12 +70,139 @@ class VOEventBroadcasterFactoryTestCase(VOEventBroadcasterFactoryTestCaseBase):
         for broadcaster in self.factory.broadcasters:
             self.assertEqual(broadcaster.received_alive, True)
 
+    def test_sendIAmAlive_batches(self):
+        # Subscribers beyond the first batch are sent iamalives over the
+        # following part of the interval.
+        self.factory.IAMALIVE_BATCH = 2
+        self.factory.broadcasters[:] = [DummyBroadcaster() for _ in range(5)]
+        clock = self.factory.alive_loop.clock
+        clock.advance(self.factory.IAMALIVE_INTERVAL)
+        self.assertEqual(
+            [b.received_alive for b in self.factory.broadcasters],
+            [True, True, False, False, False],
+        )
+        clock.advance(self.factory.IAMALIVE_INTERVAL * self.factory.IAMALIVE_SPREAD)
+        for broadcaster in self.factory.broadcasters:
+            self.assertEqual(broadcaster.received_alive, True)
+
+    def test_sendIAmAlive_disconnected(self):
+        # Subscribers which disconnect before their batch is sent are skipped.
+        self.factory.IAMALIVE_BATCH = 1
+        self.factory.broadcasters[:] = [DummyBroadcaster() for _ in range(2)]
+        clock = self.factory.alive_loop.clock
+        clock.advance(self.factory.IAMALIVE_INTERVAL)
+        gone = self.factory.broadcasters.pop()
+        clock.advance(self.factory.IAMALIVE_INTERVAL * self.factory.IAMALIVE_SPREAD)
+        self.assertEqual(self.factory.broadcasters[0].received_alive, True)
+        self.assertEqual(gone.received_alive, False)
+
     def test_sendTestEvent(self):
         self.assertEqual(self.factory.test_loop.running, True)
         self.factory.test_loop.clock.advance(BCAST_TEST_INTERVAL)
         for broadcaster in self.factory.broadcasters:
             self.assertEqual(broadcaster.received_event, True)
 
+    def test_send_event_shared_filters(self):
+        # Each distinct filter is evaluated once, however many subscribers
+        # use it.
+        evaluated = []
+
+        class CountingFilter(object):
+            def __init__(self, xpath):
+                self.xpath = xpath
+                self.path = xpath.path
+
+            def __call__(self, element):
+                evaluated.append(self.path)
+                return self.xpath(element)
+
+        test = CountingFilter(self.factory.install_filter(XPATH_TEST))
+        observation = CountingFilter(self.factory.install_filter(XPATH_OBSERVATION))
+        self.factory.broadcasters[:] = [
+            DummyBroadcaster([test]),
+            DummyBroadcaster([observation]),
+            DummyBroadcaster([observation, test]),
+            DummyBroadcaster(),
+        ]
+
+        def check(result):
+            self.assertEqual(
+                sorted(evaluated), sorted([XPATH_TEST, XPATH_OBSERVATION])
+            )
+            self.assertEqual(
+                [b.received_event for b in self.factory.broadcasters],
+                [True, False, True, True],
+            )
+
+        return self.factory.send_event(DummyEvent()).addCallback(check)
+
+    def _count_thread_hops(self, filters=(ROLE_TEST, ROLE_OBSERVATION)):
+        hops = []
+
+        def counting_deferToThread(f, *args, **kwargs):
+            hops.append(f)
+            return defer.succeed(f(*args, **kwargs))
+
+        self.patch(broadcaster_module, "deferToThread", counting_deferToThread)
+        self.factory.broadcasters[:] = [
+            DummyBroadcaster([self.factory.install_filter(xpath)]) for xpath in filters
+        ]
+        self.factory.send_event(DummyEvent())
+        self.assertEqual(
+            [b.received_event for b in self.factory.broadcasters], [True, False]
+        )
+        return len(hops)
+
+    def test_send_event_inline(self):
+        # Cheap filters are evaluated without leaving the reactor thread.
+        self.assertEqual(self._count_thread_hops(), 0)
+
+    def test_send_event_single_thread_hop(self):
+        # Otherwise, all filters are evaluated together in a single thread.
+        self.factory.INLINE_FILTER_COST = 0
+        self.assertEqual(self._count_thread_hops(), 1)
+
+    def test_send_event_xpath_in_thread(self):
+        # Filters which aren't indexed are always evaluated in a thread, since
+        # arbitrary XPath may be arbitrarily expensive.
+        self.assertEqual(self._count_thread_hops((ROLE_TEST, XPATH_OBSERVATION)), 1)
+
+    def test_send_event_subset(self):
+        # Sending to some of the broadcasters doesn't replace the index built
+        # for all of them.
+        self.factory.broadcasters[:] = [
+            DummyBroadcaster([self.factory.install_filter(ROLE_TEST)]),
+            DummyBroadcaster([self.factory.install_filter(ROLE_OBSERVATION)]),
+        ]
+        self.factory.send_event(DummyEvent())
+        index = self.factory._filter_index
+        self.assertEqual(index.paths, (ROLE_TEST, ROLE_OBSERVATION))
+        self.factory.send_event(DummyEvent(), self.factory.broadcasters[1:])
+        self.assertIs(self.factory._filter_index, index)
+
+    def test_install_filter(self):
+        # Subscribers requesting the same expression share a compiled filter,
+        # which is forgotten when no longer in use.
+        first = self.factory.install_filter(ROLE_TEST)
+        second = self.factory.install_filter(ROLE_TEST)
+        self.assertIs(first, second)
+        self.factory.release_filter(first)
+        self.assertIn(ROLE_TEST, self.factory.filters)
+        self.factory.release_filter(second)
+        self.assertNotIn(ROLE_TEST, self.factory.filters)
+
+
+class MatchFiltersTestCase(unittest.TestCase):
+    def test_bitmap(self):
+        def fails(element):
+            raise etree.XPathEvalError("Cannot evaluate")
+
+        xpaths = [etree.XPath(ROLE_TEST), etree.XPath(ROLE_OBSERVATION), fails]
+        recipients = _match_filters(
+            DummyEvent().element, FilterIndex(xpaths), [[0], [1], [], [1, 0], [2]]
+        )
+        self.assertEqual(recipients, 0b01101)
+
 
 class VOEventBroadcasterFactoryNoTestEventsTestCase(
     VOEventBroadcasterFactoryTestCaseBase
@@ -118,6 +257,33 @@ class VOEventBroadcasterTestCase(unittest.TestCase):
         )
         self.assertEqual(self.proto.alive_count - init_alive_count, 1)
 
+    def test_sendIAmAlive_shared(self):
+        # All subscribers receive the same iamalive, which is generated once
+        # per tick.
+        calls = []
+        iamalive = TransportMessage.iamalive
+
+        def counting_iamalive(local_ivo):
+            calls.append(local_ivo)
+            return iamalive(local_ivo)
+
+        # Restore the classmethod itself, rather than the bound method that
+        # self.patch would save.
+        self.addCleanup(
+            setattr, TransportMessage, "iamalive", TransportMessage.__dict__["iamalive"]
+        )
+        TransportMessage.iamalive = counting_iamalive
+        other_proto = self.factory.buildProtocol(("127.0.0.1", 0))
+        other_tr = proto_helpers.StringTransportWithDisconnection()
+        other_proto.makeConnection(other_tr)
+        self.tr.clear()
+        other_tr.clear()
+        self.factory.alive_loop.clock.advance(self.factory.IAMALIVE_INTERVAL)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(self.tr.value(), other_tr.value())
+        received_element = etree.fromstring(other_tr.value()[4:])
+        self.assertEqual("iamalive", received_element.attrib["role"])
+
     def test_alive_timeout(self):
         self.assertEqual(self.tr.connected, True)
         for x in range(self.proto.MAX_ALIVE_COUNT + 1):
@@ -245,6 +411,18 @@ class VOEventBroadcasterTestCase(unittest.TestCase):
         self.assertEqual(self.tr.connected, True)
         self.assertEqual(len(self.proto.filters), 1)
 
+    def test_receive_authenticateresponse_shared(self):
+        # Filters are registered with the factory, and released when the
+        # subscriber re-authenticates or disconnects.
+        self._test_sets_filter([ROLE_TEST])
+        self.assertIs(self.proto.filters[0], self.factory.filters[ROLE_TEST][0])
+        self.proto.stringReceived(
+            DUMMY_AUTHENTICATE_RESPONSE([ROLE_OBSERVATION]).raw_bytes
+        )
+        self.assertEqual(list(self.factory.filters), [ROLE_OBSERVATION])
+        self.tr.loseConnection()
+        self.assertEqual(self.factory.filters, {})
+
     def test_receive_authenticateresponse_with_bad_filter(self):
         self.tr.clear()
         self.assertEqual(len(self.proto.filters), 0)
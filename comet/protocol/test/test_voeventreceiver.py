@@ -1,12 +1,15 @@
 # Comet VOEvent Broker.
 # Tests for VOEvent receiver.
 
+import os
+
 import lxml.etree as etree
 
 from twisted.internet import task
 from twisted.trial import unittest
 from twisted.test import proto_helpers
 
+import comet
 from comet.testutils import DUMMY_VOEVENT, DUMMY_SERVICE_IVOID
 
 from comet.protocol.receiver import VOEventReceiver, VOEventReceiverFactory
@@ -61,6 +64,36 @@ class VOEventReceiverTestCase(unittest.TestCase):
         self.assertEqual(etree.fromstring(self.tr.value()[4:]).attrib["role"], "ack")
         self.assertEqual(self.tr.connected, False)
 
+    def test_receive_voevent_threaded(self):
+        # Large events are parsed in a thread before being processed.
+        def check(result):
+            self.assertEqual(
+                etree.fromstring(self.tr.value()[4:]).attrib["role"], "ack"
+            )
+            self.assertEqual(self.tr.connected, False)
+
+        self.tr.clear()
+        self.proto.PARSE_THRESHOLD = 0
+        return self.proto.stringReceived(DUMMY_VOEVENT).addCallback(check)
+
+    def test_receive_voevent_schema(self):
+        # If the factory has a schema, events are validated as they are
+        # parsed.
+        def check(result):
+            self.assertEqual(
+                etree.fromstring(self.tr.value()[4:]).attrib["role"], "ack"
+            )
+            self.assertEqual(received[0].schema_validity, (schema, None))
+
+        schema = etree.XMLSchema(
+            etree.parse(os.path.join(comet.__path__[0], "schema/VOEvent-v2.0.xsd"))
+        )
+        received = []
+        self.factory.schema = schema
+        self.factory.validators.append(received.append)
+        self.tr.clear()
+        return self.proto.stringReceived(DUMMY_VOEVENT).addCallback(check)
+
     def test_receive_voevent_invalid(self):
         def fail(event):
             raise Exception("Invalid")
@@ -71,6 +104,17 @@ class VOEventReceiverTestCase(unittest.TestCase):
         self.assertEqual(etree.fromstring(self.tr.value()[4:]).attrib["role"], "nak")
         self.assertEqual(self.tr.connected, False)
 
+    def test_receive_voevent_malformed(self):
+        # An event which is only found to be malformed after its header has
+        # been read is rejected.
+        self.tr.clear()
+        padding = b"<!--" + b" " * 8192 + b"-->"
+        self.proto.stringReceived(
+            DUMMY_VOEVENT.replace(b"<Who>", padding + b"<Who>").replace(b"</Who>", b"")
+        )
+        self.assertEqual(etree.fromstring(self.tr.value()[4:]).attrib["role"], "nak")
+        self.assertEqual(self.tr.connected, False)
+
     def test_timeout(self):
         self.clock.advance(self.proto.TIMEOUT)
         self.assertEqual(self.tr.connected, False)
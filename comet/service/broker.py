@@ -18,12 +18,19 @@ from twisted.plugin import getPlugins
 import comet
 import comet.log as log
 from comet.constants import DEFAULT_SUBMIT_PORT, DEFAULT_SUBSCRIBE_PORT
+from comet.protocol.base import EventHandler
 from comet.service.broadcaster import makeBroadcasterService
 from comet.service.subscriber import makeSubscriberService
 from comet.service.receiver import makeReceiverService
 from comet.utility import Event_DB, BaseOptions, valid_ivoid, valid_xpath
 from comet.utility import coerce_to_client_endpoint, coerce_to_server_endpoint
-from comet.validator import CheckIVOID, CheckPreviouslySeen, CheckSchema
+from comet.utility import MappedEventDB, PartitionedEventDB, SQLiteEventDB
+from comet.utility.event_db import MAX_BATCH_SIZE, MAX_OPEN_DATABASES
+from comet.utility.event_db import HASHES, HASH_NAME, PARTITION_HOURS
+from comet.utility.xml import MAX_DEPTH, MAX_NODES, MAX_SIZE, set_limits
+from comet.validator import CheckCached, CheckIVOID, CheckPreviouslySeen, CheckSchema
+from comet.validator import ValidationPipeline
+from comet.validator.schema import MAX_PENDING
 
 # Handlers and plugins
 import comet.plugins
@@ -36,6 +43,14 @@ __all__ = ["makeService", "Options"]
 # Constants
 MAX_AGE = 30.0 * 24 * 60 * 60  # Forget events after 30 days
 PRUNE_INTERVAL = 6 * 60 * 60  # Prune the event db every 6 hours
+FLUSH_INTERVAL = 60  # Flush the event db to disk every minute
+STATS_INTERVAL = 60 * 60  # Log event db statistics every hour
+
+# By default, remember this many recently seen events in memory.
+EVENTDB_CACHE_SIZE = 10000
+
+# By default, remember the results of validating this many submitted events.
+VALIDATION_CACHE_SIZE = 10000
 
 # By default, we brodcast a test event every BCAST_TEST_INTERVAL seconds.
 BCAST_TEST_INTERVAL = 3600
@@ -62,6 +77,108 @@ class Options(BaseOptions):
             default=gettempdir(),
             help="Event database root [default=%(default)s].",
         )
+        std_group.add_argument(
+            "--eventdb-backend",
+            default="dbm",
+            choices=["dbm", "mapped", "partitioned", "sqlite"],
+            help="Storage used for the event database [default=%(default)s].",
+        )
+        std_group.add_argument(
+            "--eventdb-partition-hours",
+            default=PARTITION_HOURS,
+            type=float,
+            help="Period covered by each file of a partitioned event database "
+            "(hours) [default=%(default)s].",
+        )
+        std_group.add_argument(
+            "--eventdb-flush-interval",
+            default=FLUSH_INTERVAL,
+            type=int,
+            help="Interval between writing the event database to disk "
+            "(seconds) [default=%(default)s].",
+        )
+        std_group.add_argument(
+            "--eventdb-max-open",
+            default=MAX_OPEN_DATABASES,
+            type=int,
+            help="Maximum number of event database files to hold open "
+            "simultaneously [default=%(default)s].",
+        )
+        std_group.add_argument(
+            "--eventdb-cache-size",
+            default=EVENTDB_CACHE_SIZE,
+            type=int,
+            help="Number of recently seen events to remember in memory; 0 to "
+            "disable [default=%(default)s].",
+        )
+        std_group.add_argument(
+            "--eventdb-batch-size",
+            default=MAX_BATCH_SIZE,
+            type=int,
+            help="Maximum number of simultaneous event database lookups to "
+            "combine into a single batch; 0 to disable [default=%(default)s].",
+        )
+        std_group.add_argument(
+            "--eventdb-hash",
+            default=HASH_NAME,
+            choices=sorted(HASHES),
+            help="Hash function used to identify events in the event database "
+            "[default=%(default)s].",
+        )
+        std_group.add_argument(
+            "--eventdb-canonical",
+            action="store_true",
+            help="Identify events by their content, ignoring differences in "
+            "formatting, rather than by their exact bytes.",
+        )
+        std_group.add_argument(
+            "--eventdb-ivorn-first",
+            action="store_true",
+            help="Hash events on arrival only if their IVOID was seen "
+            "recently, hashing others in a worker thread (requires the "
+            "in-memory cache).",
+        )
+        std_group.add_argument(
+            "--eventdb-import",
+            default=None,
+            help="Load a snapshot of the event database from this file on "
+            "startup, if it exists (dbm backend only).",
+        )
+        std_group.add_argument(
+            "--eventdb-export",
+            default=None,
+            help="Write a snapshot of the event database to this file on "
+            "shutdown (dbm backend only).",
+        )
+        std_group.add_argument(
+            "--eventdb-preload",
+            default=0,
+            type=float,
+            help="Remember events seen in this many hours before startup in "
+            "memory (dbm backend only) [default=%(default)s].",
+        )
+
+        std_group.add_argument(
+            "--max-message-size",
+            default=MAX_SIZE,
+            type=int,
+            help="Refuse incoming messages larger than this (bytes) "
+            "[default=%(default)s].",
+        )
+        std_group.add_argument(
+            "--max-message-nodes",
+            default=MAX_NODES,
+            type=int,
+            help="Refuse incoming messages containing more than this many "
+            "items of markup [default=%(default)s].",
+        )
+        std_group.add_argument(
+            "--max-message-depth",
+            default=MAX_DEPTH,
+            type=int,
+            help="Refuse incoming messages with elements nested more than this "
+            "deep [default=%(default)s].",
+        )
 
         rcv_group = self.parser.add_argument_group(
             "Event Receiver", "Receive events submitted " "by remote authors."
@@ -84,6 +201,38 @@ class Options(BaseOptions):
             "event submissions [default=accept from "
             "everywhere].",
         )
+        rcv_group.add_argument(
+            "--receive-parse-schema",
+            action="store_true",
+            help="Validate submitted events against the VOEvent schema as they "
+            "are parsed, in a thread, rather than parsing and validating them "
+            "separately.",
+        )
+        rcv_group.add_argument(
+            "--receive-validation-cache",
+            default=VALIDATION_CACHE_SIZE,
+            type=int,
+            help="Number of recently submitted payloads for which to remember "
+            "the result of schema and IVOID validation; 0 to disable. Payloads "
+            "are hashed on arrival to look them up, so the cache is disabled "
+            "by --eventdb-ivorn-first [default=%(default)s].",
+        )
+        rcv_group.add_argument(
+            "--receive-schema-processes",
+            default=0,
+            type=int,
+            help="Validate submitted events against the VOEvent schema in this "
+            "many worker processes, rather than in a thread "
+            "[default=%(default)s].",
+        )
+        rcv_group.add_argument(
+            "--receive-schema-max-pending",
+            default=MAX_PENDING,
+            type=int,
+            help="Maximum number of events being validated by worker processes "
+            "at once; as many more may wait, and any beyond that are rejected "
+            "[default=%(default)s].",
+        )
 
         bcast_group = self.parser.add_argument_group(
             "Event Broadcaster", "Broadcast events to " "remote subscribers."
@@ -168,6 +317,9 @@ class Options(BaseOptions):
 
     def _checkOptions(self):
         self._check_for_ivoid()
+        self._check_eventdb_snapshot()
+        self._check_schema_validation()
+        self._check_message_limits()
         self._configure_plugins()
 
     def _configure_plugins(self):
@@ -193,12 +345,153 @@ class Options(BaseOptions):
         if not self["local_ivo"] and (self["receive"] or self["broadcast"]):
             self.parser.error("IVOA identifier required (--local-ivo).")
 
+    def _check_eventdb_snapshot(self):
+        """Ensure that snapshots are only requested for the dbm backend."""
+        if self["eventdb_backend"] != "dbm" and (
+            self["eventdb_import"] or self["eventdb_export"] or self["eventdb_preload"]
+        ):
+            self.parser.error(
+                "Event database snapshots and preloading require the dbm backend."
+            )
+        if self["eventdb_ivorn_first"] and self["eventdb_preload"]:
+            self.parser.error("Preloading is not supported with --eventdb-ivorn-first.")
+
+    def _check_schema_validation(self):
+        """Ensure that schema validation options are consistent."""
+        if self["receive_validation_cache"] < 0:
+            self.parser.error("--receive-validation-cache may not be negative.")
+        if self["receive_schema_processes"] < 0:
+            self.parser.error("--receive-schema-processes may not be negative.")
+        if self["receive_schema_max_pending"] < 1:
+            self.parser.error("--receive-schema-max-pending must be at least 1.")
+        if self["receive_schema_processes"] and self["receive_parse_schema"]:
+            self.parser.error(
+                "--receive-schema-processes cannot be used with "
+                "--receive-parse-schema."
+            )
+
+    def _check_message_limits(self):
+        """Ensure that the limits on incoming messages are sensible."""
+        for name in ("size", "nodes", "depth"):
+            if self[f"max_message_{name}"] < 1:
+                self.parser.error(f"--max-message-{name} must be at least 1.")
+
+
+def _make_event_db(config):
+    """Construct the event database backend requested in ``config``."""
+    options = {
+        "hash_name": config["eventdb_hash"],
+        "canonical": config["eventdb_canonical"],
+    }
+    if config["eventdb_backend"] == "sqlite":
+        return SQLiteEventDB(config["eventdb"], **options)
+    elif config["eventdb_backend"] == "mapped":
+        return MappedEventDB(config["eventdb"], **options)
+    elif config["eventdb_backend"] == "partitioned":
+        return PartitionedEventDB(
+            config["eventdb"],
+            partition_hours=config["eventdb_partition_hours"],
+            **options,
+        )
+    else:
+        return Event_DB(
+            config["eventdb"], max_open=config["eventdb_max_open"], **options
+        )
+
+
+def _log_eventdb_stats(event_db, previously_seen):
+    """Report the work done to identify duplicate events."""
+    log.info(
+        "Hashed %d event payloads (%s) in %.3f seconds"
+        % (event_db.hash_count, event_db.hash_name, event_db.hash_time)
+    )
+    if previously_seen.cache is not None:
+        log.info(
+            "Event cache: %d hits, %d misses"
+            % (previously_seen.cache.hits, previously_seen.cache.misses)
+        )
+
+
+def _log_validation_stats(receiver=None, subscriber=None, check_cached=None):
+    """
+    Report the time spent validating events received by the ``receiver`` and
+    ``subscriber`` pipelines, and the cache effectiveness.
+    """
+    if receiver is not None:
+        log.info("Validation (receivers): %s" % (receiver.summary(),))
+    if subscriber is not None:
+        log.info("Validation (subscribers): %s" % (subscriber.summary(),))
+    if check_cached is not None:
+        log.info("Validation stages: %s" % (check_cached.validators.summary(),))
+        log.info(
+            "Validation cache: %d hits, %d misses"
+            % (check_cached.cache.hits, check_cached.cache.misses)
+        )
+
+
+def _import_event_db(event_db, path):
+    """Load the snapshot at ``path`` into ``event_db``, if it exists."""
+    if not os.path.exists(path):
+        log.warn("No event database snapshot found at %s" % (path,))
+        return
+    with open(path, "rb") as f:
+        added = event_db.import_snapshot(f)
+    log.info("Imported %d events from %s" % (added, path))
+
+
+def _export_event_db(event_db, path):
+    """Write a snapshot of ``event_db`` to ``path``."""
+    # Write to a temporary file first, so that an existing snapshot is not
+    # lost if we fail part way through.
+    with open(path + ".tmp", "wb") as f:
+        count = event_db.export_snapshot(f)
+    os.replace(path + ".tmp", path)
+    log.info("Exported %d events to %s" % (count, path))
+
 
 def makeService(config):
-    event_db = Event_DB(config["eventdb"])
+    set_limits(
+        config["max_message_size"],
+        config["max_message_nodes"],
+        config["max_message_depth"],
+    )
+    # Refuse frames larger than the largest document we are prepared to parse.
+    EventHandler.MAX_LENGTH = config["max_message_size"]
+
+    event_db = _make_event_db(config)
+    if config["eventdb_import"]:
+        _import_event_db(event_db, config["eventdb_import"])
     LoopingCall(event_db.prune, MAX_AGE).start(PRUNE_INTERVAL)
+    LoopingCall(event_db.flush).start(config["eventdb_flush_interval"], now=False)
+    if config["eventdb_export"]:
+        reactor.addSystemEventTrigger(
+            "after", "shutdown", _export_event_db, event_db, config["eventdb_export"]
+        )
+    reactor.addSystemEventTrigger("after", "shutdown", event_db.close)
+
+    # A single duplicate checker is shared by all services, so that events
+    # received from multiple sources hit the same in-memory cache.
+    previously_seen = CheckPreviouslySeen(
+        event_db,
+        config["eventdb_cache_size"],
+        config["eventdb_batch_size"],
+        config["eventdb_ivorn_first"],
+    )
+    LoopingCall(_log_eventdb_stats, event_db, previously_seen).start(
+        STATS_INTERVAL, now=False
+    )
+    if config["eventdb_preload"]:
+        # Warm the cache before we start listening, so that the first
+        # duplicates to arrive don't all need to visit the database.
+        count = previously_seen.preload(
+            event_db.recent(config["eventdb_preload"] * 60 * 60)
+        )
+        log.info("Preloaded %d recent events" % (count,))
 
     broker_service = MultiService()
+    receiver_validators = None
+    subscriber_validators = None
+    check_cached = None
     for ep in config["broadcast"] if config["broadcast"] else []:
         bcast = makeBroadcasterService(
             ep,
@@ -213,31 +506,60 @@ def makeService(config):
         config["handlers"].append(EventRelay(bcast.factory))
 
     if config["receive"]:
-        validators = [
-            CheckPreviouslySeen(event_db),
-            CheckSchema(os.path.join(comet.__path__[0], "schema/VOEvent-v2.0.xsd")),
-            CheckIVOID(),
-        ]
+        check_schema = CheckSchema(
+            os.path.join(comet.__path__[0], "schema/VOEvent-v2.0.xsd"),
+            config["receive_schema_processes"],
+            config["receive_schema_max_pending"],
+        )
+        validators = [check_schema, CheckIVOID()]
+        if config["receive_validation_cache"] and not config["eventdb_ivorn_first"]:
+            # A single cache is shared by all receivers, so that the same
+            # event submitted to several of them is only validated once. The
+            # cache is keyed by the digest of each event, so would defeat the
+            # purpose of --eventdb-ivorn-first by hashing every event on
+            # arrival.
+            check_cached = CheckCached(
+                validators,
+                config["receive_validation_cache"],
+                HASHES[config["eventdb_hash"]],
+            )
+            validators = [check_cached]
+        # Validators are applied cheapest first; the duplicate check records
+        # the event, so comes last.
+        receiver_validators = ValidationPipeline(validators + [previously_seen])
         for ep in config["receive"]:
             recv = makeReceiverService(
                 ep,
                 config["local_ivo"],
-                validators,
+                receiver_validators,
                 config["handlers"],
                 config["receive_whitelist"],
+                check_schema.schema if config["receive_parse_schema"] else None,
             )
             recv.setServiceParent(broker_service)
 
+    if config["subscribe"]:
+        # A single pipeline is shared by all subscribers, so that the time
+        # spent in it is accumulated.
+        subscriber_validators = ValidationPipeline([previously_seen])
     for ep in config["subscribe"] if config["subscribe"] else []:
         sub = makeSubscriberService(
             ep,
             config["local_ivo"],
-            [CheckPreviouslySeen(event_db)],
+            subscriber_validators,
             config["handlers"],
             config["filters"],
         )
         sub.setServiceParent(broker_service)
 
+    if receiver_validators is not None or subscriber_validators is not None:
+        LoopingCall(
+            _log_validation_stats,
+            receiver_validators,
+            subscriber_validators,
+            check_cached,
+        ).start(STATS_INTERVAL, now=False)
+
     if not broker_service.services:
         reactor.callWhenRunning(log.warn, "No services requested; stopping.")
         reactor.callWhenRunning(reactor.stop)
@@ -9,7 +9,9 @@ from comet.protocol import VOEventReceiverFactory
 __all__ = ["makeReceiverService"]
 
 
-def makeReceiverService(endpoint, local_ivo, validators, handlers, whitelist):
+def makeReceiverService(
+    endpoint, local_ivo, validators, handlers, whitelist, schema=None
+):
     """Create a VOEvent receiver service.
 
     The receiver service accepts VOEvent messages submitted to the broker by
@@ -21,7 +23,8 @@ def makeReceiverService(endpoint, local_ivo, validators, handlers, whitelist):
         The endpoint to which the service will listen.
     local_ivo : `str`
         IVOA identifier for the subscriber.
-    validators : `list` of implementers of `~comet.icomet.IValidator`.
+    validators : `list` of implementers of `~comet.icomet.IValidator`, or a
+        `~comet.validator.ValidationPipeline`.
         Validators which will be applied to incoming events. Events which fail
         validation will be rejected.
     handlers : `list` of implementers of `~comet.icomet.IHandler`.
@@ -29,6 +32,10 @@ def makeReceiverService(endpoint, local_ivo, validators, handlers, whitelist):
     whitelist : `list` of `ipaddress.IPv4Network` or `ipaddress.IPv6Network`
         Submissions are only accepted from addresses which fall in a network
         included in the whitelist.
+    schema : `lxml.etree.XMLSchema`, optional
+        If provided, submissions are validated against this schema as they are
+        parsed, in a thread. `~comet.validator.CheckSchema` does not validate
+        them again if it uses the same schema.
 
     Warnings
     --------
@@ -37,7 +44,7 @@ def makeReceiverService(endpoint, local_ivo, validators, handlers, whitelist):
     probably break horribly).
     """
     factory = VOEventReceiverFactory(
-        local_ivo=local_ivo, validators=validators, handlers=handlers
+        local_ivo=local_ivo, validators=validators, handlers=handlers, schema=schema
     )
     if log.LEVEL >= log.Levels.INFO:
         factory.noisy = False
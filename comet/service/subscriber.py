@@ -16,7 +16,8 @@ def makeSubscriberService(endpoint, local_ivo, validators, handlers, filters):
         The endpoint to which the service will connect.
     local_ivo : `str` or `None`
         IVOA identifier for the subscriber.
-    validators : `list` of implementers of `~comet.icomet.IValidator`.
+    validators : `list` of implementers of `~comet.icomet.IValidator`, or a
+        `~comet.validator.ValidationPipeline`.
         Validators which will be applied to incoming events. Events which fail
         validation will be rejected.
     handlers : `list` of implementers of `~comet.icomet.IHandler`.
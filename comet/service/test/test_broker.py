@@ -9,10 +9,19 @@ from twisted.trial import unittest
 from twisted.internet import reactor
 from twisted.internet.error import CannotListenError
 
+import comet.service.broker
+import comet.utility.xml
+
 from comet.constants import DEFAULT_SUBMIT_PORT, DEFAULT_SUBSCRIBE_PORT
-from comet.service.broker import BCAST_TEST_INTERVAL
+from comet.protocol.base import EventHandler
+from comet.service.broker import BCAST_TEST_INTERVAL, FLUSH_INTERVAL
+from comet.service.broker import EVENTDB_CACHE_SIZE, VALIDATION_CACHE_SIZE
 from comet.service.broker import Options
 from comet.service.broker import makeService
+from comet.utility.event_db import MAX_BATCH_SIZE
+from comet.utility.xml import MAX_DEPTH, MAX_NODES, MAX_SIZE
+from comet.validator import CheckCached, ValidationPipeline
+from comet.validator.schema import MAX_PENDING
 from comet.testutils import DUMMY_SERVICE_IVOID, OptionTestUtils
 
 
@@ -129,10 +138,143 @@ class BrokerOptionsTestCase(unittest.TestCase, OptionTestUtils):
             self.config.parseOptions(["--eventdb", dirname])["eventdb"], dirname
         )
 
+    def test_eventdb_backend(self):
+        self.config.parseOptions(self.cmd_line)
+        self.assertEqual(self.config["eventdb_backend"], "dbm")
+        self.config.parseOptions(self.cmd_line + ["--eventdb-backend", "sqlite"])
+        self.assertEqual(self.config["eventdb_backend"], "sqlite")
+        self.config.parseOptions(self.cmd_line + ["--eventdb-backend", "mapped"])
+        self.assertEqual(self.config["eventdb_backend"], "mapped")
+        self.config.parseOptions(
+            self.cmd_line
+            + ["--eventdb-backend", "partitioned", "--eventdb-partition-hours", "6"]
+        )
+        self.assertEqual(self.config["eventdb_backend"], "partitioned")
+        self.assertEqual(self.config["eventdb_partition_hours"], 6)
+        self._check_bad_parse(self.cmd_line + ["--eventdb-backend", "bad"])
+
+    def test_eventdb_flush_interval(self):
+        # Check that the default is set.
+        self.config.parseOptions(self.cmd_line)
+        self.assertEqual(self.config["eventdb_flush_interval"], FLUSH_INTERVAL)
+
+        # And can be over-ridden.
+        self.config.parseOptions(self.cmd_line + ["--eventdb-flush-interval", "10"])
+        self.assertEqual(self.config["eventdb_flush_interval"], 10)
+
+    def test_eventdb_max_open(self):
+        self.config.parseOptions(self.cmd_line + ["--eventdb-max-open", "2"])
+        self.assertEqual(self.config["eventdb_max_open"], 2)
+
+    def test_eventdb_cache_size(self):
+        self.config.parseOptions(self.cmd_line)
+        self.assertEqual(self.config["eventdb_cache_size"], EVENTDB_CACHE_SIZE)
+        self.config.parseOptions(self.cmd_line + ["--eventdb-cache-size", "0"])
+        self.assertEqual(self.config["eventdb_cache_size"], 0)
+
+    def test_eventdb_batch_size(self):
+        self.config.parseOptions(self.cmd_line)
+        self.assertEqual(self.config["eventdb_batch_size"], MAX_BATCH_SIZE)
+        self.config.parseOptions(self.cmd_line + ["--eventdb-batch-size", "0"])
+        self.assertEqual(self.config["eventdb_batch_size"], 0)
+
+    def test_eventdb_hash(self):
+        self.config.parseOptions(self.cmd_line)
+        self.assertEqual(self.config["eventdb_hash"], "sha1")
+        self.config.parseOptions(self.cmd_line + ["--eventdb-hash", "blake2b"])
+        self.assertEqual(self.config["eventdb_hash"], "blake2b")
+        self._check_bad_parse(self.cmd_line + ["--eventdb-hash", "md5"])
+
+    def test_eventdb_canonical(self):
+        self.config.parseOptions(self.cmd_line)
+        self.assertFalse(self.config["eventdb_canonical"])
+        self.config.parseOptions(self.cmd_line + ["--eventdb-canonical"])
+        self.assertTrue(self.config["eventdb_canonical"])
+
+    def test_eventdb_ivorn_first(self):
+        self.config.parseOptions(self.cmd_line)
+        self.assertFalse(self.config["eventdb_ivorn_first"])
+        self.config.parseOptions(self.cmd_line + ["--eventdb-ivorn-first"])
+        self.assertTrue(self.config["eventdb_ivorn_first"])
+        self._check_bad_parse(
+            self.cmd_line + ["--eventdb-ivorn-first", "--eventdb-preload", "1"]
+        )
+
+    def test_eventdb_snapshot(self):
+        self.config.parseOptions(self.cmd_line)
+        self.assertEqual(self.config["eventdb_import"], None)
+        self.assertEqual(self.config["eventdb_export"], None)
+        self.assertEqual(self.config["eventdb_preload"], 0)
+        self.config.parseOptions(
+            self.cmd_line
+            + [
+                "--eventdb-import",
+                "/example/in",
+                "--eventdb-export",
+                "/example/out",
+                "--eventdb-preload",
+                "2",
+            ]
+        )
+        self.assertEqual(self.config["eventdb_import"], "/example/in")
+        self.assertEqual(self.config["eventdb_export"], "/example/out")
+        self.assertEqual(self.config["eventdb_preload"], 2)
+
+        # Only supported by the dbm backend.
+        self._check_bad_parse(
+            self.cmd_line + ["--eventdb-backend", "sqlite", "--eventdb-preload", "1"]
+        )
+
     def test_receive(self):
         # Check that ``--receive`` properly sets up server endpoints.
         self._check_server_endpoints("receive", DEFAULT_SUBMIT_PORT)
 
+    def test_receive_schema_processes(self):
+        self.config.parseOptions(self.cmd_line)
+        self.assertEqual(self.config["receive_schema_processes"], 0)
+        self.assertEqual(self.config["receive_schema_max_pending"], MAX_PENDING)
+        self.config.parseOptions(
+            self.cmd_line
+            + ["--receive-schema-processes", "4", "--receive-schema-max-pending", "10"]
+        )
+        self.assertEqual(self.config["receive_schema_processes"], 4)
+        self.assertEqual(self.config["receive_schema_max_pending"], 10)
+        self._check_bad_parse(self.cmd_line + ["--receive-schema-processes", "-1"])
+        self._check_bad_parse(self.cmd_line + ["--receive-schema-max-pending", "0"])
+        self._check_bad_parse(
+            self.cmd_line
+            + ["--receive-schema-processes", "2", "--receive-parse-schema"]
+        )
+
+    def test_message_limits(self):
+        self.config.parseOptions(self.cmd_line)
+        self.assertEqual(self.config["max_message_size"], MAX_SIZE)
+        self.assertEqual(self.config["max_message_nodes"], MAX_NODES)
+        self.assertEqual(self.config["max_message_depth"], MAX_DEPTH)
+        self.config.parseOptions(
+            self.cmd_line
+            + [
+                "--max-message-size",
+                "2048",
+                "--max-message-nodes",
+                "100",
+                "--max-message-depth",
+                "8",
+            ]
+        )
+        self.assertEqual(self.config["max_message_size"], 2048)
+        self.assertEqual(self.config["max_message_nodes"], 100)
+        self.assertEqual(self.config["max_message_depth"], 8)
+        for name in ("size", "nodes", "depth"):
+            self._check_bad_parse(self.cmd_line + [f"--max-message-{name}", "0"])
+
+    def test_receive_validation_cache(self):
+        self.config.parseOptions(self.cmd_line)
+        self.assertEqual(self.config["receive_validation_cache"], VALIDATION_CACHE_SIZE)
+        self.config.parseOptions(self.cmd_line + ["--receive-validation-cache", "0"])
+        self.assertEqual(self.config["receive_validation_cache"], 0)
+        self._check_bad_parse(self.cmd_line + ["--receive-validation-cache", "-1"])
+
     def test_receive_whitelist(self):
         # Check that we create a whitelist for receivers.
         self._check_whitelist("receive-whitelist")
@@ -287,6 +429,27 @@ class BrokerServiceTestCase(unittest.TestCase):
         self.config.parseOptions(options)
         return makeService(self.config)
 
+    def test_message_limits(self):
+        # The limits on incoming messages are applied to all parsing.
+        for name in ("MAX_SIZE", "MAX_NODES", "MAX_DEPTH"):
+            self.patch(comet.utility.xml, name, getattr(comet.utility.xml, name))
+        self.patch(EventHandler, "MAX_LENGTH", EventHandler.MAX_LENGTH)
+        self._make_service(
+            [
+                "--local-ivo",
+                "ivo://comet/test",
+                "--receive",
+                "--max-message-size",
+                "2048",
+                "--max-message-depth",
+                "8",
+            ]
+        )
+        self.assertEqual(comet.utility.xml.MAX_SIZE, 2048)
+        self.assertEqual(comet.utility.xml.MAX_NODES, MAX_NODES)
+        self.assertEqual(comet.utility.xml.MAX_DEPTH, 8)
+        self.assertEqual(EventHandler.MAX_LENGTH, 2048)
+
     def test_has_services(self):
         # Demonstrate that we can create appropriate numbers of services.
 
@@ -336,6 +499,51 @@ class BrokerServiceTestCase(unittest.TestCase):
         )
         self.assertEqual(len(service.services), 6)
 
+    def test_receive_parse_schema(self):
+        # Receivers only validate as they parse if requested.
+        for options, expected in [([], False), (["--receive-parse-schema"], True)]:
+            service = self._make_service(
+                ["--local-ivo", "ivo://comet/test", "--receive"] + options
+            )
+            factory = service.services[0].factory.wrappedFactory
+            self.assertEqual(factory.schema is not None, expected)
+
+    def test_subscriber_pipeline(self):
+        # Subscribers share a single pipeline, so that its timings are kept.
+        pipelines = []
+        make_subscriber = comet.service.broker.makeSubscriberService
+
+        def recording(endpoint, local_ivo, validators, *args):
+            pipelines.append(validators)
+            return make_subscriber(endpoint, local_ivo, validators, *args)
+
+        self.patch(comet.service.broker, "makeSubscriberService", recording)
+        self._make_service(
+            [
+                "--local-ivo",
+                "ivo://comet/test",
+                "--subscribe",
+                "tcp:test:12345",
+                "--subscribe",
+                "tcp:test:54321",
+            ]
+        )
+        first, second = pipelines
+        self.assertIsInstance(first, ValidationPipeline)
+        self.assertIs(first, second)
+
+    def test_validation_cache(self):
+        # The validation cache, which hashes every event on arrival, is not
+        # used when only events with familiar IVOIDs should be hashed.
+        for options, expected in [([], True), (["--eventdb-ivorn-first"], False)]:
+            service = self._make_service(
+                ["--local-ivo", "ivo://comet/test", "--receive"] + options
+            )
+            factory = service.services[0].factory.wrappedFactory
+            self.assertEqual(
+                any(isinstance(v, CheckCached) for v in factory.validators), expected
+            )
+
     def _check_bind_failure(self, service):
         # Check that starting the service raises a CannotListenError.
         try:
@@ -7,9 +7,8 @@ from contextlib import redirect_stderr
 from functools import partial
 from os import devnull
 
-import lxml.etree as etree
-
 from comet.protocol import TransportMessage
+from comet.utility import VOEventMessage
 
 # All dummy event text should be RAW BYTES, as received over the network.
 
@@ -126,11 +125,9 @@ DUMMY_AUTHENTICATE_RESPONSE = partial(
 )
 
 
-class DummyEvent(object):
+class DummyEvent(VOEventMessage):
     def __init__(self, ivoid=DUMMY_EVENT_IVOID):
-        self.attrib = {"ivorn": ivoid}
-        self.raw_bytes = DUMMY_VOEVENT.replace(DUMMY_EVENT_IVOID, ivoid)
-        self.element = etree.fromstring(self.raw_bytes)
+        VOEventMessage.__init__(self, DUMMY_VOEVENT.replace(DUMMY_EVENT_IVOID, ivoid))
 
 
 class DummyLogObserver(object):
@@ -1,8 +1,10 @@
 # Comet VOEvent Broker.
 # Utility routines.
 
+from comet.utility.cache import *
 from comet.utility.endpoint import *
 from comet.utility.event_db import *
+from comet.utility.mapped_event_db import *
 from comet.utility.options import *
 from comet.utility.voevent import *
 from comet.utility.whitelist import *
@@ -0,0 +1,50 @@
+# Comet VOEvent Broker.
+# Bounded in-memory cache.
+
+from collections import OrderedDict
+
+__all__ = ["LRUCache"]
+
+
+class LRUCache(object):
+    """
+    A mapping holding at most ``maxsize`` entries.
+
+    When the cache is full, the least recently used entry is discarded to make
+    room for a new one. Lookups made with `get` are counted in ``hits`` and
+    ``misses``.
+
+    Note that this is not thread-safe: it is intended to be used only from
+    the reactor thread.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __setitem__(self, key, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def get(self, key, default=None):
+        try:
+            value = self._entries[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def clear(self):
+        self._entries.clear()
@@ -2,40 +2,128 @@
 # Event database.
 
 import os
+import re
+import sqlite3
+import struct
 
 try:
     import anydbm
 except ImportError:
     import dbm as anydbm
 import time
-from hashlib import sha1
+from hashlib import blake2b, sha1
+from time import perf_counter
 from threading import Lock
-from collections import defaultdict
-from contextlib import closing
+from collections import defaultdict, OrderedDict
 
+from twisted.internet import reactor
 from twisted.internet.threads import deferToThread
-from twisted.internet.defer import DeferredList
+from twisted.internet.defer import Deferred, DeferredList, inlineCallbacks
+from twisted.internet.defer import succeed
+from twisted.python.failure import Failure
 
 import comet.log as log
-from comet.utility.voevent import parse_ivoid
 
-__all__ = ["Event_DB"]
+__all__ = ["BatchingEventDB", "Event_DB", "PartitionedEventDB", "SQLiteEventDB"]
 
+# By default, keep at most this many dbm files open simultaneously.
+MAX_OPEN_DATABASES = 64
 
-class Event_DB(object):
-    def __init__(self, root):
+# By default, Event_DB prunes this many keys at a time.
+PRUNE_SLICE = 1000
+
+# By default, check at most this many events in a single batch.
+MAX_BATCH_SIZE = 100
+
+# By default, start a new partition of a PartitionedEventDB every day.
+PARTITION_HOURS = 24
+
+# Hash functions which may be used to compute event keys. All produce 20 byte
+# digests, as required by MappedEventDB and by snapshots.
+HASHES = {
+    "sha1": sha1,
+    "blake2b": lambda data: blake2b(data, digest_size=20),
+}
+
+# By default, compute event keys with this hash function.
+HASH_NAME = "sha1"
+
+# The name of an Event_DB database is derived from the authority or resource
+# key of an IVOID, with slashes replaced by underscores. Its keys are hex
+# digests.
+DB_NAME_RE = re.compile(r"[\w\-.~*'()]+")
+EVENT_KEY_RE = re.compile(rb"[0-9a-f]{40}")
+
+# A snapshot of an Event_DB starts with SNAPSHOT_MAGIC, followed by a series
+# of blocks. Each block consists of a SNAPSHOT_BLOCK header, giving the length
+# of a database name and the number of records which follow, the name itself,
+# and then the records: a binary digest and the time it was first seen.
+SNAPSHOT_MAGIC = b"CometSnapshot\x01"
+SNAPSHOT_BLOCK = struct.Struct("<HI")
+SNAPSHOT_RECORD = struct.Struct("<20sd")
+
+
+class EventDBBase(object):
+    """
+    Functionality common to all event database backends.
+
+    Backends provide ``check_batch(batch)``, which records a sequence of
+    events, and ``prune(expiry_time)``, which forgets events older than
+    ``expiry_time`` seconds and returns a `~twisted.internet.defer.Deferred`.
+    They may override `flush` and `close` if they buffer changes or hold files
+    open.
+    """
+
+    def __init__(self, root, hash_name=HASH_NAME, canonical=False):
         self.root = self._ensure_dir(root)
-        self.databases = defaultdict(Lock)
+        self.hash_name = hash_name
+        self._hash = HASHES[hash_name]
+        self.canonical = canonical
 
-    @staticmethod
-    def _get_event_details(event):
-        auth, rsrc, local = parse_ivoid(event.element.attrib["ivorn"])
+        # The number of event payloads hashed, and the total time taken.
+        self.hash_count = 0
+        self.hash_time = 0.0
+        self._stats_lock = Lock()
+
+    def check_event(self, event, details=None):
+        """Return True if event is unseen (and hence good to forward), False
+        otherwise.
+
+        If the result of `get_event_details` for this event is already known,
+        it may be supplied as ``details`` to save recalculating it.
+        """
+        return self.check_batch([details or self.get_event_details(event)])[0]
+
+    def get_event_details(self, event):
+        """
+        Return the database path and key under which ``event`` is recorded.
+
+        The key is a digest of the event payload, calculated with the hash
+        function named by ``hash_name``. If ``canonical`` is set, the digest
+        is instead taken over the canonical form of the event (see
+        `~comet.utility.xml.canonical_form`), so that copies which have been
+        re-serialized are recognized. Either way, the digest is memoized on
+        the event; the number of digests calculated, and the time taken, are
+        recorded in ``hash_count`` and ``hash_time``.
+        """
+        auth, rsrc, local = event.ivoid_parts
 
         # Although "/" isn't the path separator on Windows, it os.path.join()
         # still gets confused if it appears in a filename.
         db_path = os.path.join(auth, rsrc).replace(os.path.sep, "_").replace("/", "_")
 
-        key = sha1(event.raw_bytes).hexdigest()
+        # Only digests which are actually calculated are counted.
+        memoized = event.has_digest(self._hash, self.canonical)
+        start = perf_counter()
+        if self.canonical:
+            key = event.content_digest(self._hash)
+        else:
+            key = event.digest(self._hash)
+        elapsed = perf_counter() - start
+        if not memoized:
+            with self._stats_lock:
+                self.hash_count += 1
+                self.hash_time += elapsed
         return db_path, key
 
     @staticmethod
@@ -56,44 +144,662 @@ class Event_DB(object):
             raise RuntimeError("Insufficient permissions to manipulate event database.")
         return path
 
-    def check_event(self, event):
-        """Return True if event is unseen (and hence good to forward), False
-        otherwise.
+    def flush(self):
+        """
+        Write any outstanding changes to disk.
+        """
+        return succeed(None)
+
+    def close(self):
+        """
+        Flush outstanding changes and release any open files.
+        """
+        pass
+
+
+class Event_DB(EventDBBase):
+    """
+    Record the events seen by this broker in dbm files.
+
+    Events are stored in a separate dbm file for each authority/resource. A
+    handle to each file is kept open between calls to `check_event`, rather
+    than re-opening the file for each event; at most ``max_open`` handles are
+    kept, with the least recently used being closed first. Call `flush` to
+    write outstanding changes to disk, and `close` when done.
+
+    Any databases already present in ``root`` are found on startup, so that
+    they are pruned even if no further events are received from their source.
+    Since ``root`` may be shared with other programs, only files which are
+    named and keyed as ours would be are adopted, and keys which are not event
+    digests are never removed.
+    """
+
+    def __init__(
+        self,
+        root,
+        max_open=MAX_OPEN_DATABASES,
+        prune_slice=PRUNE_SLICE,
+        hash_name=HASH_NAME,
+        canonical=False,
+    ):
+        EventDBBase.__init__(self, root, hash_name, canonical)
+        self.max_open = max_open
+        self.prune_slice = prune_slice
+        self.databases = defaultdict(Lock)
+        for db_path in self._find_databases(self.root):
+            self.databases[db_path]
+
+        # Open dbm handles, in order of least to most recently used. Each
+        # handle may only be used while holding the lock on the corresponding
+        # path in ``self.databases``; ``_handles_lock`` protects the ordering.
+        self._handles = OrderedDict()
+        self._handles_lock = Lock()
+
+    @staticmethod
+    def _find_databases(root):
+        """
+        Return the names of the event databases in ``root``.
         """
-        db_path, key = self._get_event_details(event)
-        with self.databases[db_path]:  # Acquire lock
-            with closing(anydbm.open(os.path.join(self.root, db_path), "c")) as db:
-                if key in db:
-                    return False
+        # Depending on the dbm implementation, a database may consist of a
+        # file with the same name as the database, or of files with the name
+        # followed by one of these suffixes.
+        candidates = set()
+        for filename in os.listdir(root):
+            candidates.add(filename)
+            for suffix in (".db", ".dat", ".dir", ".pag"):
+                if filename.endswith(suffix):
+                    candidates.add(filename[: -len(suffix)])
+        return sorted(
+            name
+            for name in candidates
+            if DB_NAME_RE.fullmatch(name)
+            and Event_DB._is_event_db(os.path.join(root, name))
+        )
+
+    @staticmethod
+    def _is_event_db(path):
+        """
+        Return True if ``path`` is a dbm database which is either empty or
+        keyed by event digests.
+        """
+        if not anydbm.whichdb(path):
+            return False
+        try:
+            db = anydbm.open(path, "r")
+        except Exception:
+            return False
+        try:
+            if hasattr(db, "firstkey"):
+                key = db.firstkey()
+            else:
+                key = next(iter(db.keys()), None)
+        except Exception:
+            return False
+        finally:
+            db.close()
+        return key is None or bool(EVENT_KEY_RE.fullmatch(key))
+
+    def _open(self, db_path):
+        """
+        Return an open handle to the database at ``db_path``.
+
+        The caller must hold the lock on ``db_path``.
+        """
+        with self._handles_lock:
+            db = self._handles.get(db_path)
+            if db is not None:
+                self._handles.move_to_end(db_path)
+                return db
+
+        # Open outside ``_handles_lock``: nobody else can be opening this path,
+        # since we hold its lock.
+        db = anydbm.open(os.path.join(self.root, db_path), "c")
+
+        with self._handles_lock:
+            self._handles[db_path] = db
+            if len(self._handles) > self.max_open:
+                idle = [path for path in self._handles if path != db_path]
+            else:
+                idle = []
+        for path in idle:
+            self._evict(path)
+        return db
+
+    def _evict(self, db_path):
+        """
+        Close the handle on ``db_path``, if it is open and not in use.
+
+        We never block waiting for another path's lock here: the caller may be
+        holding a lock of its own, and blocking could deadlock.
+        """
+        lock = self.databases[db_path]
+        if not lock.acquire(False):
+            return
+        try:
+            with self._handles_lock:
+                if len(self._handles) <= self.max_open:
+                    return
+                db = self._handles.pop(db_path, None)
+            if db is not None:
+                db.close()
+        finally:
+            lock.release()
+
+    def check_batch(self, batch):
+        """
+        Record a sequence of events.
+
+        ``batch`` is a sequence of ``(db_path, key)`` pairs, as returned by
+        `get_event_details`. Return a list containing, for each event in
+        order, True if it is unseen and False otherwise.
+
+        Each database is locked and opened once per batch, and events are
+        checked in order, so that a duplicate later in the batch of an event
+        earlier in the batch is detected.
+        """
+        results = [None] * len(batch)
+        by_path = defaultdict(list)
+        for index, (db_path, key) in enumerate(batch):
+            by_path[db_path].append((index, key))
+        now = str(time.time())
+        for db_path, entries in by_path.items():
+            with self.databases[db_path]:  # Acquire lock
+                db = self._open(db_path)
+                for index, key in entries:
+                    if key in db:
+                        results[index] = False
+                    else:
+                        db[key] = now
+                        results[index] = True
+        return results
+
+    def _sync(self, db_path, close=False):
+        with self.databases[db_path]:
+            with self._handles_lock:
+                if close:
+                    db = self._handles.pop(db_path, None)
                 else:
-                    db[key] = str(time.time())
-                    return True
+                    db = self._handles.get(db_path)
+            if db is None:
+                return
+            elif close:
+                db.close()
+            elif hasattr(db, "sync"):
+                # Not all dbm implementations support sync(); those that don't
+                # write changes immediately.
+                db.sync()
+
+    def flush(self):
+        """
+        Write any changes held by open database handles to disk.
+        """
+        with self._handles_lock:
+            paths = list(self._handles)
+        return DeferredList([deferToThread(self._sync, db_path) for db_path in paths])
+
+    def close(self):
+        """
+        Flush and close all open database handles.
+
+        Handles will be re-opened as required if the database is used again.
+        """
+        with self._handles_lock:
+            paths = list(self._handles)
+        for db_path in paths:
+            self._sync(db_path, close=True)
+
+    def _keys(self, db_path):
+        with self.databases[db_path]:
+            # The database returned by anydbm is guaranteed to have a .keys()
+            # method, but not necessarily .(iter)items().
+            return self._open(db_path).keys()
+
+    def _expire_keys(self, db_path, keys, expiry_time):
+        removed = 0
+        with self.databases[db_path]:
+            db = self._open(db_path)
+            now = time.time()
+            for key in keys:
+                if not EVENT_KEY_RE.fullmatch(key):
+                    # Not one of ours.
+                    continue
+                try:
+                    inserted = float(db[key])
+                except (KeyError, ValueError):
+                    # Either checked since the keys were listed, or not one of
+                    # ours.
+                    continue
+                # Rounding to nearest int avoids an issue when we call
+                # prune(0) *immediately* after an insertion and might get hit
+                # by floating point weirdness.
+                if int(now - inserted) >= expiry_time:
+                    del db[key]
+                    removed += 1
+        return removed
+
+    def _read_keys(self, db_path, keys):
+        entries = []
+        with self.databases[db_path]:
+            db = self._open(db_path)
+            for key in keys:
+                if not EVENT_KEY_RE.fullmatch(key):
+                    continue
+                try:
+                    inserted = float(db[key])
+                except (KeyError, ValueError):
+                    continue
+                if isinstance(key, bytes):
+                    key = key.decode("ascii")
+                entries.append((key, inserted))
+        return entries
+
+    def _slices(self):
+        """
+        Iterate over the contents of all databases, ``prune_slice`` keys at a
+        time, yielding ``db_path`` and a list of ``(key, inserted)`` pairs.
+
+        Only one slice is read while holding the lock on each database. A
+        database which cannot be read is logged and skipped.
+        """
+        for db_path in list(self.databases):
+            try:
+                keys = self._keys(db_path)
+            except Exception as e:
+                log.warn("Failed to read %s: %s" % (db_path, e))
+                continue
+            for start in range(0, len(keys), self.prune_slice):
+                stop = start + self.prune_slice
+                try:
+                    items = self._read_keys(db_path, keys[start:stop])
+                except Exception as e:
+                    log.warn("Failed to read %s: %s" % (db_path, e))
+                    break
+                yield db_path, items
+
+    def recent(self, max_age):
+        """
+        Return the details of events seen in the last ``max_age`` seconds.
+
+        The result is a list of ``(db_path, key)`` pairs, as returned by
+        `get_event_details`, ordered from least to most recently seen.
+        """
+        horizon = time.time() - max_age
+        entries = []
+        for db_path, items in self._slices():
+            entries.extend(
+                (inserted, db_path, key)
+                for key, inserted in items
+                if inserted > horizon
+            )
+        entries.sort()
+        return [(db_path, key) for inserted, db_path, key in entries]
+
+    def export_snapshot(self, fileobj):
+        """
+        Write the contents of all databases to the binary file ``fileobj``.
+
+        Return the number of events written. The snapshot is written
+        incrementally, so events may be checked while it is in progress.
+        """
+        fileobj.write(SNAPSHOT_MAGIC)
+        count = 0
+        for db_path, items in self._slices():
+            records = []
+            for key, inserted in items:
+                try:
+                    records.append(SNAPSHOT_RECORD.pack(bytes.fromhex(key), inserted))
+                except (ValueError, struct.error):
+                    # Not one of ours.
+                    continue
+            if records:
+                name = db_path.encode("utf-8")
+                fileobj.write(SNAPSHOT_BLOCK.pack(len(name), len(records)))
+                fileobj.write(name)
+                fileobj.write(b"".join(records))
+                count += len(records)
+        return count
+
+    def import_snapshot(self, fileobj):
+        """
+        Record the events in a snapshot read from the binary file ``fileobj``.
+
+        Events which are already present retain their existing insertion
+        times. Return the number of events added.
+        """
+
+        def read(size):
+            data = fileobj.read(size)
+            if len(data) != size:
+                raise RuntimeError("Truncated event database snapshot.")
+            return data
 
+        if fileobj.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+            raise RuntimeError("Not an event database snapshot.")
+        added = 0
+        while True:
+            header = fileobj.read(SNAPSHOT_BLOCK.size)
+            if not header:
+                return added
+            elif len(header) != SNAPSHOT_BLOCK.size:
+                raise RuntimeError("Truncated event database snapshot.")
+            name_length, count = SNAPSHOT_BLOCK.unpack(header)
+            db_path = read(name_length).decode("utf-8")
+            if db_path in ("", ".", "..") or os.path.basename(db_path) != db_path:
+                raise RuntimeError("Bad database name in snapshot: %r" % (db_path,))
+            records = SNAPSHOT_RECORD.iter_unpack(read(count * SNAPSHOT_RECORD.size))
+            with self.databases[db_path]:
+                db = self._open(db_path)
+                for digest, inserted in records:
+                    key = digest.hex()
+                    if key not in db:
+                        db[key] = str(inserted)
+                        added += 1
+
+    @inlineCallbacks
     def prune(self, expiry_time):
         """
         Remove entries with age at least expiry_time seconds from the database.
+
+        Databases are pruned one at a time, ``prune_slice`` keys at a time.
+        The lock on each database is released between slices, so that events
+        can be checked while pruning is in progress.
         """
+        for db_path in list(self.databases):
+            removed = 0
+            try:
+                keys = yield deferToThread(self._keys, db_path)
+                for start in range(0, len(keys), self.prune_slice):
+                    stop = start + self.prune_slice
+                    removed += yield deferToThread(
+                        self._expire_keys, db_path, keys[start:stop], expiry_time
+                    )
+            except Exception as e:
+                log.warn("Failed to prune %s: %s" % (db_path, e))
+            log.info("Expiring %d events from %s" % (removed, db_path))
 
-        def expire_db(db_path, lock):
-            remove = []
-            with lock:
-                db = anydbm.open(os.path.join(self.root, db_path), "c")
-                # The database returned by anydbm is guaranteed to have a
-                # .keys() method, but not necessarily .(iter)items().
-                for key in db.keys():
-                    if int(time.time() - float(db[key])) >= expiry_time:
-                        # Rounding to nearest int avoids an issue when we call
-                        # call prune(0) *immediately* after an insertion and might
-                        # get hit by floating point weirdness.
-                        remove.append(key)
-                log.info("Expiring %d events from %s" % (len(remove), db_path))
-                for key in remove:
-                    del db[key]
-                db.close()
 
-        return DeferredList(
-            [
-                deferToThread(expire_db, db_path, lock)
-                for db_path, lock in self.databases.items()
+class SQLiteEventDB(EventDBBase):
+    """
+    Record the events seen by this broker in an SQLite database.
+
+    All events are stored in a single table in ``root``, keyed by digest and
+    indexed by the time at which they were inserted, so that expired events
+    can be pruned without examining the rest of the table. Changes are
+    committed when `flush` is called.
+    """
+
+    FILENAME = "events.sqlite"
+
+    def __init__(self, root, hash_name=HASH_NAME, canonical=False):
+        EventDBBase.__init__(self, root, hash_name, canonical)
+        self._lock = Lock()
+        self._conn = None
+        with self._lock:
+            self._connect()
+
+    def _connect(self):
+        """
+        Return a connection to the database, opening it if necessary.
+
+        The caller must hold ``_lock``.
+        """
+        if self._conn is None:
+            self._conn = sqlite3.connect(
+                os.path.join(self.root, self.FILENAME), check_same_thread=False
+            )
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS events "
+                "(key TEXT PRIMARY KEY, inserted REAL NOT NULL) WITHOUT ROWID"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS events_inserted ON events (inserted)"
+            )
+            self._conn.commit()
+        return self._conn
+
+    def check_batch(self, batch):
+        """
+        Record a sequence of ``(db_path, key)`` pairs in a single transaction.
+        """
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            return [
+                conn.execute(
+                    "INSERT OR IGNORE INTO events (key, inserted) VALUES (?, ?)",
+                    (key, now),
+                ).rowcount
+                == 1
+                for db_path, key in batch
             ]
+
+    def _commit(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.commit()
+
+    def flush(self):
+        return deferToThread(self._commit)
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.commit()
+                self._conn.close()
+                self._conn = None
+
+    def prune(self, expiry_time):
+        """
+        Remove entries with age at least expiry_time seconds from the database.
+        """
+
+        def expire_db(cutoff):
+            with self._lock:
+                conn = self._connect()
+                removed = conn.execute(
+                    "DELETE FROM events WHERE inserted <= ?", (cutoff,)
+                ).rowcount
+                conn.commit()
+            log.info("Expiring %d events from %s" % (removed, self.FILENAME))
+
+        return deferToThread(expire_db, time.time() - expiry_time)
+
+
+class PartitionedEventDB(EventDBBase):
+    """
+    Record the events seen by this broker in time-partitioned dbm files.
+
+    Each partition holds the events first seen during a period of
+    ``partition_hours``. New events are written to the current partition;
+    lookups check every partition, newest first. Pruning removes whole
+    partitions once all the events they contain have expired, so files never
+    need to be rewritten. The consequence is that events may be remembered
+    for up to ``partition_hours`` longer than requested.
+    """
+
+    SUBDIR = "partitions"
+
+    def __init__(
+        self,
+        root,
+        partition_hours=PARTITION_HOURS,
+        hash_name=HASH_NAME,
+        canonical=False,
+    ):
+        EventDBBase.__init__(self, root, hash_name, canonical)
+        self.partition_length = int(partition_hours * 60 * 60)
+        self.partition_dir = self._ensure_dir(os.path.join(self.root, self.SUBDIR))
+
+        # Partitions are named for the time at which they start. We keep the
+        # start times sorted newest first, together with open handles to
+        # those partitions which have been used. Both are protected by _lock.
+        self._lock = Lock()
+        self._handles = {}
+        self._starts = sorted(
+            {
+                int(name.split(".")[0])
+                for name in os.listdir(self.partition_dir)
+                if name.split(".")[0].isdigit()
+            },
+            reverse=True,
         )
+
+    def _open(self, start):
+        """
+        Return an open handle to the partition starting at ``start``.
+
+        The caller must hold ``_lock``.
+        """
+        if start not in self._handles:
+            self._handles[start] = anydbm.open(
+                os.path.join(self.partition_dir, str(start)), "c"
+            )
+        return self._handles[start]
+
+    def _check_key(self, key, now):
+        """
+        Record ``key`` in the current partition unless it is already present.
+
+        The caller must hold ``_lock``.
+        """
+        for start in self._starts:
+            if key in self._open(start):
+                return False
+        current = int(now) - int(now) % self.partition_length
+        if not self._starts or self._starts[0] != current:
+            self._starts.insert(0, current)
+        self._open(current)[key] = str(now)
+        return True
+
+    def check_batch(self, batch):
+        """
+        Record a sequence of ``(db_path, key)`` pairs, in order.
+        """
+        now = time.time()
+        with self._lock:
+            return [self._check_key(key, now) for db_path, key in batch]
+
+    def _sync(self):
+        with self._lock:
+            for db in self._handles.values():
+                if hasattr(db, "sync"):
+                    db.sync()
+
+    def flush(self):
+        return deferToThread(self._sync)
+
+    def close(self):
+        with self._lock:
+            for db in self._handles.values():
+                db.close()
+            self._handles.clear()
+
+    def prune(self, expiry_time):
+        """
+        Remove partitions containing only events with age at least expiry_time
+        seconds.
+        """
+
+        def expire_partitions(horizon):
+            # Detach expired partitions while holding the lock; the slow work
+            # of removing the files happens without it.
+            with self._lock:
+                expired = [
+                    start
+                    for start in self._starts
+                    if start + self.partition_length <= horizon
+                ]
+                for start in expired:
+                    self._starts.remove(start)
+                    db = self._handles.pop(start, None)
+                    if db is not None:
+                        db.close()
+            log.info("Expiring %d partitions from %s" % (len(expired), self.root))
+            expired = {str(start) for start in expired}
+            for name in os.listdir(self.partition_dir):
+                if name.split(".")[0] in expired:
+                    os.unlink(os.path.join(self.partition_dir, name))
+
+        return deferToThread(expire_partitions, time.time() - expiry_time)
+
+
+class BatchingEventDB(object):
+    """
+    Coalesce checks against an event database into batches.
+
+    Calls to `check_event` made during a single iteration of the reactor are
+    collected, and then resolved together with a single call to the
+    ``check_batch`` method of ``event_db`` in a thread. A batch is dispatched
+    early if it reaches ``max_batch`` events. Events whose details are not
+    supplied are also hashed in that thread, rather than on the reactor.
+
+    Unlike the underlying database, `check_event` returns a
+    `~twisted.internet.defer.Deferred`; it should be called only from the
+    reactor thread.
+    """
+
+    def __init__(self, event_db, max_batch=MAX_BATCH_SIZE):
+        self.event_db = event_db
+        self.max_batch = max_batch
+        self._pending = []
+        self._delayed_call = None
+
+    def check_event(self, event, details=None):
+        """
+        Return a Deferred which fires with True if event is unseen, False
+        otherwise.
+        """
+        d = Deferred()
+        self._pending.append((event, details, d))
+        if len(self._pending) >= self.max_batch:
+            self._dispatch()
+        elif self._delayed_call is None:
+            self._delayed_call = reactor.callLater(0, self._dispatch)
+        return d
+
+    def _check_batch(self, batch):
+        """
+        Check a sequence of ``(event, details)`` pairs, calculating the
+        details where they are None.
+
+        Return a list containing, for each event in order, the result of
+        checking it, or a `~twisted.python.failure.Failure` if its details
+        could not be calculated.
+        """
+        results = [None] * len(batch)
+        described = []
+        for index, (event, details) in enumerate(batch):
+            try:
+                described.append(
+                    (index, details or self.event_db.get_event_details(event))
+                )
+            except Exception:
+                results[index] = Failure()
+        checked = self.event_db.check_batch([details for index, details in described])
+        for (index, details), result in zip(described, checked):
+            results[index] = result
+        return results
+
+    def _dispatch(self):
+        if self._delayed_call is not None:
+            if self._delayed_call.active():
+                self._delayed_call.cancel()
+            self._delayed_call = None
+        batch, self._pending = self._pending, []
+
+        def deliver(results):
+            for (event, details, d), result in zip(batch, results):
+                if isinstance(result, Failure):
+                    d.errback(result)
+                else:
+                    d.callback(result)
+
+        def deliver_failure(failure):
+            for event, details, d in batch:
+                d.errback(failure)
+
+        deferToThread(
+            self._check_batch, [(event, details) for event, details, d in batch]
+        ).addCallbacks(deliver, deliver_failure)
@@ -0,0 +1,297 @@
+# Comet VOEvent Broker.
+# Event database stored as a memory-mapped hash table.
+
+import mmap
+import os
+import struct
+import time
+from threading import Condition, Lock, Thread
+
+from twisted.internet.threads import deferToThread
+
+import comet.log as log
+from comet.utility.event_db import EventDBBase, HASH_NAME
+
+__all__ = ["MappedEventDB"]
+
+# The file starts with a header: a magic string, a format version, and the
+# number of slots and of occupied slots in the table.
+HEADER = struct.Struct("<8sIxxxxQQ")
+MAGIC = b"CometMap"
+VERSION = 1
+
+# Each slot holds a 20 byte digest and the time at which it was inserted in
+# whole seconds. A time of zero marks an empty slot.
+RECORD = struct.Struct("<20sI")
+DIGEST_SIZE = 20
+
+# By default, start with this many slots. When more than MAX_LOAD of the
+# slots are occupied, a larger table is built in the background; events are
+# still recorded in the current table until it is ready, unless more than
+# FULL_LOAD of its slots are occupied.
+MIN_CAPACITY = 1 << 16
+MAX_LOAD = 0.5
+FULL_LOAD = 0.9
+
+# When rebuilding the table, copy this many slots at a time.
+COPY_SLOTS = 1 << 14
+
+
+def _entries(data):
+    """
+    Iterate over (digest, insertion time) for all occupied slots in ``data``.
+    """
+    for digest, inserted in RECORD.iter_unpack(data):
+        if inserted:
+            yield digest, inserted
+
+
+def _capacity_for(count):
+    """Return a suitable table size for holding ``count`` entries."""
+    capacity = MIN_CAPACITY
+    while count > capacity * MAX_LOAD:
+        capacity *= 2
+    return capacity
+
+
+class _Table(object):
+    """
+    An open-addressing hash table of digests held in a memory-mapped file.
+
+    Not thread-safe: `MappedEventDB` serializes access.
+    """
+
+    def __init__(self, path, capacity=None):
+        self.path = path
+        if capacity is not None:
+            with open(path, "wb") as f:
+                f.write(HEADER.pack(MAGIC, VERSION, capacity, 0))
+                f.truncate(HEADER.size + capacity * RECORD.size)
+        self._file = open(path, "r+b")
+        self._map = mmap.mmap(self._file.fileno(), 0)
+        magic, version, self.capacity, self.count = HEADER.unpack_from(self._map)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise RuntimeError("%s is not a Comet event database." % (path,))
+        self._mask = self.capacity - 1
+
+    def insert(self, digest, inserted):
+        """
+        Insert ``digest`` unless it is already present.
+
+        Return True if it was inserted, False if it was already present.
+        """
+        slot = int.from_bytes(digest[:8], "little") & self._mask
+        while True:
+            offset = HEADER.size + slot * RECORD.size
+            existing, existing_inserted = RECORD.unpack_from(self._map, offset)
+            if not existing_inserted:
+                RECORD.pack_into(self._map, offset, digest, inserted)
+                self.count += 1
+                HEADER.pack_into(
+                    self._map, 0, MAGIC, VERSION, self.capacity, self.count
+                )
+                return True
+            elif existing == digest:
+                return False
+            slot = (slot + 1) & self._mask
+
+    def load(self):
+        """Return the fraction of slots which would be occupied by one more."""
+        return (self.count + 1) / self.capacity
+
+    def copy_slots(self, first, last):
+        """Return a copy of the slots from ``first`` up to ``last``."""
+        start = HEADER.size + first * RECORD.size
+        stop = HEADER.size + last * RECORD.size
+        return self._map[start:stop]
+
+    def flush(self):
+        self._map.flush()
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+
+class MappedEventDB(EventDBBase):
+    """
+    Record the events seen by this broker in a memory-mapped hash table.
+
+    Each event is stored as a fixed-width record, consisting of a binary
+    digest and a 32-bit insertion time, in an open-addressing hash table which
+    is mapped into memory from a single file in ``root``. Checking an event is
+    therefore a matter of a few memory operations. The table grows as
+    required, and is rebuilt without the expired entries when pruned. Either
+    way, the new table is built from a copy of the current one without
+    holding the lock, so events may be checked while this is in progress.
+    """
+
+    FILENAME = "events.map"
+
+    def __init__(self, root, hash_name=HASH_NAME, canonical=False):
+        EventDBBase.__init__(self, root, hash_name, canonical)
+        self.path = os.path.join(self.root, self.FILENAME)
+        self._lock = Lock()
+        self._table = None
+
+        # While the table is being rebuilt, the entries inserted since the
+        # rebuild started are recorded here, so they can be added to the new
+        # table. Only one rebuild takes place at a time; ``_rebuilt`` is
+        # notified when each finishes.
+        self._journal = None
+        self._rebuilt = Condition(self._lock)
+        self._grower = None
+
+        with self._lock:
+            self._open()
+
+    def _open(self):
+        """
+        Return the table, opening or creating it as required.
+
+        The caller must hold ``_lock``.
+        """
+        if self._table is None:
+            if os.path.exists(self.path):
+                self._table = _Table(self.path)
+            else:
+                self._table = _Table(self.path, MIN_CAPACITY)
+        return self._table
+
+    def _start_rebuild(self):
+        """
+        Start recording inserted entries in the journal, after waiting for any
+        other rebuild to finish. Return the current table, its number of
+        entries, and the number of entries which may be added to the journal
+        before the table is full.
+
+        The caller must hold ``_lock``.
+        """
+        while self._journal is not None:
+            self._rebuilt.wait()
+        self._journal = []
+        table = self._open()
+        headroom = int(table.capacity * FULL_LOAD) - table.count
+        return table, table.count, headroom
+
+    def _copy_entries(self, table):
+        """
+        Iterate over the entries in ``table``, copying COPY_SLOTS slots at a
+        time while holding ``_lock``. Entries inserted meanwhile may or may not
+        be included, but are recorded in the journal regardless.
+        """
+        for first in range(0, table.capacity, COPY_SLOTS):
+            with self._lock:
+                data = table.copy_slots(first, first + COPY_SLOTS)
+            yield from _entries(data)
+
+    def _rebuild(self, table, headroom, keep, suffix):
+        """
+        Build a new table from the entries in ``table`` (see `_start_rebuild`)
+        for which ``keep`` is true, with room for ``headroom`` more, then swap
+        it for the current one. Return the number of entries kept.
+
+        The caller must not hold ``_lock``: it is only taken briefly to copy
+        each part of the current table, then to add the entries recorded in
+        the journal and swap the tables.
+        """
+        try:
+            live = [entry for entry in self._copy_entries(table) if keep(entry)]
+            new_path = self.path + suffix
+            new_table = _Table(new_path, _capacity_for(len(live) + headroom))
+            for digest, inserted in live:
+                new_table.insert(digest, inserted)
+        except Exception:
+            with self._lock:
+                self._journal = None
+                self._rebuilt.notify_all()
+            raise
+        with self._lock:
+            for digest, inserted in self._journal:
+                new_table.insert(digest, inserted)
+            self._journal = None
+            new_table.close()
+            if self._table is not None:
+                self._table.close()
+            # Move the old table aside, and only delete it (which may take
+            # a while for a large file) once the lock is released.
+            old_path = self.path + ".old"
+            os.replace(self.path, old_path)
+            os.replace(new_path, self.path)
+            self._table = _Table(self.path)
+            self._rebuilt.notify_all()
+        os.remove(old_path)
+        return len(live)
+
+    def _grow(self, table, headroom):
+        try:
+            self._rebuild(table, headroom, lambda entry: True, ".resize")
+        except Exception as e:
+            log.warn("Failed to enlarge %s: %s" % (self.FILENAME, e))
+
+    def check_batch(self, batch):
+        """
+        Record a sequence of ``(db_path, key)`` pairs, in order.
+        """
+        now = int(time.time())
+        results = []
+        with self._lock:
+            table = self._open()
+            for db_path, key in batch:
+                digest = bytes.fromhex(key)[:DIGEST_SIZE]
+                while True:
+                    load = table.load()
+                    if load > MAX_LOAD and self._journal is None:
+                        current, _, headroom = self._start_rebuild()
+                        self._grower = Thread(
+                            target=self._grow,
+                            args=(current, headroom),
+                            name="comet-event-db-grow",
+                        )
+                        self._grower.start()
+                    if load <= FULL_LOAD:
+                        break
+                    # Wait for the table being built to replace this one.
+                    self._rebuilt.wait()
+                    table = self._open()
+                inserted = table.insert(digest, now)
+                if inserted and self._journal is not None:
+                    self._journal.append((digest, now))
+                results.append(inserted)
+        return results
+
+    def _sync(self):
+        with self._lock:
+            if self._table is not None:
+                self._table.flush()
+
+    def flush(self):
+        return deferToThread(self._sync)
+
+    def close(self):
+        if self._grower is not None:
+            self._grower.join()
+            self._grower = None
+        with self._lock:
+            if self._table is not None:
+                self._table.flush()
+                self._table.close()
+                self._table = None
+
+    def prune(self, expiry_time):
+        """
+        Remove entries with age at least expiry_time seconds from the database.
+        """
+
+        def rebuild(now):
+            # Take a copy of the table, then filter it without holding the
+            # lock. Events checked in the meantime are caught by the journal.
+            with self._lock:
+                table, count, headroom = self._start_rebuild()
+            kept = self._rebuild(
+                table, headroom, lambda entry: now - entry[1] < expiry_time, ".prune"
+            )
+            log.info("Expiring %d events from %s" % (count - kept, self.FILENAME))
+
+        return deferToThread(rebuild, int(time.time()))
@@ -0,0 +1,35 @@
+# Comet VOEvent Broker.
+# Tests for the bounded in-memory cache.
+
+from twisted.trial import unittest
+
+from comet.utility import LRUCache
+
+
+class LRUCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.cache = LRUCache(2)
+
+    def test_get(self):
+        self.cache["a"] = 1
+        self.assertEqual(self.cache.get("a"), 1)
+        self.assertIsNone(self.cache.get("b"))
+        self.assertEqual(self.cache.get("b", 2), 2)
+        self.assertEqual(self.cache.hits, 1)
+        self.assertEqual(self.cache.misses, 2)
+
+    def test_bounded(self):
+        # The least recently used entry is discarded when the cache is full.
+        self.cache["a"] = 1
+        self.cache["b"] = 2
+        self.cache.get("a")
+        self.cache["c"] = 3
+        self.assertEqual(len(self.cache), 2)
+        self.assertIn("a", self.cache)
+        self.assertNotIn("b", self.cache)
+        self.assertIn("c", self.cache)
+
+    def test_clear(self):
+        self.cache["a"] = 1
+        self.cache.clear()
+        self.assertEqual(len(self.cache), 0)
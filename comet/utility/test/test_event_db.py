@@ -7,17 +7,28 @@ import stat
 import tempfile
 import time
 from functools import reduce
+from io import BytesIO
 from itertools import repeat, permutations
 from multiprocessing.pool import ThreadPool
 from operator import __or__
 from sys import platform
 from unittest import skipIf
 
+try:
+    import anydbm
+except ImportError:
+    import dbm as anydbm
+
+import lxml.etree as etree
+from twisted.internet import defer
 from twisted.trial import unittest
 
-from comet.testutils import DummyEvent
-from comet.utility.event_db import Event_DB
-from comet.utility.voevent import BadIvoidError
+from comet.testutils import DUMMY_VOEVENT, DummyEvent
+import comet.utility.event_db
+from comet.utility.event_db import BatchingEventDB, Event_DB
+from comet.utility.event_db import PartitionedEventDB, SQLiteEventDB
+from comet.utility.event_db import SNAPSHOT_BLOCK, SNAPSHOT_MAGIC
+from comet.utility.voevent import BadIvoidError, VOEventMessage
 
 
 class Event_DB_TestCase(unittest.TestCase):
@@ -84,6 +95,202 @@ class Event_DB_TestCase(unittest.TestCase):
         d.addCallback(done_prune)
         return d
 
+    def test_handle_reused(self):
+        # Checking a second event from the same source should not re-open the
+        # database.
+        self.event_db.check_event(self.event)
+        db_path, _ = self.event_db.get_event_details(self.event)
+        handle = self.event_db._handles[db_path]
+        self.event_db.check_event(DummyEvent(b"ivo://comet.broker/test#other"))
+        self.assertIs(self.event_db._handles[db_path], handle)
+
+    def test_max_open(self):
+        # The least recently used handles are closed when too many are open,
+        # but the events they record are not forgotten.
+        event_db = Event_DB(self.event_db_dir, max_open=2)
+        events = [DummyEvent(b"ivo://comet.broker/test%d#1" % (i,)) for i in range(4)]
+        for event in events:
+            self.assertTrue(event_db.check_event(event))
+        self.assertEqual(len(event_db._handles), 2)
+        for event in events:
+            self.assertFalse(event_db.check_event(event))
+        self.assertEqual(len(event_db._handles), 2)
+        event_db.close()
+
+    def test_flush(self):
+        def done_flush(result):
+            # Flushing leaves the handle open.
+            self.assertEqual(len(self.event_db._handles), 1)
+            self.assertFalse(self.event_db.check_event(self.event))
+
+        self.event_db.check_event(self.event)
+        return self.event_db.flush().addCallback(done_flush)
+
+    def test_close(self):
+        # Events are persisted when the database is closed, and it can be
+        # re-opened by another instance.
+        self.event_db.check_event(self.event)
+        self.event_db.close()
+        self.assertEqual(len(self.event_db._handles), 0)
+        self.assertFalse(self.event_db.check_event(self.event))
+        self.event_db.close()
+        other_db = Event_DB(self.event_db_dir)
+        self.assertFalse(other_db.check_event(self.event))
+        other_db.close()
+
+    def test_check_batch(self):
+        # Duplicates within a batch are detected, and results returned in
+        # order.
+        other_event = DummyEvent(b"ivo://comet.broker/other#1")
+        batch = [
+            self.event_db.get_event_details(event)
+            for event in [self.event, other_event, self.event]
+        ]
+        self.assertEqual(self.event_db.check_batch(batch), [True, True, False])
+        self.assertEqual(self.event_db.check_batch(batch), [False, False, False])
+
+    def test_discover_databases(self):
+        # Databases written by a previous instance are found on startup, and
+        # hence pruned.
+        def done_prune(result):
+            self.assertTrue(event_db.check_event(self.event))
+            event_db.close()
+
+        self.event_db.check_event(self.event)
+        self.event_db.close()
+        db_path, _ = self.event_db.get_event_details(self.event)
+        event_db = Event_DB(self.event_db_dir)
+        self.assertEqual(list(event_db.databases), [db_path])
+        return event_db.prune(0).addCallback(done_prune)
+
+    def test_ignore_foreign_databases(self):
+        # Other programs' files in the same directory are left alone.
+        for name in ("foreign", "not ours!"):
+            db = anydbm.open(os.path.join(self.event_db_dir, name), "c")
+            db["setting"] = "0"
+            db.close()
+        self.event_db.check_event(self.event)
+        db_path, key = self.event_db.get_event_details(self.event)
+        with self.event_db.databases[db_path]:
+            self.event_db._open(db_path)["setting"] = "0"
+        self.event_db.close()
+        event_db = Event_DB(self.event_db_dir)
+        self.assertEqual(list(event_db.databases), [db_path])
+
+        def done_prune(result):
+            self.assertEqual(event_db._keys(db_path), [b"setting"])
+            event_db.close()
+            db = anydbm.open(os.path.join(self.event_db_dir, "foreign"), "r")
+            self.assertEqual(db["setting"], b"0")
+            db.close()
+
+        return event_db.prune(0).addCallback(done_prune)
+
+    def test_skip_unreadable_databases(self):
+        # A database which can't be read doesn't prevent us reading the rest.
+        events = [DummyEvent(b"ivo://comet.broker/%d#1" % (i,)) for i in range(2)]
+        for event in events:
+            self.event_db.check_event(event)
+        bad_path, _ = self.event_db.get_event_details(events[0])
+        keys = self.event_db._keys
+
+        def failing_keys(db_path):
+            if db_path == bad_path:
+                raise OSError("locked")
+            return keys(db_path)
+
+        self.patch(self.event_db, "_keys", failing_keys)
+        self.assertEqual(
+            self.event_db.recent(3600), [self.event_db.get_event_details(events[1])]
+        )
+        self.assertEqual(self.event_db.export_snapshot(BytesIO()), 1)
+
+    def test_prune_slices(self):
+        # Pruning a few keys at a time gives the same results.
+        def done_prune(result):
+            for event in events:
+                self.assertTrue(event_db.check_event(event))
+            event_db.close()
+
+        event_db = Event_DB(self.event_db_dir, prune_slice=2)
+        events = [DummyEvent(b"ivo://comet.broker/test#%d" % (i,)) for i in range(5)]
+        for event in events:
+            event_db.check_event(event)
+        return event_db.prune(0).addCallback(done_prune)
+
+    def test_snapshot(self):
+        # Events exported from one database are seen by another on import.
+        events = [DummyEvent(b"ivo://comet.broker/test#%d" % (i,)) for i in range(5)]
+        for event in events[:3]:
+            self.event_db.check_event(event)
+        snapshot = BytesIO()
+        self.assertEqual(self.event_db.export_snapshot(snapshot), 3)
+
+        other_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, other_dir)
+        other_db = Event_DB(other_dir)
+        other_db.check_event(events[0])
+        self.assertEqual(other_db.import_snapshot(BytesIO(snapshot.getvalue())), 2)
+        self.assertEqual(
+            [other_db.check_event(event) for event in events],
+            [False, False, False, True, True],
+        )
+        other_db.close()
+
+    def test_bad_snapshot(self):
+        snapshot = BytesIO()
+        self.event_db.check_event(self.event)
+        self.event_db.export_snapshot(snapshot)
+        truncated = snapshot.getvalue()[:-1]
+        escaping = SNAPSHOT_MAGIC + SNAPSHOT_BLOCK.pack(5, 0) + b"../db"
+        for bad in (b"", b"garbage", truncated, escaping):
+            self.assertRaises(RuntimeError, self.event_db.import_snapshot, BytesIO(bad))
+
+    def test_recent(self):
+        # Only recent events are returned, oldest first.
+        old, new = [DummyEvent(b"ivo://comet.broker/test#%d" % (i,)) for i in range(2)]
+        self.event_db.check_event(new)
+        db_path, key = self.event_db.get_event_details(old)
+        with self.event_db.databases[db_path]:
+            self.event_db._open(db_path)[key] = str(time.time() - 7200)
+        self.assertEqual(
+            self.event_db.recent(3600), [self.event_db.get_event_details(new)]
+        )
+        self.assertEqual(
+            self.event_db.recent(10800),
+            [
+                self.event_db.get_event_details(old),
+                self.event_db.get_event_details(new),
+            ],
+        )
+
+    def test_hash(self):
+        # The hash function is configurable, and its use is measured.
+        db_path, key = self.event_db.get_event_details(self.event)
+        self.assertEqual(self.event_db.hash_count, 1)
+        self.assertTrue(self.event_db.hash_time >= 0)
+        # Memoized digests aren't counted again.
+        self.event_db.get_event_details(self.event)
+        self.assertEqual(self.event_db.hash_count, 1)
+        event_db = Event_DB(self.event_db_dir, hash_name="blake2b")
+        blake_path, blake_key = event_db.get_event_details(self.event)
+        self.assertEqual(blake_path, db_path)
+        self.assertEqual(len(blake_key), len(key))
+        self.assertNotEqual(blake_key, key)
+        self.assertRaises(KeyError, Event_DB, self.event_db_dir, hash_name="bad")
+
+    def test_canonical(self):
+        # Re-serialized copies of an event are recognized.
+        event_db = Event_DB(self.event_db_dir, canonical=True)
+        event = VOEventMessage(DUMMY_VOEVENT)
+        reserialized = VOEventMessage(
+            etree.tostring(event.element, encoding="UTF-8", pretty_print=False)
+        )
+        self.assertNotEqual(event.raw_bytes, reserialized.raw_bytes)
+        self.assertTrue(event_db.check_event(event))
+        self.assertFalse(event_db.check_event(reserialized))
+        event_db.close()
+
     def test_bad_ivoid(self):
         bad_event = DummyEvent(b"ivo://#")
         with self.assertRaises(BadIvoidError):
@@ -111,4 +318,195 @@ class Event_DB_TestCase(unittest.TestCase):
         return d
 
     def tearDown(self):
+        self.event_db.close()
+        shutil.rmtree(self.event_db_dir)
+
+
+class SQLiteEventDBTestCase(unittest.TestCase):
+    def setUp(self):
+        self.event_db_dir = tempfile.mkdtemp()
+        self.event_db = SQLiteEventDB(self.event_db_dir)
+        self.event = DummyEvent()
+
+    def test_dir_is_file(self):
+        filename = "event_db_test_is_file_%.5f" % (time.time(),)
+        open(filename, "w").close()
+        self.assertRaises(RuntimeError, SQLiteEventDB, filename)
+
+    def test_unseen(self):
+        self.assertTrue(self.event_db.check_event(self.event))
+
+    def test_seen(self):
+        self.event_db.check_event(self.event)
+        self.assertFalse(self.event_db.check_event(self.event))
+
+    def test_threadsafe(self):
+        pool = ThreadPool(10)
+        results = pool.map(self.event_db.check_event, repeat(self.event, 1000))
+        self.assertEqual(results.count(True), 1)
+        self.assertEqual(results.count(False), 999)
+
+    def test_bad_ivoid(self):
+        with self.assertRaises(BadIvoidError):
+            self.event_db.check_event(DummyEvent(b"ivo://#"))
+
+    def test_prune(self):
+        def done_prune(result):
+            self.assertTrue(self.event_db.check_event(self.event))
+
+        self.event_db.check_event(self.event)
+        d = self.event_db.prune(0)
+        d.addCallback(done_prune)
+        return d
+
+    def test_prune_keeps_recent(self):
+        def done_prune(result):
+            self.assertFalse(self.event_db.check_event(self.event))
+
+        self.event_db.check_event(self.event)
+        d = self.event_db.prune(60)
+        d.addCallback(done_prune)
+        return d
+
+    def test_flush(self):
+        # Once flushed, events are visible to other connections.
+        def done_flush(result):
+            other_db = SQLiteEventDB(self.event_db_dir)
+            self.assertFalse(other_db.check_event(self.event))
+            other_db.close()
+
+        self.event_db.check_event(self.event)
+        return self.event_db.flush().addCallback(done_flush)
+
+    def test_close(self):
+        # Events are persisted on close, and the database re-opened on demand.
+        self.event_db.check_event(self.event)
+        self.event_db.close()
+        self.assertFalse(self.event_db.check_event(self.event))
+
+    def tearDown(self):
+        self.event_db.close()
+        shutil.rmtree(self.event_db_dir)
+
+
+class MockTime(object):
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+class PartitionedEventDBTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = MockTime(1000000.0)
+        self.patch(comet.utility.event_db, "time", self.clock)
+        self.event_db_dir = tempfile.mkdtemp()
+        self.event_db = PartitionedEventDB(self.event_db_dir, partition_hours=1)
+        self.event = DummyEvent()
+
+    def test_unseen(self):
+        self.assertTrue(self.event_db.check_event(self.event))
+
+    def test_seen(self):
+        self.event_db.check_event(self.event)
+        self.assertFalse(self.event_db.check_event(self.event))
+
+    def test_threadsafe(self):
+        pool = ThreadPool(10)
+        results = pool.map(self.event_db.check_event, repeat(self.event, 1000))
+        self.assertEqual(results.count(True), 1)
+        self.assertEqual(results.count(False), 999)
+
+    def test_seen_in_old_partition(self):
+        # Events recorded in earlier partitions are still found.
+        self.event_db.check_event(self.event)
+        self.clock.now += 3 * 60 * 60
+        self.assertTrue(self.event_db.check_event(DummyEvent(b"ivo://test/new#1")))
+        self.assertEqual(len(self.event_db._starts), 2)
+        self.assertFalse(self.event_db.check_event(self.event))
+
+    def test_prune(self):
+        def done_prune(result):
+            self.assertEqual(len(self.event_db._starts), 1)
+            self.assertTrue(self.event_db.check_event(self.event))
+            self.assertFalse(self.event_db.check_event(new_event))
+
+        new_event = DummyEvent(b"ivo://test/new#1")
+        self.event_db.check_event(self.event)
+        self.clock.now += 3 * 60 * 60
+        self.event_db.check_event(new_event)
+        n_files = len(os.listdir(self.event_db.partition_dir))
+
+        # Only the older partition is entirely older than the horizon.
+        d = self.event_db.prune(2 * 60 * 60)
+        d.addCallback(
+            lambda result: self.assertLess(
+                len(os.listdir(self.event_db.partition_dir)), n_files
+            )
+        )
+        d.addCallback(done_prune)
+        return d
+
+    def test_discover_partitions(self):
+        # Partitions written by a previous instance are found on startup.
+        self.event_db.check_event(self.event)
+        self.event_db.close()
+        event_db = PartitionedEventDB(self.event_db_dir, partition_hours=1)
+        self.assertFalse(event_db.check_event(self.event))
+        event_db.close()
+
+    def tearDown(self):
+        self.event_db.close()
+        shutil.rmtree(self.event_db_dir)
+
+
+class BatchingEventDBTestCase(unittest.TestCase):
+    def setUp(self):
+        self.event_db_dir = tempfile.mkdtemp()
+        self.event_db = Event_DB(self.event_db_dir)
+        self.batches = []
+        check_batch = self.event_db.check_batch
+
+        def counting_check_batch(batch):
+            self.batches.append(len(batch))
+            return check_batch(batch)
+
+        self.event_db.check_batch = counting_check_batch
+        self.event = DummyEvent()
+
+    def test_single_batch(self):
+        # Checks made together are resolved in a single batch, and duplicates
+        # within the batch are detected.
+        def check_results(results):
+            self.assertEqual(results, [True, False, True])
+            self.assertEqual(self.batches, [3])
+
+        batcher = BatchingEventDB(self.event_db)
+        d = defer.gatherResults(
+            [
+                batcher.check_event(self.event),
+                batcher.check_event(self.event),
+                batcher.check_event(DummyEvent(b"ivo://comet.broker/other#1")),
+            ]
+        )
+        return d.addCallback(check_results)
+
+    def test_max_batch(self):
+        def check_results(results):
+            self.assertEqual(results, [True, False, False])
+            self.assertEqual(self.batches, [2, 1])
+
+        batcher = BatchingEventDB(self.event_db, max_batch=2)
+        d = defer.gatherResults([batcher.check_event(self.event) for i in range(3)])
+        return d.addCallback(check_results)
+
+    def test_bad_ivoid(self):
+        batcher = BatchingEventDB(self.event_db)
+        return self.assertFailure(
+            batcher.check_event(DummyEvent(b"ivo://#")), BadIvoidError
+        )
+
+    def tearDown(self):
+        self.event_db.close()
         shutil.rmtree(self.event_db_dir)
@@ -0,0 +1,135 @@
+# Comet VOEvent Broker.
+# Memory-mapped event database tests.
+
+import os
+import shutil
+import tempfile
+import time
+from hashlib import sha1
+from itertools import repeat
+from multiprocessing.pool import ThreadPool
+from threading import Event
+
+from twisted.trial import unittest
+
+from comet.testutils import DummyEvent
+import comet.utility.mapped_event_db
+from comet.utility.mapped_event_db import MappedEventDB
+from comet.utility.voevent import BadIvoidError
+
+
+def make_batch(count):
+    return [("db", sha1(str(i).encode()).hexdigest()) for i in range(count)]
+
+
+class MappedEventDBTestCase(unittest.TestCase):
+    def setUp(self):
+        self.event_db_dir = tempfile.mkdtemp()
+        self.event_db = MappedEventDB(self.event_db_dir)
+        self.event = DummyEvent()
+
+    def test_dir_is_file(self):
+        filename = "event_db_test_is_file_%.5f" % (time.time(),)
+        open(filename, "w").close()
+        self.assertRaises(RuntimeError, MappedEventDB, filename)
+
+    def test_not_a_table(self):
+        # Refuse to use a file which we didn't create.
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        with open(os.path.join(root, MappedEventDB.FILENAME), "wb") as f:
+            f.write(b"\0" * 1024)
+        self.assertRaises(RuntimeError, MappedEventDB, root)
+
+    def test_unseen(self):
+        self.assertTrue(self.event_db.check_event(self.event))
+
+    def test_seen(self):
+        self.event_db.check_event(self.event)
+        self.assertFalse(self.event_db.check_event(self.event))
+
+    def test_threadsafe(self):
+        pool = ThreadPool(10)
+        results = pool.map(self.event_db.check_event, repeat(self.event, 1000))
+        self.assertEqual(results.count(True), 1)
+        self.assertEqual(results.count(False), 999)
+
+    def test_bad_ivoid(self):
+        with self.assertRaises(BadIvoidError):
+            self.event_db.check_event(DummyEvent(b"ivo://#"))
+
+    def test_check_batch(self):
+        batch = make_batch(10)
+        self.assertEqual(
+            self.event_db.check_batch(batch + batch[:1]), [True] * 10 + [False]
+        )
+
+    def test_grow(self):
+        # The table is enlarged as it fills, without losing entries.
+        self.patch(comet.utility.mapped_event_db, "MIN_CAPACITY", 8)
+        event_db = MappedEventDB(tempfile.mkdtemp(dir=self.event_db_dir))
+        batch = make_batch(100)
+        self.assertTrue(all(event_db.check_batch(batch)))
+        self.assertFalse(any(event_db.check_batch(batch)))
+        event_db._grower.join()
+        self.assertEqual(event_db._table.count, 100)
+        self.assertTrue(event_db._table.capacity >= 200)
+        event_db.close()
+
+    def test_check_while_growing(self):
+        # Events are recorded in the current table while a larger one is
+        # being built, and are carried over to it.
+        self.patch(comet.utility.mapped_event_db, "MIN_CAPACITY", 64)
+        event_db = MappedEventDB(tempfile.mkdtemp(dir=self.event_db_dir))
+        release = Event()
+        grow = event_db._grow
+
+        def blocked_grow(*args):
+            release.wait()
+            grow(*args)
+
+        event_db._grow = blocked_grow
+        batch = make_batch(50)
+        self.assertTrue(all(event_db.check_batch(batch[:40])))
+        self.assertIsNotNone(event_db._journal)
+        self.assertEqual(event_db._table.capacity, 64)
+        self.assertTrue(all(event_db.check_batch(batch[40:])))
+        release.set()
+        event_db._grower.join()
+        self.assertIsNone(event_db._journal)
+        self.assertGreater(event_db._table.capacity, 64)
+        self.assertFalse(any(event_db.check_batch(batch)))
+        self.assertEqual(event_db._table.count, 50)
+        event_db.close()
+
+    def test_prune(self):
+        def done_prune(result):
+            self.assertTrue(self.event_db.check_event(self.event))
+
+        self.event_db.check_event(self.event)
+        d = self.event_db.prune(0)
+        d.addCallback(done_prune)
+        return d
+
+    def test_prune_keeps_recent(self):
+        def done_prune(result):
+            self.assertFalse(self.event_db.check_event(self.event))
+
+        self.event_db.check_event(self.event)
+        d = self.event_db.prune(60)
+        d.addCallback(done_prune)
+        return d
+
+    def test_close(self):
+        # Events are persisted on close, and the table re-opened on demand.
+        self.event_db.check_event(self.event)
+        self.event_db.close()
+        self.assertFalse(self.event_db.check_event(self.event))
+        self.event_db.close()
+        other_db = MappedEventDB(self.event_db_dir)
+        self.assertFalse(other_db.check_event(self.event))
+        other_db.close()
+
+    def tearDown(self):
+        self.event_db.close()
+        shutil.rmtree(self.event_db_dir)
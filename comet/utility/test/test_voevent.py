@@ -3,13 +3,16 @@
 
 import os
 import string
+import time
+from hashlib import sha1
+
 import lxml.etree as etree
 
 from twisted.trial import unittest
 
 import comet
 from comet.utility import VOEventMessage, parse_ivoid, BadIvoidError
-from comet.testutils import DUMMY_SERVICE_IVOID
+from comet.testutils import DUMMY_SERVICE_IVOID, DUMMY_VOEVENT
 
 
 class broker_test_messageTestCase(unittest.TestCase):
@@ -25,6 +28,54 @@ class broker_test_messageTestCase(unittest.TestCase):
         self.assertTrue(self.message.ivoid.startswith(DUMMY_SERVICE_IVOID.decode()))
 
 
+class VOEventMessageTestCase(unittest.TestCase):
+    def setUp(self):
+        self.before = time.time()
+        self.event = VOEventMessage(DUMMY_VOEVENT)
+
+    def test_metadata(self):
+        self.assertEqual(self.event.ivoid, "ivo://comet.broker/test#1234567890")
+        self.assertEqual(
+            self.event.ivoid_parts, ("comet.broker", "/test", "1234567890")
+        )
+        self.assertEqual(self.event.size, len(DUMMY_VOEVENT))
+        self.assertEqual(self.event.digest(sha1), sha1(DUMMY_VOEVENT).hexdigest())
+        self.assertEqual(self.event.encoding, "UTF-8")
+        self.assertEqual(self.event.author_ivoid, "ivo://comet.broker/test")
+        self.assertEqual(self.event.date, "2012-01-01T00:00:00")
+        self.assertTrue(self.before <= self.event.received <= time.time())
+
+    def test_lazy(self):
+        # The same details are available from an event which has only been
+        # partly parsed.
+        event = VOEventMessage(DUMMY_VOEVENT, lazy=True)
+        self.assertEqual(event.ivoid_parts, self.event.ivoid_parts)
+        self.assertIsNone(event._element)
+        self.assertTrue(self.before <= event.received <= time.time())
+
+    def test_memoized(self):
+        self.assertIs(self.event.ivoid_parts, self.event.ivoid_parts)
+        self.assertIs(self.event.digest(sha1), self.event.digest(sha1))
+        self.assertIs(self.event.encoding, self.event.encoding)
+
+    def test_forget(self):
+        # Nothing is remembered across changes to the event.
+        self.event.digest(sha1)
+        self.event.ivoid_parts
+        self.event.author_ivoid
+        other = DUMMY_VOEVENT.replace(b"test#", b"other#").replace(
+            b"2012-01-01", b"2013-01-01"
+        )
+        self.event.raw_bytes = other
+        self.assertEqual(self.event.digest(sha1), sha1(other).hexdigest())
+        self.assertEqual(self.event.ivoid_parts[1], "/other")
+        self.assertEqual(self.event.date, "2013-01-01T00:00:00")
+
+    def test_bad_ivoid(self):
+        event = VOEventMessage(DUMMY_VOEVENT.replace(b"ivo://comet", b"ivo://#"))
+        self.assertRaises(BadIvoidError, getattr, event, "ivoid_parts")
+
+
 class parse_ivoidTestCase(unittest.TestCase):
     # Character classes as defined by the IVOA Identifiers spec, 1.12
     ALPHANUM = string.ascii_letters + string.digits
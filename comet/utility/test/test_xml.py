@@ -1,14 +1,20 @@
 # Comet VOEvent Broker.
 # Tests for XML parsing.
 
+import os
 import textwrap
+import threading
 import lxml.etree as etree
+from hashlib import sha1
 from io import BytesIO
 
 from twisted.trial import unittest
 
+import comet
+import comet.utility.xml
 from comet.testutils import DUMMY_IAMALIVE, DUMMY_VOEVENT, DUMMY_EVENT_IVOID
-from comet.utility import xml_document, ParseError
+from comet.utility import xml_document, ParseError, canonical_form
+from comet.utility import IncrementalParser
 from comet.utility import VOEventMessage
 from comet.protocol import TransportMessage
 
@@ -70,6 +76,113 @@ class xml_document_from_element_TestCase(unittest.TestCase, xml_document_tests):
         self.doc = xml_document(etree.fromstring(EXAMPLE_XML))
 
 
+class xml_document_lazy_TestCase(unittest.TestCase):
+    def test_voevent(self):
+        # The root attributes are available without parsing the whole
+        # document.
+        doc = VOEventMessage(DUMMY_VOEVENT, lazy=True)
+        self.assertIsNone(doc._element)
+        self.assertEqual(doc.role, "test")
+        self.assertEqual(doc.ivoid, DUMMY_EVENT_IVOID.decode())
+        self.assertIsNone(doc._element)
+        self.assertIsInstance(doc.element, etree._Element)
+        self.assertEqual(doc.ivoid, DUMMY_EVENT_IVOID.decode())
+
+    def test_transport(self):
+        doc = TransportMessage(DUMMY_IAMALIVE, lazy=True)
+        self.assertEqual(doc.role, "iamalive")
+        origin = etree.fromstring(DUMMY_IAMALIVE).findtext("Origin")
+        self.assertEqual(doc.origin, origin)
+        self.assertIsNone(doc._element)
+
+    def test_infer_type(self):
+        msg = xml_document.infer_type(DUMMY_IAMALIVE, lazy=True)
+        self.assertIsInstance(msg, TransportMessage)
+        self.assertEqual(msg.role, "iamalive")
+        self.assertIsNone(msg._element)
+
+    def test_malformed(self):
+        # Errors after the header are only found when the tree is built.
+        padding = b" " * 8192
+        doc = xml_document(
+            b"<foo role='ack'><Origin>x</Origin>" + padding + b"<bar></foo>",
+            lazy=True,
+        )
+        self.assertEqual(doc.role, "ack")
+        self.assertRaises(ParseError, getattr, doc, "element")
+
+    def test_unparsable(self):
+        self.assertRaises(ParseError, xml_document, b"not xml", lazy=True)
+        self.assertRaises(ParseError, xml_document, u"<foo/>", lazy=True)
+
+    def test_dtd(self):
+        # Documents with a DTD are always parsed in full, and hence refused.
+        self.assertRaises(
+            ParseError,
+            xml_document,
+            b'<!DOCTYPE foo [<!ENTITY a "b">]><foo role="ack">c</foo>',
+            lazy=True,
+        )
+
+
+class canonical_form_TestCase(unittest.TestCase):
+    def test_formatting_ignored(self):
+        # Documents which differ only in their formatting are equivalent.
+        compact = b'<a:foo xmlns:a="urn:x" b="1" c="2"><bar>baz</bar></a:foo>'
+        reformatted = (
+            b"<?xml version='1.0' encoding='ISO-8859-1'?>\n"
+            b'<x:foo xmlns:x="urn:x" c="2" b="1">\n'
+            b"  <!-- A comment -->\n"
+            b"  <bar>\n    baz\n  </bar>\n"
+            b"</x:foo>\n"
+        )
+        self.assertEqual(
+            canonical_form(etree.fromstring(compact)),
+            canonical_form(etree.fromstring(reformatted)),
+        )
+
+    def test_text_after_comment(self):
+        # Text which follows a comment is part of the content.
+        good = canonical_form(etree.fromstring(b"<a>x<!--c-->GOOD<b/></a>"))
+        evil = canonical_form(etree.fromstring(b"<a>x<!--c-->EVIL<b/></a>"))
+        self.assertNotEqual(good, evil)
+        self.assertEqual(good, canonical_form(etree.fromstring(b"<a>xGOOD<b/></a>")))
+
+    def test_content_matters(self):
+        original = b'<a:foo xmlns:a="urn:x" b="1" c="2"><bar>baz</bar></a:foo>'
+        for other in (
+            b'<a:foo xmlns:a="urn:y" b="1" c="2"><bar>baz</bar></a:foo>',
+            b'<a:foo xmlns:a="urn:x" b="1" c="3"><bar>baz</bar></a:foo>',
+            b'<a:foo xmlns:a="urn:x" b="1" c="2"><bar>bat</bar></a:foo>',
+            b'<a:foo xmlns:a="urn:x" b="1" c="2"><bar/>baz</a:foo>',
+            b'<a:foo xmlns:a="urn:x" b="1" c="2"><bar>baz<!--c-->bat</bar></a:foo>',
+            b'<a:foo xmlns:a="urn:x" b="1" c="2"><bar>baz</bar><!--c-->bat</a:foo>',
+        ):
+            self.assertNotEqual(
+                canonical_form(etree.fromstring(original)),
+                canonical_form(etree.fromstring(other)),
+            )
+
+    def test_content_digest(self):
+        # The digest is calculated once, and recalculated if the document
+        # changes.
+        calls = []
+
+        def counting_sha1(data):
+            calls.append(data)
+            return sha1(data)
+
+        doc = xml_document(b"<foo>bar</foo>")
+        digest = doc.content_digest(counting_sha1)
+        self.assertEqual(doc.content_digest(counting_sha1), digest)
+        self.assertEqual(len(calls), 1)
+        doc.raw_bytes = b"<foo>baz</foo>"
+        self.assertNotEqual(doc.content_digest(counting_sha1), digest)
+        self.assertEqual(len(calls), 2)
+        doc.element = etree.fromstring(b"<foo>bar</foo>")
+        self.assertEqual(doc.content_digest(counting_sha1), digest)
+
+
 class xml_security_TestCase(unittest.TestCase):
     """
     Refuse to parse any dangerous XML.
@@ -132,6 +245,107 @@ class xml_security_TestCase(unittest.TestCase):
         self.assertRaises(ParseError, xml_document, xml_str)
 
 
+class xml_limits_TestCase(unittest.TestCase):
+    """
+    Refuse to parse documents which are excessively large or complex.
+    """
+
+    def test_max_size(self):
+        self.patch(comet.utility.xml, "MAX_SIZE", 16)
+        xml_document(b"<foo>bar</foo>")
+        self.assertRaises(ParseError, xml_document, b"<foo>barbarbar</foo>")
+        self.assertRaises(ParseError, xml_document, b"<foo>barbarbar</foo>", lazy=True)
+
+    def test_max_nodes(self):
+        self.patch(comet.utility.xml, "MAX_NODES", 4)
+        xml_document(b"<foo><bar/><bar/></foo>")
+        self.assertRaises(ParseError, xml_document, b"<foo><bar/><bar/><bar/></foo>")
+
+    def test_max_depth(self):
+        self.patch(comet.utility.xml, "MAX_DEPTH", 3)
+        xml_document(b"<a><b><c/></b></a>")
+        self.assertRaises(ParseError, xml_document, b"<a><b><c><d/></c></b></a>")
+
+    def test_doctype(self):
+        # Even harmless DTDs are refused.
+        self.assertRaises(ParseError, xml_document, b"<!DOCTYPE foo><foo/>")
+
+    def test_set_limits(self):
+        for name in ("MAX_SIZE", "MAX_NODES", "MAX_DEPTH"):
+            self.patch(comet.utility.xml, name, getattr(comet.utility.xml, name))
+        comet.utility.xml.set_limits(max_depth=2)
+        self.assertEqual(comet.utility.xml.MAX_DEPTH, 2)
+        self.assertRaises(ParseError, xml_document, b"<a><b><c/></b></a>")
+        comet.utility.xml.set_limits(max_size=8)
+        self.assertEqual(comet.utility.xml.MAX_DEPTH, 2)
+        self.assertRaises(ParseError, xml_document, b"<a>bar</a>")
+
+    def test_parser_reused_after_error(self):
+        # A parser which has been used for a bad document is ready to parse
+        # another, subject to the same checks.
+        self.patch(comet.utility.xml, "MAX_DEPTH", 3)
+        for bad in (b"<a><b></a>", b"<a><b><c><d/></c></b></a>", b"<a>"):
+            self.assertRaises(ParseError, xml_document, bad)
+            xml_document(b"<a><b/></a>")
+        self.assertRaises(ParseError, xml_document, b"<!DOCTYPE a><a/>")
+        self.assertRaises(ParseError, xml_document, b"<a><b><c><d/></c></b></a>")
+
+    def test_parser_per_thread(self):
+        # Parsers are reused within a thread, but not shared between threads.
+        parser = comet.utility.xml._get_parser()
+        self.assertIs(comet.utility.xml._get_parser(), parser)
+        other = []
+        thread = threading.Thread(
+            target=lambda: other.append(comet.utility.xml._get_parser())
+        )
+        thread.start()
+        thread.join()
+        self.assertIsNot(other[0], parser)
+
+
+class IncrementalParser_TestCase(unittest.TestCase):
+    def _parse(self, raw_bytes, size=7):
+        parser = IncrementalParser()
+        for start in range(0, len(raw_bytes), size):
+            stop = start + size
+            parser.feed(raw_bytes[start:stop])
+        return parser
+
+    def test_parse(self):
+        element = self._parse(DUMMY_VOEVENT).close()
+        self.assertEqual(
+            canonical_form(element), canonical_form(etree.fromstring(DUMMY_VOEVENT))
+        )
+
+    def test_early_error(self):
+        # Errors are detected as soon as the offending data arrives.
+        parser = self._parse(b"<foo></bar>")
+        self.assertIsInstance(parser.error, ParseError)
+        self.assertRaises(ParseError, parser.close)
+
+    def test_incomplete(self):
+        self.assertRaises(ParseError, self._parse(b"<foo><bar/>").close)
+
+    def test_limits(self):
+        self.patch(comet.utility.xml, "MAX_SIZE", 16)
+        self.assertIsNotNone(self._parse(b"<foo>barbarbar</foo>").error)
+        self.patch(comet.utility.xml, "MAX_SIZE", 1024)
+        self.patch(comet.utility.xml, "MAX_NODES", 4)
+        self.assertIsNotNone(self._parse(b"<foo><bar/><bar/><bar/></foo>").error)
+        self.patch(comet.utility.xml, "MAX_DEPTH", 3)
+        self.assertRaises(ParseError, self._parse(b"<a><b><c><d/></c></b></a>").close)
+
+    def test_doctype(self):
+        self.assertRaises(ParseError, self._parse(b"<!DOCTYPE foo><foo/>").close)
+
+    def test_limits_enforced_while_parsing(self):
+        # Documents which break the limits are refused as soon as they do,
+        # without parsing the rest.
+        self.patch(comet.utility.xml, "MAX_DEPTH", 3)
+        self.assertIsNotNone(self._parse(b"<a><b><c><d>").error)
+        self.assertIsNotNone(self._parse(b"<!DOCTYPE foo><foo><bar>").error)
+
+
 class xml_document_infer_type_TestCase(unittest.TestCase):
     def _assertTransport(self, doc, role):
         self.assertIsInstance(doc, TransportMessage)
@@ -153,6 +367,84 @@ class xml_document_infer_type_TestCase(unittest.TestCase):
     def test_bad_parse(self):
         self.assertRaises(ParseError, xml_document.infer_type, EXAMPLE_XML)
 
+    def test_single_parse(self):
+        # Each payload is parsed only once.
+        calls = []
+        original = xml_document.__dict__["_parse"]
+        parse = xml_document._parse
+
+        def counting_parse(raw_bytes):
+            calls.append(raw_bytes)
+            return parse(raw_bytes)
+
+        # Not self.patch(), which would restore a plain function rather than
+        # the staticmethod.
+        self.addCleanup(setattr, xml_document, "_parse", original)
+        xml_document._parse = staticmethod(counting_parse)
+        msg = xml_document.infer_type(DUMMY_VOEVENT)
+        self.assertEqual(calls, [DUMMY_VOEVENT])
+        self.assertEqual(msg.raw_bytes, DUMMY_VOEVENT)
+
+    def test_from_parsed(self):
+        element = etree.fromstring(DUMMY_IAMALIVE)
+        msg = TransportMessage.from_parsed(DUMMY_IAMALIVE, element)
+        self.assertIs(msg.element, element)
+        self.assertEqual(msg.raw_bytes, DUMMY_IAMALIVE)
+        self._assertTransport(msg, "iamalive")
+
+    def test_from_element(self):
+        # An element which has already been parsed is used as-is.
+        element = etree.fromstring(DUMMY_VOEVENT)
+        msg = xml_document.infer_type(DUMMY_VOEVENT, lazy=True, element=element)
+        self.assertIs(msg.element, element)
+        self._assertVOEvent(msg, "test", DUMMY_EVENT_IVOID.decode())
+
+    def test_schema(self):
+        # VOEvents are validated against the schema as they are parsed.
+        schema = etree.XMLSchema(
+            etree.parse(os.path.join(comet.__path__[0], "schema/VOEvent-v2.0.xsd"))
+        )
+        msg = xml_document.infer_type(DUMMY_VOEVENT, schema=schema)
+        self.assertEqual(msg.schema_validity, (schema, None))
+        self.assertIsNotNone(msg._element)
+
+        invalid = DUMMY_VOEVENT.replace(b'version="2.0"', b'version="1.1"')
+        msg = xml_document.infer_type(invalid, schema=schema)
+        self.assertIs(msg.schema_validity[0], schema)
+        self.assertIsInstance(msg.schema_validity[1], etree.DocumentInvalid)
+        self.assertEqual(msg.raw_bytes, invalid)
+
+    def test_schema_transport(self):
+        # Transport messages are parsed once, without the schema.
+        schema = etree.XMLSchema(
+            etree.parse(os.path.join(comet.__path__[0], "schema/VOEvent-v2.0.xsd"))
+        )
+        calls = []
+        for name in ("_parse", "_parse_validated"):
+            original = xml_document.__dict__[name]
+            self.addCleanup(setattr, xml_document, name, original)
+
+        def counting(name, function):
+            def wrapper(*args):
+                calls.append(name)
+                return function(*args)
+
+            return staticmethod(wrapper)
+
+        xml_document._parse = counting("_parse", xml_document._parse)
+        xml_document._parse_validated = counting(
+            "_parse_validated", xml_document._parse_validated
+        )
+        msg = xml_document.infer_type(DUMMY_IAMALIVE, schema=schema)
+        self._assertTransport(msg, "iamalive")
+        self.assertIsNotNone(msg._element)
+        self.assertEqual(calls, ["_parse"])
+
+        self._assertTransport(
+            xml_document.infer_type(DUMMY_IAMALIVE, schema=schema), "iamalive"
+        )
+        self.assertRaises(ParseError, xml_document.infer_type, b"<xml", schema=schema)
+
     def test_from_stream(self):
         b = BytesIO()
         b.write(DUMMY_VOEVENT)
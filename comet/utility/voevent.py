@@ -3,6 +3,7 @@
 
 # Python standard library
 import re
+import time
 from datetime import datetime
 
 # XML parsing using lxml
@@ -64,9 +65,112 @@ def parse_ivoid(ivoid):
 
 
 class VOEventMessage(xml_document):
+    """
+    A VOEvent.
+
+    The same event is passed to every validator and handler, and to every
+    subscriber, so facts about it which are needed at several stages of
+    processing are worked out when first required and then remembered.
+
+    ``received`` is the time at which the event was created, in seconds
+    since the epoch.
+
+    If the event was validated against a schema as it was parsed,
+    ``schema_validity`` is a tuple of the `~lxml.etree.XMLSchema` and None if
+    the event is valid, or the `~lxml.etree.DocumentInvalid` exception
+    describing why not; otherwise, it is None.
+    """
+
+    __slots__ = [
+        "_ivoid_parts",
+        "_digest",
+        "_encoding",
+        "_who",
+        "received",
+        "schema_validity",
+    ]
+
+    def __init__(self, document, lazy=False):
+        xml_document.__init__(self, document, lazy)
+        self.received = time.time()
+
+    @classmethod
+    def from_parsed(cls, raw_bytes, element=None, header=None):
+        document = super().from_parsed(raw_bytes, element, header)
+        document.received = time.time()
+        return document
+
+    def _forget(self):
+        xml_document._forget(self)
+        self._ivoid_parts = None
+        self._digest = None
+        self._encoding = None
+        self._who = None
+        self.schema_validity = None
+
     @property
     def ivoid(self):
-        return self.element.attrib["ivorn"]
+        return self.attrib["ivorn"]
+
+    @property
+    def ivoid_parts(self):
+        """
+        The authority, resource key and local ID of the event's IVOID, as
+        returned by `parse_ivoid`.
+
+        Raises `BadIvoidError` if the IVOID is invalid.
+        """
+        if self._ivoid_parts is None:
+            self._ivoid_parts = parse_ivoid(self.ivoid)
+        return self._ivoid_parts
+
+    @property
+    def size(self):
+        return len(self.raw_bytes)
+
+    def digest(self, hash_function):
+        """
+        Return the hex digest of the raw bytes of the event.
+
+        As for `content_digest`, the digest is calculated at most once for
+        each ``hash_function``.
+        """
+        if self._digest is None or self._digest[0] != hash_function:
+            self._digest = (hash_function, hash_function(self.raw_bytes).hexdigest())
+        return self._digest[1]
+
+    def has_digest(self, hash_function, canonical=False):
+        """
+        Return True if the `digest` (or, if ``canonical`` is set, the
+        `content_digest`) calculated by ``hash_function`` is already known.
+        """
+        known = self._content_digest if canonical else self._digest
+        return known is not None and known[0] == hash_function
+
+    @property
+    def encoding(self):
+        if self._encoding is None:
+            self._encoding = xml_document.encoding.fget(self)
+        return self._encoding
+
+    @property
+    def author_ivoid(self):
+        """The ``AuthorIVORN`` from the event's ``Who``, if any."""
+        return self._get_who()[0]
+
+    @property
+    def date(self):
+        """The ``Date`` from the event's ``Who``, if any."""
+        return self._get_who()[1]
+
+    def _get_who(self):
+        if self._who is None:
+            who = self.element.find("Who")
+            if who is None:
+                self._who = (None, None)
+            else:
+                self._who = (who.findtext("AuthorIVORN"), who.findtext("Date"))
+        return self._who
 
     @classmethod
     def broker_test(cls, ivo):
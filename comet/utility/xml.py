@@ -1,19 +1,170 @@
 # Comet VOEvent Broker.
 # XML document parsing.
 
+import threading
+
 import lxml.etree as ElementTree
 
-__all__ = ["ParseError", "xml_document"]
+__all__ = ["IncrementalParser", "ParseError", "canonical_form", "xml_document"]
 
 # Used to infer incoming message type
 VOEVENT_ROLES = ("observation", "prediction", "utility", "test")
 TRANSPORT_ROLES = ("iamalive", "ack", "nak", "authenticate")
 
+# When reading only the header of a document, examine at most HEADER_LIMIT
+# bytes, HEADER_CHUNK bytes at a time.
+HEADER_LIMIT = 64 * 1024
+HEADER_CHUNK = 4096
+
+# Refuse to parse documents which are larger than MAX_SIZE bytes, which
+# contain more than MAX_NODES items of markup (as counted by the "<"
+# characters which introduce them), or in which elements are nested more than
+# MAX_DEPTH deep. The limits may be changed with `set_limits`.
+MAX_SIZE = 16 * 1024 * 1024
+MAX_NODES = 1000000
+MAX_DEPTH = 32
+
+# Parsers are expensive to create, but may not be shared between threads.
+_thread_local = threading.local()
+
 
 class ParseError(Exception):
     pass
 
 
+def set_limits(max_size=None, max_nodes=None, max_depth=None):
+    """
+    Change the limits on the size and complexity of the documents which will
+    be parsed. Limits which are not given are left unchanged.
+    """
+    global MAX_SIZE, MAX_NODES, MAX_DEPTH
+    if max_size is not None:
+        MAX_SIZE = max_size
+    if max_nodes is not None:
+        MAX_NODES = max_nodes
+    if max_depth is not None:
+        MAX_DEPTH = max_depth
+
+
+def _make_parser(schema=None):
+    # We'll disable entity expansion and network access in the parser to
+    # avoid any risk of resource exhaustion.
+    return ElementTree.XMLParser(
+        resolve_entities=False,
+        no_network=True,
+        load_dtd=False,
+        huge_tree=False,
+        schema=schema,
+    )
+
+
+def _make_pull_parser():
+    # As `_make_parser`, but the parser reports each element as it starts and
+    # ends, so that the limits can be enforced while a document arrives (see
+    # `IncrementalParser`).
+    return ElementTree.XMLPullParser(
+        events=("start", "end"),
+        resolve_entities=False,
+        no_network=True,
+        load_dtd=False,
+        huge_tree=False,
+    )
+
+
+def _get_parser():
+    """
+    Return a parser for use by the current thread.
+    """
+    if not hasattr(_thread_local, "parser"):
+        _thread_local.parser = _make_parser()
+    return _thread_local.parser
+
+
+def _get_too_deep():
+    """
+    Return an XPath expression which is true if a document is nested more
+    than MAX_DEPTH deep, for use by the current thread.
+    """
+    if getattr(_thread_local, "max_depth", None) != MAX_DEPTH:
+        _thread_local.too_deep = ElementTree.XPath(
+            "boolean(%s)" % ("/*" * (MAX_DEPTH + 1),)
+        )
+        _thread_local.max_depth = MAX_DEPTH
+    return _thread_local.too_deep
+
+
+def _get_schema_parser(schema):
+    """
+    Return a parser which validates documents against ``schema`` as it parses
+    them, for use by the current thread.
+    """
+    if not hasattr(_thread_local, "schema_parsers"):
+        _thread_local.schema_parsers = {}
+    if schema not in _thread_local.schema_parsers:
+        _thread_local.schema_parsers[schema] = _make_parser(schema)
+    return _thread_local.schema_parsers[schema]
+
+
+def _parse_with(raw_bytes, parser):
+    """
+    Parse the complete document ``raw_bytes`` with ``parser``, as returned by
+    `_make_parser`, returning the root element.
+
+    The size and node limits have already been checked, so bound the work
+    done by the parser. The remaining checks are made on the parsed tree,
+    which is much cheaper than having the parser report every element.
+    """
+    try:
+        element = ElementTree.fromstring(raw_bytes, parser=parser)
+    except ElementTree.ParseError as e:
+        raise ParseError(str(e))
+    # Since entities can only be declared in a DTD, refusing documents with a
+    # DTD means refusing all entities (besides the predefined ones). Better
+    # safe than sorry.
+    if element.getroottree().docinfo.doctype:
+        raise ParseError("Document type declarations not supported")
+    if _get_too_deep()(element):
+        raise ParseError("Document nested more than %d deep" % (MAX_DEPTH,))
+    return element
+
+
+def _text_after(text, node):
+    """
+    Return ``text``, followed by the tails of any comments or processing
+    instructions from ``node`` onwards, with surrounding whitespace removed.
+    """
+    parts = [text or ""]
+    while node is not None and not isinstance(node.tag, str):
+        parts.append(node.tail or "")
+        node = node.getnext()
+    return "".join(parts).strip()
+
+
+def canonical_form(element):
+    """
+    Return a normalized serialization of ``element`` and its children.
+
+    Documents which differ only in their formatting -- indentation, attribute
+    order, namespace prefixes, encoding, comments -- have the same canonical
+    form. Each element contributes its qualified name, its attributes in
+    sorted order, and its text and tail with surrounding whitespace removed.
+    """
+    parts = []
+    for action, node in ElementTree.iterwalk(element, events=("start", "end")):
+        if not isinstance(node.tag, str):
+            # Comments and processing instructions; their tails are included
+            # with the text which precedes them.
+            continue
+        if action == "start":
+            parts.append("<" + node.tag)
+            parts.extend("@%s=%s" % item for item in sorted(node.attrib.items()))
+            parts.append(_text_after(node.text, node[0] if len(node) else None))
+        else:
+            parts.append(">" + _text_after(node.tail, node.getnext()))
+    # NUL may not appear in XML, so it can't be confused with the content.
+    return "\0".join(parts).encode("utf-8")
+
+
 class xml_document(object):
     """
     The combination of of an ElementTree element and its serialization.
@@ -24,44 +175,55 @@ class xml_document(object):
     unicode string. The raw bytes will (generally) include the XML encoding
     declaration, but if it is not available we will rely on lxml to take its
     best guess.
+
+    If ``lazy`` is set, only the attributes of the root element (and, for
+    Transport messages, the ``Origin``) are read when the document is created.
+    The full tree is built the first time `element` is accessed; if the
+    document turns out to be malformed, `ParseError` is raised then.
     """
 
-    __slots__ = ["_element", "_raw_bytes"]
+    __slots__ = ["_element", "_raw_bytes", "_content_digest", "_header"]
 
     @property
     def role(self):
-        return self.element.get("role")
+        return self.attrib.get("role")
 
-    def __init__(self, document):
+    @property
+    def attrib(self):
+        """The attributes of the root element."""
+        if self._element is None:
+            return self._header[0]
+        return self._element.attrib
+
+    def __init__(self, document, lazy=False):
+        self._forget()
+        self._header = None
         if isinstance(document, ElementTree._Element):
             self.element = document
         else:
-            self.raw_bytes = document
+            header = self._parse_header(document) if lazy else None
+            if header is None:
+                self.raw_bytes = document
+            else:
+                self._raw_bytes = document
+                self._element = None
+                self._header = header
 
     def get_raw_bytes(self):
         return self._raw_bytes
 
     def set_raw_bytes(self, value):
-        if not isinstance(value, bytes):
-            raise ParseError("Raw bytes required.")
+        element = self._parse(value)
         self._raw_bytes = value
-
-        # We'll disable entity expansion in the parser to avoid any risk of
-        # resource exhaustion. If we receive any, we raise (and hence reject
-        # the event). Better safe than sorry.
-        parser = ElementTree.XMLParser(resolve_entities=False)
-        try:
-            element = ElementTree.fromstring(self._raw_bytes, parser=parser)
-        except ElementTree.ParseError as e:
-            raise ParseError(str(e))
-        if list(element.iter(ElementTree.Entity)):
-            raise ParseError("Entity expansion not supported")
-        else:
-            self._element = element
+        self._element = element
+        self._forget()
+        self._header = None
 
     raw_bytes = property(get_raw_bytes, set_raw_bytes)
 
     def get_element(self):
+        if self._element is None:
+            self._element = self._parse(self._raw_bytes)
         return self._element
 
     def set_element(self, value):
@@ -69,9 +231,31 @@ class xml_document(object):
         self._raw_bytes = ElementTree.tostring(
             self._element, xml_declaration=True, encoding="UTF-8", pretty_print=True
         )
+        self._forget()
+        self._header = None
 
     element = property(get_element, set_element)
 
+    def _forget(self):
+        """
+        Discard everything remembered about the document, because it is new
+        or has changed.
+        """
+        self._content_digest = None
+
+    def content_digest(self, hash_function):
+        """
+        Return the hex digest of the `canonical_form` of the element.
+
+        The digest is calculated at most once for each document (unless it is
+        requested with a different ``hash_function``), however many times it
+        is required.
+        """
+        if self._content_digest is None or self._content_digest[0] != hash_function:
+            digest = hash_function(canonical_form(self.element)).hexdigest()
+            self._content_digest = (hash_function, digest)
+        return self._content_digest[1]
+
     @property
     def valid_signature(self):
         return False
@@ -81,25 +265,235 @@ class xml_document(object):
         # Return the encoding that lxml detected for the raw_bytes we're
         # carrying. Note we need to construct an ElementTree and use that;
         # can't read from the element directly.
-        return ElementTree.ElementTree(self._element).docinfo.encoding
+        return ElementTree.ElementTree(self.element).docinfo.encoding
+
+    @staticmethod
+    def _check_limits(raw_bytes):
+        """Raise unless ``raw_bytes`` are within the size and node limits."""
+        if not isinstance(raw_bytes, bytes):
+            raise ParseError("Raw bytes required.")
+        if len(raw_bytes) > MAX_SIZE:
+            raise ParseError("Document exceeds %d bytes" % (MAX_SIZE,))
+        if raw_bytes.count(b"<") > MAX_NODES:
+            raise ParseError("Document exceeds %d nodes" % (MAX_NODES,))
+
+    @staticmethod
+    def _parse(raw_bytes):
+        """Parse ``raw_bytes``, returning the root element."""
+        # Cheap checks first, so that hostile documents are rejected before
+        # we spend any time parsing them.
+        xml_document._check_limits(raw_bytes)
+        return _parse_with(raw_bytes, _get_parser())
+
+    @staticmethod
+    def _parse_validated(raw_bytes, schema):
+        """
+        Parse ``raw_bytes``, validating the document against ``schema`` at the
+        same time.
+
+        Return the root element, and None if the document is valid or the
+        `~lxml.etree.DocumentInvalid` exception describing why not if it is
+        well formed but invalid. Raise `ParseError` if it is malformed.
+        """
+        xml_document._check_limits(raw_bytes)
+        try:
+            element = _parse_with(raw_bytes, _get_schema_parser(schema))
+        except ParseError:
+            # Malformed or invalid; we need to parse again to tell which.
+            element = xml_document._parse(raw_bytes)
+            try:
+                schema.assertValid(element)
+            except ElementTree.DocumentInvalid as e:
+                return element, e
+        return element, None
+
+    @staticmethod
+    def _parse_header(raw_bytes):
+        """
+        Read the attributes of the root element of ``raw_bytes`` and, if it
+        is a Transport message, the text of its ``Origin``.
+
+        Only as much of the document as is required is parsed. Return a tuple
+        of the attributes and the origin (None if there is none, or it could
+        not be found), or None if the header cannot be read this way: in that
+        case, the document should be parsed in full.
+        """
+        try:
+            xml_document._check_limits(raw_bytes)
+        except ParseError:
+            return None
+        parser = ElementTree.XMLPullParser(
+            events=("start", "end"), resolve_entities=False, no_network=True
+        )
+        root = None
+        try:
+            for start in range(0, min(len(raw_bytes), HEADER_LIMIT), HEADER_CHUNK):
+                stop = start + HEADER_CHUNK
+                parser.feed(raw_bytes[start:stop])
+                for action, element in parser.read_events():
+                    if root is None:
+                        # Documents with a DTD are parsed in full, and hence
+                        # rejected.
+                        if b"<!DOCTYPE" in raw_bytes[:stop]:
+                            return None
+                        root = element
+                        if ElementTree.QName(root).localname != "Transport":
+                            return dict(root.attrib), None
+                    elif action == "end" and element.getparent() is root:
+                        origin = element.text if element.tag == "Origin" else None
+                        return dict(root.attrib), origin
+        except ElementTree.XMLSyntaxError:
+            pass
+        return None
+
+    @classmethod
+    def from_parsed(cls, raw_bytes, element=None, header=None):
+        """
+        Construct a document from ``raw_bytes`` and either the ``element`` or
+        the ``header`` (as returned by `_parse_header`) which was obtained by
+        parsing them, without parsing them again.
+        """
+        document = cls.__new__(cls)
+        document._raw_bytes = raw_bytes
+        document._element = element
+        document._forget()
+        document._header = header
+        return document
 
     @staticmethod
-    def infer_type(raw_bytes):
-        """Given a payload, attempt to infer its message type."""
-        # The double-parse is unfortunate.
-        xmldoc = xml_document(raw_bytes)
-        if xmldoc.role in VOEVENT_ROLES:
+    def infer_type(raw_bytes, lazy=False, element=None, schema=None):
+        """Given a payload, attempt to infer its message type.
+
+        If ``lazy`` is set, only the header of the payload is parsed if
+        possible; see `xml_document`. If the ``element`` obtained by parsing
+        the payload is supplied, it is not parsed again. Otherwise, if a
+        ``schema`` is supplied, VOEvents are validated against it as they are
+        parsed, and the result is recorded as their ``schema_validity``.
+        """
+        # Parse once, then hand the result to the appropriate subclass.
+        header = None
+        validity = None
+        if element is None and (lazy or schema is not None):
+            header = xml_document._parse_header(raw_bytes)
+        if element is None and schema is not None:
+            # Only VOEvents can be valid against the schema. Other messages
+            # are parsed as usual, rather than failing validation and then
+            # being parsed again.
+            if header is not None and header[0].get("role") in VOEVENT_ROLES:
+                element, error = xml_document._parse_validated(raw_bytes, schema)
+                validity = (schema, error)
+            if not lazy:
+                header = None
+        if element is None and header is None:
+            element = xml_document._parse(raw_bytes)
+        if element is not None:
+            role = element.get("role")
+        else:
+            role = header[0].get("role")
+        if role in VOEVENT_ROLES:
             from comet.utility.voevent import VOEventMessage
 
-            return VOEventMessage(raw_bytes)
-        elif xmldoc.role in TRANSPORT_ROLES:
+            document = VOEventMessage.from_parsed(raw_bytes, element, header)
+            document.schema_validity = validity
+            return document
+        elif role in TRANSPORT_ROLES:
             from comet.protocol import TransportMessage
 
-            return TransportMessage(raw_bytes)
+            return TransportMessage.from_parsed(raw_bytes, element, header)
         else:
-            raise ParseError(f"Unknown role: {xmldoc.role}")
+            raise ParseError(f"Unknown role: {role}")
 
     @staticmethod
     def from_stream(stream):
         """Give an IO stream, return an appropriate xml_document subclass."""
         return xml_document.infer_type(stream.read())
+
+
+class IncrementalParser(object):
+    """
+    Parse a document which arrives a piece at a time.
+
+    Each piece passed to `feed` is parsed immediately, so that the document
+    is ready, or found to be malformed, as soon as the last piece arrives. The
+    same limits apply as when parsing an `xml_document`, and are enforced as
+    parsing proceeds: once one is exceeded, the rest of the document is
+    ignored.
+
+    A ``parser`` returned by `_make_pull_parser` may be supplied, so that it
+    can be reused; it is ready to parse another document once `close` is
+    called.
+    """
+
+    def __init__(self, parser=None):
+        self._parser = _make_pull_parser() if parser is None else parser
+        self._size = 0
+        self._nodes = 0
+        self._depth = 0
+        self._started = False
+        self.error = None
+
+    def feed(self, data):
+        """Parse the next piece of the document."""
+        if self.error is not None:
+            return
+        self._size += len(data)
+        self._nodes += data.count(b"<")
+        try:
+            if self._size > MAX_SIZE:
+                raise ParseError("Document exceeds %d bytes" % (MAX_SIZE,))
+            elif self._nodes > MAX_NODES:
+                raise ParseError("Document exceeds %d nodes" % (MAX_NODES,))
+            try:
+                self._parser.feed(data)
+            except ElementTree.ParseError as e:
+                raise ParseError(str(e))
+            self._check_events()
+        except ParseError as e:
+            self.error = e
+            self._reset()
+
+    def _check_events(self):
+        """Check the elements the parser has seen since we last looked."""
+        for action, element in self._parser.read_events():
+            if action == "end":
+                self._depth -= 1
+                continue
+            if not self._started:
+                self._started = True
+                # Since entities can only be declared in a DTD, refusing
+                # documents with a DTD means refusing all entities (besides
+                # the predefined ones). Better safe than sorry. Any DTD
+                # precedes the root element, so is known by now.
+                if element.getroottree().docinfo.doctype:
+                    raise ParseError("Document type declarations not supported")
+            self._depth += 1
+            if self._depth > MAX_DEPTH:
+                raise ParseError("Document nested more than %d deep" % (MAX_DEPTH,))
+
+    def _reset(self):
+        """Abandon the document, so that the parser may be reused."""
+        try:
+            self._parser.close()
+        except ElementTree.ParseError:
+            pass
+        for event in self._parser.read_events():
+            pass
+
+    def close(self):
+        """Return the root element of the document, or raise `ParseError`."""
+        if self.error is None:
+            try:
+                element = self._parser.close()
+            except ElementTree.ParseError as e:
+                self.error = ParseError(str(e))
+            else:
+                # Elements may be reported only once the parser is closed.
+                try:
+                    self._check_events()
+                    return element
+                except ParseError as e:
+                    self.error = e
+            finally:
+                for event in self._parser.read_events():
+                    pass
+        raise self.error
@@ -1,6 +1,8 @@
 # Comet VOEvent Broker.
 # VOEvent validation.
 
+from comet.validator.cache import *
 from comet.validator.ivoid import *
+from comet.validator.pipeline import *
 from comet.validator.previously_seen import *
 from comet.validator.schema import *
@@ -0,0 +1,66 @@
+# Comet VOEvent Broker.
+# Remember the results of validating events.
+
+from hashlib import sha1
+
+import lxml.etree as etree
+from twisted.internet import defer
+from zope.interface import implementer
+
+from comet.icomet import IValidator
+from comet.utility import BadIvoidError, LRUCache, ParseError
+from comet.validator.pipeline import ValidationPipeline
+
+__all__ = ["CheckCached"]
+
+# Failures which are determined by the content of an event, and hence may be
+# remembered.
+CACHEABLE_FAILURES = (etree.DocumentInvalid, ParseError, BadIvoidError)
+
+
+@implementer(IValidator)
+class CheckCached(object):
+    """
+    Apply ``validators`` to each event in a `ValidationPipeline`, remembering
+    the outcome.
+
+    The outcome -- success, or the exception raised by the first validator
+    to fail, if it is one of `CACHEABLE_FAILURES` -- is remembered for the
+    last ``cache_size`` distinct payloads, keyed by their digest as calculated
+    by ``hash_function``. If an identical payload is seen again, the
+    validators are not applied; the remembered outcome is used instead. Other
+    failures, such as those of the machinery used to apply the validators,
+    may not recur, so are not remembered. Hits and misses are counted in
+    ``cache.hits`` and ``cache.misses``.
+
+    Only validators whose result depends solely on the content of the event
+    (such as `CheckSchema` and `CheckIVOID`) should be cached in this way:
+    in particular, `CheckPreviouslySeen` should not.
+    """
+
+    def __init__(self, validators, cache_size, hash_function=sha1):
+        self.validators = ValidationPipeline(validators)
+        self.cache = LRUCache(cache_size)
+        self.hash_function = hash_function
+
+    @property
+    def cost(self):
+        return self.validators.cost
+
+    def __call__(self, event):
+        key = event.digest(self.hash_function)
+        outcome = self.cache.get(key)
+        if outcome is not None:
+            return defer.succeed(True) if outcome is True else defer.fail(outcome)
+
+        def remember_valid(result):
+            self.cache[key] = True
+            return True
+
+        def remember_invalid(failure):
+            failure.trap(defer.FirstError)
+            if failure.value.subFailure.check(*CACHEABLE_FAILURES):
+                self.cache[key] = failure.value.subFailure.value
+            return failure.value.subFailure
+
+        return self.validators(event).addCallbacks(remember_valid, remember_invalid)
@@ -3,7 +3,8 @@
 
 from zope.interface import implementer
 from comet.icomet import IValidator
-from comet.utility import parse_ivoid
+from comet.utility import BadIvoidError
+from comet.validator.pipeline import COST_CHEAP
 
 __all__ = ["CheckIVOID"]
 
@@ -17,8 +18,10 @@ class CheckIVOID(object):
     following a #).
     """
 
+    cost = COST_CHEAP
+
     def __call__(self, event):
-        # parse_ivoid() raises if whatever it is passed is unparseable.
-        auth, rsrc, local_ID = parse_ivoid(event.element.attrib["ivorn"])
+        # ivoid_parts raises if the IVOID is unparseable.
+        auth, rsrc, local_ID = event.ivoid_parts
         if not local_ID:
-            raise Exception("No per-event local ID")
+            raise BadIvoidError("No per-event local ID")
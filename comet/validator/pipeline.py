@@ -0,0 +1,93 @@
+# Comet VOEvent Broker.
+# Apply validators in order of cost.
+
+import time
+
+from twisted.internet import defer
+from zope.interface import implementer
+
+from comet.icomet import IValidator
+
+__all__ = [
+    "COST_CHEAP",
+    "COST_MODERATE",
+    "COST_EXPENSIVE",
+    "COST_RECORD",
+    "ValidationPipeline",
+    "validator_cost",
+]
+
+# Validators may declare how expensive they are to apply with a ``cost``
+# attribute, taking one of these values; cheaper validators are applied first.
+COST_CHEAP = 0  # Quick checks, made without leaving the reactor thread.
+COST_MODERATE = 1  # The default, for validators which don't declare a cost.
+COST_EXPENSIVE = 2  # Substantial work, such as schema validation.
+COST_RECORD = 3  # Checks which record the event, so must only see valid ones.
+
+
+def validator_cost(validator):
+    """Return the cost class declared by ``validator``."""
+    return getattr(validator, "cost", COST_MODERATE)
+
+
+@implementer(IValidator)
+class ValidationPipeline(object):
+    """
+    Apply a sequence of ``validators`` to each event in turn, cheapest first.
+
+    Validators are ordered by their cost (see `validator_cost`); those of
+    equal cost are applied in the order given. Each validator is applied only
+    once the previous one has succeeded, and validation stops at the first
+    failure. In that case, the result is a `~twisted.internet.defer.FirstError`
+    wrapping the failure, just as `~twisted.internet.defer.gatherResults`
+    would produce; otherwise, it is the list of results of each validator.
+
+    The number of events examined by each stage, and the total time taken by
+    it, are recorded in ``timings``.
+    """
+
+    def __init__(self, validators):
+        self.stages = sorted(validators, key=validator_cost)
+        self.timings = [[0, 0.0] for stage in self.stages]
+
+    @property
+    def cost(self):
+        return max(map(validator_cost, self.stages), default=COST_CHEAP)
+
+    def __iter__(self):
+        return iter(self.stages)
+
+    def __len__(self):
+        return len(self.stages)
+
+    def __call__(self, event):
+        d = defer.succeed([])
+        for index, validator in enumerate(self.stages):
+            d.addCallback(self._apply, index, validator, event)
+        return d
+
+    def _apply(self, results, index, validator, event):
+        timing = self.timings[index]
+        start = time.perf_counter()
+
+        def record(result):
+            timing[0] += 1
+            timing[1] += time.perf_counter() - start
+            return result
+
+        def succeeded(result):
+            results.append(result)
+            return results
+
+        def failed(failure):
+            raise defer.FirstError(failure, index)
+
+        d = defer.maybeDeferred(validator, event).addBoth(record)
+        return d.addCallbacks(succeeded, failed)
+
+    def summary(self):
+        """Describe the time spent in each stage of the pipeline."""
+        return "; ".join(
+            "%s: %d events in %.3f seconds" % (type(stage).__name__, count, elapsed)
+            for stage, (count, elapsed) in zip(self.stages, self.timings)
+        )
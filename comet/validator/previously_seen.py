@@ -1,10 +1,13 @@
 # Comet VOEvent Broker.
 # Check for previously seen events.
 
+from twisted.internet import defer
 from twisted.internet.threads import deferToThread
 from zope.interface import implementer
 
 from comet.icomet import IValidator
+from comet.utility import BatchingEventDB, LRUCache, ParseError
+from comet.validator.pipeline import COST_RECORD
 import comet.log as log
 
 __all__ = ["CheckPreviouslySeen"]
@@ -12,8 +15,40 @@ __all__ = ["CheckPreviouslySeen"]
 
 @implementer(IValidator)
 class CheckPreviouslySeen(object):
-    def __init__(self, event_db):
+    """
+    Reject events which have already been recorded in ``event_db``.
+
+    If ``cache_size`` is non-zero, the keys of up to that many recently seen
+    events are also held in memory. Duplicates of those events are rejected
+    immediately, without a round trip to the database; hits and misses are
+    counted in ``cache.hits`` and ``cache.misses``.
+
+    If ``batch_size`` is non-zero, lookups made at the same time are sent to
+    the database together, in batches of up to that many events (see
+    `~comet.utility.BatchingEventDB`).
+
+    If ``ivorn_first`` is set (and ``cache_size`` is non-zero), the cache is
+    instead indexed by IVOID. The payload of an event is only hashed on
+    receipt if an event with the same IVOID and size has been seen recently:
+    if the digests match, it is an exact duplicate and is rejected; otherwise
+    it may be a resubmission, and is checked against the database. Events with
+    unfamiliar IVOIDs are hashed when they are looked up in the database, in
+    a thread.
+
+    Since checking an event records it, this validator is applied after any
+    others (see `~comet.validator.ValidationPipeline`), so that only events
+    which are otherwise valid are recorded. For the same reason, events which
+    were parsed lazily are parsed in full before they are recorded, and
+    rejected if they are malformed.
+    """
+
+    cost = COST_RECORD
+
+    def __init__(self, event_db, cache_size=0, batch_size=0, ivorn_first=False):
         self.event_db = event_db
+        self.cache = LRUCache(cache_size) if cache_size else None
+        self.ivorn_first = ivorn_first and self.cache is not None
+        self.batcher = BatchingEventDB(event_db, batch_size) if batch_size else None
 
     def __call__(self, event):
         def check_validity(is_valid):
@@ -25,11 +60,70 @@ class CheckPreviouslySeen(object):
                 raise Exception("Previously seen by this broker")
 
         def db_failure(failure):
+            if failure.check(ParseError):
+                return failure
             log.warn("Event DB lookup failed!")
             log.warn(failure.getTraceback())
             return failure
 
-        return deferToThread(
-            self.event_db.check_event,
-            event,
-        ).addCallbacks(check_validity, db_failure)
+        if self.cache is None:
+            d = defer.maybeDeferred(self._check_db, event)
+        elif self.ivorn_first:
+            d = defer.maybeDeferred(self._check_ivorn, event)
+        else:
+            d = defer.maybeDeferred(self._check_cached, event)
+        return d.addCallbacks(check_validity, db_failure)
+
+    def preload(self, details):
+        """
+        Remember the events described by ``details`` in the in-memory cache.
+
+        ``details`` is a sequence of results of ``get_event_details``, ordered
+        from least to most recently seen; if there are more than fit in the
+        cache, the most recent are kept. Has no effect if the cache is
+        disabled or indexed by IVOID. Return the number of events remembered.
+        """
+        if self.cache is None or self.ivorn_first:
+            return 0
+        for item in details:
+            self.cache[item] = True
+        return len(self.cache)
+
+    def _check_cached(self, event):
+        details = self.event_db.get_event_details(event)
+        if self.cache.get(details):
+            return False
+
+        def remember(is_valid):
+            # Whatever the result, the event is now recorded in the database.
+            self.cache[details] = True
+            return is_valid
+
+        return self._check_db(event, details).addCallback(remember)
+
+    def _check_ivorn(self, event):
+        ivorn = event.ivoid
+        size = event.size
+        details = None
+        known = self.cache.get(ivorn)
+        if known is not None and known[0] == size:
+            details = self.event_db.get_event_details(event)
+            if details == known[1]:
+                return False
+
+        def remember(is_valid):
+            # The event has now been hashed, so its details are memoized.
+            self.cache[ivorn] = (size, self.event_db.get_event_details(event))
+            return is_valid
+
+        # Events with unfamiliar IVOIDs are hashed along with the database
+        # lookup, away from the reactor thread.
+        return self._check_db(event, details).addCallback(remember)
+
+    def _check_db(self, event, details=None):
+        # Make sure the event is well formed before the database records it.
+        event.element
+        if self.batcher is None:
+            return deferToThread(self.event_db.check_event, event, details)
+        else:
+            return self.batcher.check_event(event, details)
@@ -1,13 +1,57 @@
 # Comet VOEvent Broker.
 # Schema validator.
 
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, DeferredSemaphore, fail, succeed
 from twisted.internet.threads import deferToThread
 import lxml.etree as etree
 
 from zope.interface import implementer
 from comet.icomet import IValidator
+from comet.utility import ParseError, xml_document
+import comet.utility.xml
+from comet.validator.pipeline import COST_EXPENSIVE
+
+__all__ = ["CheckSchema", "ValidationBacklogError"]
+
+# By default, allow this many events to be undergoing validation by worker
+# processes at once, and as many again to be waiting their turn.
+MAX_PENDING = 1000
+
+# The schema used by a worker process.
+_worker_schema = None
+
+
+def _init_worker(schema, limits):
+    """
+    Compile ``schema`` for use by `_validate` in a worker process, which
+    parses documents subject to ``limits`` (see `~comet.utility.xml.set_limits`).
+    """
+    global _worker_schema
+    _worker_schema = etree.XMLSchema(etree.parse(schema))
+    comet.utility.xml.set_limits(*limits)
+
 
-__all__ = ["CheckSchema"]
+def _validate(raw_bytes):
+    """
+    Validate ``raw_bytes`` in a worker process.
+
+    Return None if the document is valid, or a message describing the
+    problem if not.
+    """
+    try:
+        _worker_schema.assertValid(xml_document._parse(raw_bytes))
+    except (ParseError, etree.DocumentInvalid) as e:
+        return str(e)
+
+
+class ValidationBacklogError(Exception):
+    """Raised when too many events are already waiting for validation."""
+
+    pass
 
 
 @implementer(IValidator)
@@ -15,10 +59,78 @@ class CheckSchema(object):
     """
     This takes an ElementTree element, converts it to a string, then reads
     that into lxml for validation. That... can't be optimal.
+
+    Events which were validated against ``schema`` as they were parsed (see
+    `~comet.utility.xml_document.infer_type`) are not validated again; the
+    recorded result is used instead.
+
+    If ``processes`` is non-zero, events are validated by a pool of that many
+    worker processes, rather than in a thread, so that validation can make
+    use of multiple cores. The raw bytes of each event are sent to a worker,
+    which parses and validates them with its own copy of the schema. Up to
+    ``max_pending`` events may be sent to the pool at once, and up to
+    ``max_waiting`` (by default, the same number) more may wait their turn;
+    beyond that, events are rejected with `ValidationBacklogError`. The pool
+    is started when first required.
     """
 
-    def __init__(self, schema):
+    cost = COST_EXPENSIVE
+
+    def __init__(self, schema, processes=0, max_pending=MAX_PENDING, max_waiting=None):
         self.schema = etree.XMLSchema(etree.parse(schema))
+        self.schema_path = schema
+        self.processes = processes
+        self.max_waiting = max_pending if max_waiting is None else max_waiting
+        self._pending = DeferredSemaphore(max_pending)
+        self._pool = None
 
     def __call__(self, event):
+        validity = getattr(event, "schema_validity", None)
+        if validity is not None and validity[0] is self.schema:
+            return succeed(None) if validity[1] is None else fail(validity[1])
+        if self.processes:
+            if len(self._pending.waiting) >= self.max_waiting:
+                return fail(
+                    ValidationBacklogError("Too many events awaiting validation")
+                )
+            return self._pending.run(self._validate_in_pool, event.raw_bytes)
         return deferToThread(self.schema.assertValid, event.element)
+
+    def _validate_in_pool(self, raw_bytes):
+        if self._pool is None:
+            # Worker processes are spawned afresh, rather than forked from
+            # a process which is running threads.
+            self._pool = ProcessPoolExecutor(
+                self.processes,
+                multiprocessing.get_context("spawn"),
+                _init_worker,
+                (
+                    self.schema_path,
+                    (
+                        comet.utility.xml.MAX_SIZE,
+                        comet.utility.xml.MAX_NODES,
+                        comet.utility.xml.MAX_DEPTH,
+                    ),
+                ),
+            )
+            reactor.addSystemEventTrigger("during", "shutdown", self.close)
+
+        d = Deferred()
+
+        def report(future):
+            if future.exception() is not None:
+                d.errback(future.exception())
+            elif future.result() is not None:
+                d.errback(etree.DocumentInvalid(future.result()))
+            else:
+                d.callback(None)
+
+        future = self._pool.submit(_validate, raw_bytes)
+        future.add_done_callback(lambda f: reactor.callFromThread(report, f))
+        return d
+
+    def close(self):
+        """Shut down the pool of worker processes, if it has been started."""
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
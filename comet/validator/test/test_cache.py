@@ -0,0 +1,78 @@
+# Comet VOEvent Broker.
+# Tests for the validation cache.
+
+import lxml.etree as etree
+from twisted.trial import unittest
+
+from comet.icomet import IValidator
+from comet.utility import BadIvoidError, ParseError, VOEventMessage
+from comet.validator import CheckCached
+from comet.testutils import DUMMY_VOEVENT
+
+
+class CountingValidator(object):
+    def __init__(self, error=None):
+        self.calls = 0
+        self.error = error
+
+    def __call__(self, event):
+        self.calls += 1
+        if self.error is not None:
+            raise self.error
+        return True
+
+
+class CheckCachedTestCase(unittest.TestCase):
+    def setUp(self):
+        self.event = VOEventMessage(DUMMY_VOEVENT)
+
+    def test_valid(self):
+        validators = [CountingValidator(), CountingValidator()]
+        checker = CheckCached(validators, 10)
+        self.successResultOf(checker(self.event))
+        self.successResultOf(checker(VOEventMessage(DUMMY_VOEVENT)))
+        self.assertEqual([v.calls for v in validators], [1, 1])
+        self.assertEqual(checker.cache.hits, 1)
+        self.assertEqual(checker.cache.misses, 1)
+
+    def test_invalid(self):
+        for error in (
+            etree.DocumentInvalid("Bad event"),
+            ParseError("Bad event"),
+            BadIvoidError("Bad event"),
+        ):
+            validator = CountingValidator(error)
+            checker = CheckCached([validator], 10)
+            for _ in range(2):
+                failure = self.failureResultOf(checker(self.event), type(error))
+                self.assertEqual(str(failure.value), "Bad event")
+            self.assertEqual(validator.calls, 1)
+            self.assertEqual(checker.cache.hits, 1)
+
+    def test_transient_failure(self):
+        # Failures which don't depend on the event aren't remembered.
+        validator = CountingValidator(RuntimeError("Pool broken"))
+        checker = CheckCached([validator], 10)
+        self.failureResultOf(checker(self.event), RuntimeError)
+        validator.error = None
+        self.successResultOf(checker(self.event))
+        self.assertEqual(validator.calls, 2)
+        self.assertEqual(checker.cache.hits, 0)
+
+    def test_distinct_payloads(self):
+        validator = CountingValidator()
+        checker = CheckCached([validator], 10)
+        self.successResultOf(checker(self.event))
+        self.successResultOf(checker(VOEventMessage(DUMMY_VOEVENT + b" ")))
+        self.assertEqual(validator.calls, 2)
+
+    def test_bounded(self):
+        validator = CountingValidator()
+        checker = CheckCached([validator], 1)
+        self.successResultOf(checker(self.event))
+        self.successResultOf(checker(VOEventMessage(DUMMY_VOEVENT + b" ")))
+        self.successResultOf(checker(self.event))
+        self.assertEqual(validator.calls, 3)
+
+    def test_interface(self):
+        self.assertTrue(IValidator.providedBy(CheckCached([], 10)))
@@ -4,7 +4,7 @@
 from twisted.trial import unittest
 
 from comet.icomet import IValidator
-from comet.utility import xml_document
+from comet.utility import VOEventMessage
 from comet.validator import CheckIVOID
 from comet.testutils import DUMMY_VOEVENT, DUMMY_EVENT_IVOID
 
@@ -29,13 +29,13 @@ class CheckSchemaTestCase(unittest.TestCase):
 
     def test_valid(self):
         # Should not raise
-        self.validator(xml_document(DUMMY_VOEVENT))
+        self.validator(VOEventMessage(DUMMY_VOEVENT))
 
     def test_invalid(self):
         self.assertRaises(
             Exception,
             self.validator,
-            xml_document(BAD_EVENT_TEXT.replace(DUMMY_EVENT_IVOID, b"bad_ivoid")),
+            VOEventMessage(BAD_EVENT_TEXT.replace(DUMMY_EVENT_IVOID, b"bad_ivoid")),
         )
 
     def test_interface(self):
@@ -0,0 +1,86 @@
+# Comet VOEvent Broker.
+# Tests for the staged validation pipeline.
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from comet.icomet import IValidator
+from comet.validator import CheckIVOID, CheckPreviouslySeen, ValidationPipeline
+from comet.validator import COST_CHEAP, COST_EXPENSIVE, COST_RECORD
+from comet.validator import validator_cost
+
+
+class Stage(object):
+    def __init__(self, log, name, cost=None, error=None):
+        self.log = log
+        self.name = name
+        self.error = error
+        if cost is not None:
+            self.cost = cost
+
+    def __call__(self, event):
+        self.log.append(self.name)
+        if self.error is not None:
+            raise self.error
+        return self.name
+
+
+class ValidationPipelineTestCase(unittest.TestCase):
+    def setUp(self):
+        self.log = []
+
+    def test_cost_order(self):
+        pipeline = ValidationPipeline(
+            [
+                Stage(self.log, "record", COST_RECORD),
+                Stage(self.log, "expensive", COST_EXPENSIVE),
+                Stage(self.log, "default"),
+                Stage(self.log, "cheap", COST_CHEAP),
+            ]
+        )
+        result = self.successResultOf(pipeline(None))
+        self.assertEqual(self.log, ["cheap", "default", "expensive", "record"])
+        self.assertEqual(result, self.log)
+
+    def test_stable(self):
+        # Validators of equal cost are applied in the order given.
+        pipeline = ValidationPipeline([Stage(self.log, "a"), Stage(self.log, "b")])
+        self.successResultOf(pipeline(None))
+        self.assertEqual(self.log, ["a", "b"])
+
+    def test_short_circuit(self):
+        pipeline = ValidationPipeline(
+            [
+                Stage(self.log, "record", COST_RECORD),
+                Stage(self.log, "cheap", COST_CHEAP, ValueError("Bad event")),
+            ]
+        )
+        failure = self.failureResultOf(pipeline(None), defer.FirstError)
+        self.assertEqual(failure.value.subFailure.getErrorMessage(), "Bad event")
+        self.assertEqual(self.log, ["cheap"])
+
+    def test_waits_for_stage(self):
+        pending = defer.Deferred()
+        pipeline = ValidationPipeline([lambda event: pending, Stage(self.log, "b")])
+        d = pipeline(None)
+        self.assertNoResult(d)
+        self.assertEqual(self.log, [])
+        pending.callback("a")
+        self.assertEqual(self.successResultOf(d), ["a", "b"])
+
+    def test_timings(self):
+        pipeline = ValidationPipeline(
+            [Stage(self.log, "a"), Stage(self.log, "b", error=ValueError())]
+        )
+        self.successResultOf(pipeline(None).addErrback(lambda failure: None))
+        self.failureResultOf(pipeline(None), defer.FirstError)
+        self.assertEqual([count for count, elapsed in pipeline.timings], [2, 2])
+        self.assertIn("Stage: 2 events", pipeline.summary())
+
+    def test_cost(self):
+        self.assertEqual(validator_cost(CheckIVOID()), COST_CHEAP)
+        self.assertEqual(CheckPreviouslySeen.cost, COST_RECORD)
+        self.assertEqual(ValidationPipeline([CheckIVOID()]).cost, COST_CHEAP)
+
+    def test_interface(self):
+        self.assertTrue(IValidator.providedBy(ValidationPipeline([])))
@@ -4,11 +4,12 @@
 import tempfile
 import shutil
 
+from twisted.internet import defer
 from twisted.trial import unittest
 
-from comet.testutils import DummyEvent
+from comet.testutils import DUMMY_VOEVENT, DummyEvent
 from comet.icomet import IValidator
-from comet.utility import Event_DB
+from comet.utility import Event_DB, ParseError, xml_document
 from comet.validator import CheckPreviouslySeen
 
 
@@ -51,5 +52,194 @@ class CheckPreviouslySeenTestCase(unittest.TestCase):
     def test_interface(self):
         self.assertTrue(IValidator.providedBy(self.checker))
 
+    def test_malformed_not_recorded(self):
+        # A lazily parsed event which turns out to be malformed is rejected
+        # without being recorded, so a corrected resubmission is accepted.
+        padding = b"<!--" + b" " * 8192 + b"-->"
+        malformed = xml_document.infer_type(
+            DUMMY_VOEVENT.replace(b"</Who>", padding), lazy=True
+        )
+        self.assertIsNone(malformed._element)
+        d = self.assertFailure(self.checker(malformed), ParseError)
+        d.addCallback(lambda _: self.checker(self.event))
+        return d.addCallback(self.assertTrue)
+
+    def test_no_cache(self):
+        # By default, there is no in-memory cache.
+        self.assertIsNone(self.checker.cache)
+        self.assertEqual(self.checker.preload([("db", "key")]), 0)
+
+    def tearDown(self):
+        self.checker.event_db.close()
+        shutil.rmtree(self.event_db_dir)
+
+
+class CheckPreviouslySeenCachedTestCase(unittest.TestCase):
+    def setUp(self):
+        self.event_db_dir = tempfile.mkdtemp()
+        self.checker = CheckPreviouslySeen(Event_DB(self.event_db_dir), cache_size=2)
+        self.event = DummyEvent()
+
+    def test_unseen(self):
+        d = self.checker(self.event)
+        d.addCallback(self.assertTrue)
+        return d
+
+    def test_cache_hit(self):
+        # Once an event has been checked, duplicates are rejected immediately
+        # without consulting the database.
+        def check_duplicate(result):
+            self.checker.event_db.check_event = None
+            d = self.checker(self.event)
+            self.assertTrue(d.called)
+            self.assertEqual(self.checker.cache.hits, 1)
+            return self.assertFailure(d, Exception)
+
+        d = self.checker(self.event)
+        d.addCallback(lambda result: self.assertEqual(self.checker.cache.misses, 1))
+        d.addCallback(check_duplicate)
+        return d
+
+    def test_cache_miss(self):
+        # Events which were recorded in the database but are not in the cache
+        # are still rejected.
+        self.checker.event_db.check_event(self.event)
+        d = self.assertFailure(self.checker(self.event), Exception)
+        d.addCallback(lambda result: self.assertEqual(self.checker.cache.misses, 1))
+        return d
+
+    def test_cache_bounded(self):
+        def check_all(result):
+            self.assertEqual(len(self.checker.cache), 2)
+
+        events = [DummyEvent(b"ivo://comet.broker/test#%d" % (i,)) for i in range(3)]
+        d = defer.gatherResults([self.checker(event) for event in events])
+        d.addCallback(check_all)
+        return d
+
+    def test_preload(self):
+        # Preloaded events are rejected without consulting the database; only
+        # the most recent fit in the cache.
+        events = [DummyEvent(b"ivo://comet.broker/test#%d" % (i,)) for i in range(3)]
+        details = [self.checker.event_db.get_event_details(e) for e in events]
+        self.assertEqual(self.checker.preload(details), 2)
+        self.assertNotIn(details[0], self.checker.cache)
+        self.checker.event_db.check_event = None
+        d = self.checker(events[2])
+        self.assertTrue(d.called)
+        return self.assertFailure(d, Exception)
+
+    def test_interface(self):
+        self.assertTrue(IValidator.providedBy(self.checker))
+
+    def tearDown(self):
+        self.checker.event_db.close()
+        shutil.rmtree(self.event_db_dir)
+
+
+class CheckPreviouslySeenBatchedTestCase(unittest.TestCase):
+    def setUp(self):
+        self.event_db_dir = tempfile.mkdtemp()
+        self.checker = CheckPreviouslySeen(Event_DB(self.event_db_dir), batch_size=10)
+        self.event = DummyEvent()
+
+    def test_duplicates_in_batch(self):
+        # Of two copies checked together, exactly one is accepted.
+        d = defer.DeferredList(
+            [self.checker(self.event), self.checker(self.event)], consumeErrors=True
+        )
+        d.addCallback(
+            lambda results: self.assertEqual(
+                [success for success, value in results], [True, False]
+            )
+        )
+        return d
+
+    def tearDown(self):
+        self.checker.event_db.close()
+        shutil.rmtree(self.event_db_dir)
+
+
+class CheckPreviouslySeenIvornFirstTestCase(unittest.TestCase):
+    def setUp(self):
+        self.event_db_dir = tempfile.mkdtemp()
+        self.checker = CheckPreviouslySeen(
+            Event_DB(self.event_db_dir), cache_size=2, ivorn_first=True
+        )
+        self.event = DummyEvent()
+
+    def test_unseen(self):
+        d = self.checker(self.event)
+        d.addCallback(self.assertTrue)
+        return d
+
+    def test_duplicate(self):
+        # A duplicate of a recent event is hashed and rejected immediately,
+        # without consulting the database.
+        def check_duplicate(result):
+            self.assertEqual(self.checker.event_db.hash_count, 1)
+            self.checker.event_db.check_event = None
+            d = self.checker(DummyEvent())
+            self.assertTrue(d.called)
+            self.assertEqual(self.checker.event_db.hash_count, 2)
+            return self.assertFailure(d, Exception)
+
+        return self.checker(self.event).addCallback(check_duplicate)
+
+    def test_resubmission(self):
+        # A different event with a familiar IVOID is checked against the
+        # database.
+        def check_resubmission(result):
+            resubmitted = DummyEvent()
+            resubmitted.raw_bytes += b" "
+            return self.checker(resubmitted).addCallback(self.assertTrue)
+
+        return self.checker(self.event).addCallback(check_resubmission)
+
+    def test_cache_miss(self):
+        # Events with unfamiliar IVOIDs are still checked against the
+        # database.
+        self.checker.event_db.check_event(self.event)
+        return self.assertFailure(self.checker(self.event), Exception)
+
+    def test_batched(self):
+        checker = CheckPreviouslySeen(
+            self.checker.event_db, cache_size=2, batch_size=10, ivorn_first=True
+        )
+        d = defer.DeferredList(
+            [checker(self.event), checker(DummyEvent())], consumeErrors=True
+        )
+        d.addCallback(
+            lambda results: self.assertEqual(
+                [success for success, value in results], [True, False]
+            )
+        )
+        return d
+
+    def test_batched_hashing_deferred(self):
+        # With batching, events with unfamiliar IVOIDs are not hashed on the
+        # reactor thread, but along with the database lookup.
+        checker = CheckPreviouslySeen(
+            self.checker.event_db, cache_size=2, batch_size=10, ivorn_first=True
+        )
+        event_db = self.checker.event_db
+        d = checker(self.event)
+        self.assertFalse(self.event.has_digest(event_db._hash))
+        self.assertEqual(event_db.hash_count, 0)
+
+        def check_hashed(result):
+            self.assertTrue(result)
+            self.assertEqual(event_db.hash_count, 1)
+            self.assertEqual(
+                checker.cache.get(self.event.ivoid),
+                (self.event.size, event_db.get_event_details(self.event)),
+            )
+
+        return d.addCallback(check_hashed)
+
+    def test_no_preload(self):
+        self.assertEqual(self.checker.preload([("db", "key")]), 0)
+
     def tearDown(self):
+        self.checker.event_db.close()
         shutil.rmtree(self.event_db_dir)
@@ -3,12 +3,14 @@
 
 import os
 
+from lxml.etree import DocumentInvalid
+from twisted.internet.defer import DeferredSemaphore, gatherResults
 from twisted.trial import unittest
 
 import comet
 from comet.icomet import IValidator
 from comet.utility import xml_document
-from comet.validator import CheckSchema
+from comet.validator import CheckSchema, ValidationBacklogError
 from comet.testutils import DUMMY_VOEVENT
 
 BAD_EVENT_TEXT = b"""<xml></xml>"""
@@ -27,5 +29,80 @@ class CheckSchemaTestCase(unittest.TestCase):
         d = self.validator(xml_document(BAD_EVENT_TEXT))
         return self.assertFailure(d, Exception)
 
+    def test_recorded_valid(self):
+        # Events which were validated as they were parsed are not validated
+        # again.
+        event = xml_document.infer_type(DUMMY_VOEVENT, schema=self.validator.schema)
+        d = self.validator(event)
+        self.assertTrue(d.called)
+        return d
+
+    def test_recorded_invalid(self):
+        event = xml_document.infer_type(
+            DUMMY_VOEVENT.replace(b'version="2.0"', b'version="1.1"'),
+            schema=self.validator.schema,
+        )
+        d = self.validator(event)
+        self.assertTrue(d.called)
+        return self.assertFailure(d, DocumentInvalid)
+
+    def test_other_schema(self):
+        # Results recorded against a different schema are ignored.
+        other = CheckSchema(os.path.join(comet.__path__[0], "schema/VOEvent-v2.0.xsd"))
+        event = xml_document.infer_type(
+            DUMMY_VOEVENT.replace(b'version="2.0"', b'version="1.1"'),
+            schema=other.schema,
+        )
+        event.schema_validity = (other.schema, None)
+        return self.assertFailure(self.validator(event), DocumentInvalid)
+
     def test_interface(self):
         self.assertTrue(IValidator.providedBy(self.validator))
+
+
+class CheckSchemaProcessesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.validator = CheckSchema(
+            os.path.join(comet.__path__[0], "schema/VOEvent-v2.0.xsd"), processes=1
+        )
+        self.addCleanup(self.validator.close)
+
+    def test_valid(self):
+        return self.validator(xml_document(DUMMY_VOEVENT))
+
+    def test_invalid(self):
+        d = self.validator(xml_document(BAD_EVENT_TEXT))
+        return self.assertFailure(d, DocumentInvalid)
+
+    def test_max_pending(self):
+        # Events beyond the limit wait for earlier ones to finish.
+        self.validator._pending = DeferredSemaphore(1)
+        results = []
+        d = gatherResults(
+            [
+                self.validator(xml_document(text)).addBoth(results.append)
+                for text in (DUMMY_VOEVENT, BAD_EVENT_TEXT, DUMMY_VOEVENT)
+            ]
+        )
+        self.assertEqual(len(self.validator._pending.waiting), 2)
+
+        def check(result):
+            self.assertEqual(results[0], None)
+            self.assertTrue(results[1].check(DocumentInvalid))
+            self.assertEqual(results[2], None)
+
+        return d.addCallback(check)
+
+    def test_max_waiting(self):
+        # Once enough events are waiting, further ones are rejected.
+        self.validator._pending = DeferredSemaphore(1)
+        self.validator.max_waiting = 1
+        accepted = [self.validator(xml_document(DUMMY_VOEVENT)) for _ in range(2)]
+        rejected = self.validator(xml_document(DUMMY_VOEVENT))
+        self.assertEqual(len(self.validator._pending.waiting), 1)
+        return gatherResults(
+            [
+                gatherResults(accepted),
+                self.assertFailure(rejected, ValidationBacklogError),
+            ]
+        )